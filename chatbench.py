@@ -0,0 +1,757 @@
+from socket import create_connection, socketpair, timeout as SocketTimeout
+from sys import argv, executable, stderr, stdout, exit
+from threading import Lock, Thread
+from time import monotonic, perf_counter, sleep, time
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import tempfile
+from chatframing import (LineFramer, encode_message, parse_line, CHAT, JOIN_SUCCESS, QUEUE_JOIN_SUCCESS,
+                         IN_QUEUE, USER_ERROR, USER_DUP, KICK, EMPTY, AFK, SWITCH_PORT, SWITCH_CHANNEL, FILE_DATA,
+                         FILE_END, FILE_READY, TEXT)
+from chatmetrics import Histogram
+from chatserver import FILE_CHUNK_SIZE, OutboundSocket, server_options as chatserver_options
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chatserver.py")
+START_DELAY = 1.0  # seconds between starting the load processes and the first connection
+SETTLE_TIME = 1.0  # seconds between the end of the ramp and the measured phase
+RSS_INTERVAL = 0.2  # seconds between two samples of the memory of the server
+HOT_RATE = 200  # messages per second of each sender of the broadcast and isolation scenarios
+EMPTY_INTERVAL = 0.5  # seconds between two /empty of the empty scenario
+CHURN_INTERVAL = 0.5  # seconds a client of the replay scenario stays in its channel
+CLIENT_READ_DELAY = 0.1  # chatclient.py starts reading this long after it connects
+REPLAY_COUNT = "20"  # --replay given to the server in the replay scenario
+HANDOFF_WINDOW = 2.0  # seconds after the new server of the handoff scenario is started whose joins are measured
+PARSER_MESSAGES = 200000
+FAN_OUT_BROADCASTS = 20000  # broadcasts of the fan-out scenario, to every member of one channel
+FAN_OUT_MEMBERS = 8
+SEND_BLOCK = 1 << 20  # bytes of the generated file written and received at once in the send scenario
+SEND_CHAT_INTERVAL = 0.01  # seconds between two chat messages of the sender during the transfer
+SEND_TIMEOUT = 60  # seconds without data from the server before the send scenario gives up
+# {scenario: clients per place in the channels}, the place of each channel is its capacity
+SCENARIOS = {
+    "steady": 1.0,  # every member chats at --rate
+    "broadcast": 1.0,  # one member of each channel chats at HOT_RATE, the others only receive
+    # the first channel chats at HOT_RATE, the latency of the other channels is measured without it,
+    # with it, and with it on a --global-lock server: the stress check that with a lock per channel,
+    # traffic on one channel does not slow down the others
+    "isolation": 1.0,
+    "join-storm": 2.0,  # everyone connects at once, then half of the members leave and the queues move up
+    "switch": 0.5,  # everyone switches to the next channel at once, half in place and half by reconnecting
+    "afk": 1.0,  # half of the clients stay idle, go AFK and reconnect while the others chat
+    "empty": 1.5,  # channels are emptied while their members chat, emptied clients reconnect
+    "replay": 1.0,  # half of the clients keep leaving and joining again, which replays the history to them
+    "handoff": 1.0,  # like replay, and halfway through a new server takes over with --handoff
+    "idle": 1.0,  # everyone joins and stays idle, for the memory used by each connection
+    "parser": 0.0,  # messages per second of the v1 and v2 parsers of the server, without a server
+    "fan-out": 0.0,  # one busy channel, old per-member sendall() loop against the writer queues, without a server
+    "send": 0.0,  # a /send of --file-size MB over loopback, with the threaded and the --async writers
+    "workers": 1.0,  # the steady load against --workers=1 up to --max-workers, one run each
+}
+bench_options = {"scenario": "steady", "channels": "100", "capacity": "8", "clients": "", "processes": "4",
+                 "duration": "10", "ramp": "", "rate": "1", "afk": "", "base-port": "20000",
+                 "file-size": "50", "max-workers": "4", "output": "chatbench.json"}
+server_args = []  # everything after "--" is given to chatserver.py
+single_port = None  # set when the server is started with --port
+handoff_path = None  # Unix socket of the handoff scenario, when chosen by the harness
+rss_samples = []
+server_lines = 0
+
+
+def invalid_command_line():
+    print("Usage: chatbench [--name=value]... [-- server_option...]", file=stderr)
+    print("Scenarios: " + ", ".join(SCENARIOS), file=stderr)
+    exit(3)
+
+
+def process_command_line():
+    global server_args
+    global single_port
+    global handoff_path
+    args = argv[1:]
+    if "--" in args:
+        server_args = args[args.index("--") + 1:]
+        args = args[:args.index("--")]
+    for option in args:
+        name, has_value, value = option[2:].partition("=")
+        if not option.startswith("--") or name not in bench_options or not has_value or not value:
+            invalid_command_line()
+        bench_options[name] = value
+    scenario = bench_options["scenario"]
+    if scenario not in SCENARIOS:
+        invalid_command_line()
+    defaults = {"ramp": "0" if scenario == "join-storm" else "1", "afk": "2" if scenario == "afk" else "100"}
+    for name, value in defaults.items():
+        bench_options[name] = bench_options[name] or value
+    try:
+        if (int(bench_options["channels"]) < 1 or not 1 <= int(bench_options["capacity"]) <= 8
+                or int(bench_options["processes"]) < 1 or not 1 <= int(bench_options["afk"]) <= 1000
+                or not 1024 <= int(bench_options["base-port"]) <= 65535 - int(bench_options["channels"])
+                or float(bench_options["duration"]) <= 0 or float(bench_options["ramp"]) < 0
+                or float(bench_options["rate"]) <= 0 or int(bench_options["clients"] or 1) < 1
+                or float(bench_options["file-size"]) <= 0 or int(bench_options["max-workers"]) < 1
+                or (scenario == "send" and int(bench_options["capacity"]) < 2)):
+            invalid_command_line()
+    except ValueError:
+        invalid_command_line()
+    if not bench_options["clients"]:
+        places = int(bench_options["channels"]) * int(bench_options["capacity"])
+        bench_options["clients"] = str(max(1, int(places * SCENARIOS[scenario])))
+    if scenario == "replay" and not any(arg.startswith("--replay=") for arg in server_args):
+        server_args.append("--replay=" + REPLAY_COUNT)
+    if scenario == "handoff" and not any(arg.startswith("--handoff=") for arg in server_args):
+        handoff_path = os.path.join(tempfile.gettempdir(), f"chatbench-{os.getpid()}.sock")
+        server_args.append("--handoff=" + handoff_path)
+    for arg in server_args:
+        if arg.startswith("--port="):
+            single_port = int(arg[7:])
+
+
+def channel_name(index):
+    return f"bench{index}"
+
+
+def write_config():
+    config_file = tempfile.NamedTemporaryFile("w", prefix="chatbench-", suffix=".txt", delete=False)
+    base_port = int(bench_options["base-port"])
+    for index in range(int(bench_options["channels"])):
+        config_file.write(f"channel {channel_name(index)} {base_port + index} {bench_options['capacity']}\n")
+    config_file.close()
+    return config_file.name
+
+
+# Resident memory of the server and of its --workers processes, in bytes (Linux only, 0 elsewhere)
+def server_rss(pid):
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f"/proc/{pid}/status") as status:
+                total += next(int(line.split()[1]) for line in status if line.startswith("VmRSS:")) * 1024
+            for task in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{task}/children") as children:
+                    pids += [int(child) for child in children.read().split()]
+        except (OSError, StopIteration):
+            pass
+    return total
+
+
+def sample_rss(server):
+    while server.poll() is None:  # until a new server takes over in the handoff scenario
+        rss_samples.append(server_rss(server.pid))
+        sleep(RSS_INTERVAL)
+
+
+# Every chat message is printed by the server, its output is read as it comes so it never blocks
+def read_server_output(server):
+    global server_lines
+    for _ in server.stdout:
+        server_lines += 1
+
+
+# A server taking over with --handoff may serve the clients of the old one before its "Welcome"
+def start_server(config_filename, taking_over=False, args=None):
+    global server_lines
+    args = server_args if args is None else args
+    server = subprocess.Popen([executable, SERVER, *args, bench_options["afk"], config_filename],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    for line in server.stdout:
+        if line == "Welcome to chatserver.\n":
+            break
+        if taking_over and not line.startswith("Channel \""):
+            server_lines += 1
+        elif not line.startswith("Channel \""):
+            print(f"Error: the server did not start: {line.strip()}", file=stderr)
+            server.kill()
+            exit(8)
+    else:
+        print("Error: the server did not start.", file=stderr)
+        exit(8)
+    Thread(target=read_server_output, args=(server,), daemon=True).start()
+    Thread(target=sample_rss, args=(server,), daemon=True).start()
+    return server
+
+
+# One simulated chatclient, it speaks the text protocol like chatclient.py does
+class BenchClient:
+    def __init__(self, number, plan):
+        self.number = number
+        self.name = f"user{number}"
+        self.channel = number % plan["channels"]
+        self.reader = None
+        self.writer = None
+        self.state = None  # "member", "queued" or None when not connected
+        self.connected_at = 0.0
+        self.joined_at = 0.0
+        self.queued_at = 0.0
+        self.switch_started = None
+        self.switch_reconnected = False  # the server answered the /switch with "$Switch:" or "$SwitchChannel:"
+        self.switch_port = None  # port given by "$Switch:", None for the shared port of --port mode
+        self.in_place = plan["scenario"] == "switch" and number % 2 == 0  # announces "$Hello: switch"
+        self.read_task = None  # kept so the task is not garbage collected while it waits
+        self.leaving = False
+        self.reconnect_on_close = plan["scenario"] in ("afk", "empty")
+
+
+# Histograms and counters of one load process, sent to the harness at the end
+def new_results():
+    results = {name: Histogram() for name in ("join_latency", "queue_wait", "broadcast_latency",
+                                              "hot_broadcast_latency", "switch_in_place", "switch_reconnect",
+                                              "handoff_join_latency")}
+    results.update({name: 0 for name in ("sent", "delivered", "joined", "queued", "rejoins", "refused",
+                                         "kicked", "emptied", "afk", "name_errors")})
+    return results
+
+
+async def sleep_until(deadline):
+    await asyncio.sleep(max(0.0, deadline - monotonic()))
+
+
+def send_line(client, line):
+    if client.writer is not None and not client.writer.is_closing():
+        client.writer.write(line.encode())
+
+
+async def connect(client, plan, results, port=None, read_delay=0.0):
+    port = port or single_port or plan["base_port"] + client.channel
+    client.connected_at = monotonic()
+    try:
+        client.reader, client.writer = await asyncio.open_connection("127.0.0.1", port)
+    except OSError:
+        results["refused"] += 1
+        return
+    if single_port:
+        send_line(client, f"$User: {client.name} {channel_name(client.channel)}\n")
+    else:
+        send_line(client, f"$User: {client.name}\n")
+    if client.in_place:
+        send_line(client, "$Hello: switch\n")
+    await asyncio.sleep(read_delay)
+    client.read_task = asyncio.get_running_loop().create_task(read_forever(client, client.reader, plan, results))
+
+
+async def reconnect(client, plan, results, delay):
+    await asyncio.sleep(delay)
+    if monotonic() < plan["end"]:
+        results["rejoins"] += 1
+        await connect(client, plan, results)
+
+
+def admitted(client, plan, results, now):
+    if client.switch_started is not None:
+        switch_type = "switch_reconnect" if client.switch_reconnected else "switch_in_place"
+        results[switch_type].record(now - client.switch_started)
+        client.switch_started = None
+    else:
+        results["join_latency"].record(now - client.connected_at)
+        # connections made while the new server takes over wait in the accept queue for it
+        if plan["handoff"] is not None and plan["handoff"] <= client.connected_at < plan["handoff"] + HANDOFF_WINDOW:
+            results["handoff_join_latency"].record(now - client.connected_at)
+
+
+def process_line(client, line, plan, results):
+    now = monotonic()
+    if line[0] == "[":  # "[username] bench <time sent>"
+        fields = line.split(" ")
+        if len(fields) == 3 and fields[1] == "bench":
+            sent_at = float(fields[2])
+            if sent_at >= client.joined_at:  # older messages are replayed history
+                hot = plan["scenario"] == "isolation" and client.channel == 0
+                results["hot_broadcast_latency" if hot else "broadcast_latency"].record(now - sent_at)
+                results["delivered"] += 1
+        return
+    kind, fields = parse_line(line)
+    if kind == JOIN_SUCCESS or kind == IN_QUEUE:
+        admitted(client, plan, results, now)
+    if kind == JOIN_SUCCESS or kind == QUEUE_JOIN_SUCCESS:
+        if kind == QUEUE_JOIN_SUCCESS:
+            results["queue_wait"].record(now - client.queued_at)
+        client.state = "member"
+        client.joined_at = now
+        results["joined"] += 1
+        send_line(client, "$Joined\n")
+    elif kind == IN_QUEUE:
+        client.state = "queued"
+        client.queued_at = now
+        results["queued"] += 1
+    elif kind == KICK:
+        results["kicked"] += 1
+        send_line(client, "$Quit-kicked\n")
+    elif kind == EMPTY:
+        results["emptied"] += 1
+    elif kind == AFK:
+        results["afk"] += 1
+    elif kind == USER_ERROR:  # the name was still taken, like chatclient.py the client gives up this connection
+        results["name_errors"] += 1
+        client.writer.close()
+    elif kind == USER_DUP:
+        results["name_errors"] += 1
+    elif kind == SWITCH_PORT or kind == SWITCH_CHANNEL:  # the old way, the client reconnects, see read_forever()
+        client.switch_reconnected = True
+        client.switch_port = int(fields[-1]) if kind == SWITCH_PORT else None
+
+
+async def read_forever(client, reader, plan, results):
+    try:
+        while line := await reader.readline():
+            process_line(client, line.decode("utf-8", "replace"), plan, results)
+    except (OSError, ValueError):
+        pass
+    if reader is not client.reader:  # this connection was replaced by a switch
+        return
+    client.state = None
+    if client.writer is not None:
+        client.writer.close()
+    client.reader = client.writer = None
+    if client.switch_started is not None and client.switch_reconnected:
+        # like chatclient.py: it waits for the server to close the old connection, then connects
+        # to the new channel and only reads from it CLIENT_READ_DELAY later
+        await connect(client, plan, results, client.switch_port, CLIENT_READ_DELAY)
+    elif client.reconnect_on_close and not client.leaving:
+        await reconnect(client, plan, results, random.uniform(0.1, 0.5))
+
+
+# Open loop: messages are sent on schedule whether or not the server keeps up
+async def chat_forever(client, rate, plan, results):
+    next_send = monotonic() + random.random() / rate
+    while next_send < plan["end"]:
+        await sleep_until(next_send)
+        if client.state == "member":
+            send_line(client, f"bench {monotonic():.6f}\n")
+            results["sent"] += 1
+        next_send += 1 / rate
+
+
+async def leave(client):
+    client.leaving = True
+    send_line(client, "$Quit\n")
+    if client.writer is not None:
+        client.writer.close()
+    client.reader = client.writer = None
+    client.state = None
+
+
+async def churn_forever(client, plan, results):
+    while monotonic() + CHURN_INTERVAL < plan["end"]:
+        await asyncio.sleep(CHURN_INTERVAL * random.uniform(0.5, 1.5))
+        await leave(client)
+        await asyncio.sleep(0.05)  # the server has to see the "$Quit" before the name is free again
+        client.leaving = False
+        results["rejoins"] += 1
+        await connect(client, plan, results)
+
+
+async def client_life(client, plan, results):
+    scenario = plan["scenario"]
+    await sleep_until(plan["start"] + plan["ramp"] * client.number / plan["clients"])
+    await connect(client, plan, results)
+    await sleep_until(plan["measure"])
+    rate = plan["rate"]
+    if scenario in ("steady", "empty", "workers") or (scenario == "afk" and client.number % 2 == 0):
+        await chat_forever(client, rate, plan, results)
+    elif scenario == "broadcast" and client.number < plan["channels"]:  # the first client of each channel
+        await chat_forever(client, HOT_RATE, plan, results)
+    elif scenario == "isolation":
+        await chat_forever(client, HOT_RATE if client.channel == 0 and plan["hot"] else rate, plan, results)
+    elif scenario in ("replay", "handoff"):
+        await (churn_forever(client, plan, results) if client.number % 2 else chat_forever(client, rate, plan, results))
+    elif scenario == "join-storm" and client.state == "member" and client.number // plan["channels"] % 2 == 0:
+        await leave(client)
+    elif scenario == "switch" and client.state is not None:
+        await asyncio.sleep(random.uniform(0, 0.1))
+        client.channel = (client.channel + 1) % plan["channels"]
+        client.switch_started = monotonic()
+        send_line(client, f"/switch {channel_name(client.channel)}\n")
+    await sleep_until(plan["end"])
+    await leave(client)
+
+
+async def run_clients(numbers, plan, results):
+    await asyncio.gather(*(client_life(BenchClient(number, plan), plan, results) for number in numbers))
+    await asyncio.sleep(0.2)  # let the "$Quit" lines go out
+    readers = asyncio.all_tasks() - {asyncio.current_task()}
+    for reader in readers:
+        reader.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+
+
+# Body of a load process: its share of the clients run on one event loop
+def run_load(connection, numbers, plan):
+    random.seed(numbers[0] if numbers else 0)
+    results = new_results()
+    asyncio.run(run_clients(numbers, plan, results))
+    connection.send(results)
+    connection.close()
+
+
+def summary(histogram):
+    if histogram.count == 0:
+        return None
+    return {"count": histogram.count, "mean_ms": histogram.total / histogram.count * 1000,
+            "p50_ms": histogram.percentile(0.5) * 1000, "p99_ms": histogram.percentile(0.99) * 1000,
+            "p999_ms": histogram.percentile(0.999) * 1000, "max_ms": histogram.max / 1000}
+
+
+# Messages per second of the server side of each protocol: LineFramer, then parse_line() for v1
+def parser_benchmark():
+    report = {}
+    text = "bench " + "x" * 60
+    for version in (1, 2):
+        data = encode_message(version, CHAT, text) * PARSER_MESSAGES
+        framer = LineFramer()
+        messages = 0
+        started = perf_counter()
+        for position in range(0, len(data), 65536):
+            framer.feed(data[position:position + 65536])
+            for message in framer.messages():
+                kind, fields = message if isinstance(message, tuple) else parse_line(message)
+                messages += 1
+        report[f"v{version}_messages_per_second"] = messages / (perf_counter() - started)
+    return report
+
+
+# Connection of the send scenario to the first channel, once it is a member
+def join_first_channel(name):
+    connection = create_connection(("127.0.0.1", single_port or int(bench_options["base-port"])))
+    connection.settimeout(SEND_TIMEOUT)
+    connection.sendall(f"$User: {name}{' ' + channel_name(0) if single_port else ''}\n".encode())
+    framer = LineFramer()
+    while True:
+        data = connection.recv(SEND_BLOCK)
+        if not data:
+            print(f"Error: {name} could not join {channel_name(0)}.", file=stderr)
+            exit(8)
+        framer.feed(data)
+        for line in framer.lines():
+            if parse_line(line)[0] == JOIN_SUCCESS:
+                return connection
+
+
+def chat_during_transfer(sender, send_lock, done):
+    while not done:
+        with send_lock:
+            sender.sendall(f"bench {monotonic():.6f}\n".encode())
+        sleep(SEND_CHAT_INTERVAL)
+
+
+# The sender uploads the file as chatclient.py does, one chunk for each one the server grants
+def upload_file(sender, send_lock, path, size):
+    with send_lock:
+        sender.sendall(f"$File: 1 {size} receiver {path}\n".encode())
+    framer = LineFramer()
+    with open(path, "rb") as file:
+        while file.tell() < size and (data := sender.recv(SEND_BLOCK)):
+            framer.feed(data)
+            for line in framer.lines():
+                kind, fields = parse_line(line)
+                if kind != FILE_READY:
+                    continue
+                for _ in range(int(fields[1])):
+                    chunk = file.read(FILE_CHUNK_SIZE)
+                    with send_lock:
+                        sender.sendall(f"$FileData: 1 {len(chunk)}\n".encode() + chunk)
+                    if file.tell() >= size:
+                        break
+    with send_lock:
+        sender.sendall(b"$FileEnd: 1\n")
+
+
+# Seconds from the "$File:" of the sender to the "$FileEnd:" on the receiver's connection, the sender's chat
+# messages are read from the same connection, between the chunks of the file
+def receive_file(receiver, chat_latency):
+    framer = LineFramer()
+    received = 0
+    while data := receiver.recv(SEND_BLOCK):
+        framer.feed(data)
+        while True:
+            if framer.raw_remaining:
+                received += len(framer.read_raw())
+                if framer.raw_remaining:
+                    break
+            line = framer.next_line()
+            if line is None:
+                break
+            kind, fields = parse_line(line)
+            if kind == FILE_DATA:
+                framer.expect_raw(int(fields[1]))
+            elif kind == FILE_END:
+                return received
+            elif line.startswith("[sender] bench "):
+                chat_latency.record(monotonic() - float(line.split(" ")[2]))
+    return received
+
+
+def send_file_over(config_filename, path, size, args):
+    server = start_server(config_filename, args=args)
+    receiver, sender = join_first_channel("receiver"), join_first_channel("sender")
+    chat_latency = Histogram()
+    send_lock = Lock()  # the chat messages go between the chunks of the upload
+    done = []
+    chatter = Thread(target=chat_during_transfer, args=(sender, send_lock, done), daemon=True)
+    uploader = Thread(target=upload_file, args=(sender, send_lock, path, size), daemon=True)
+    started = monotonic()
+    uploader.start()
+    chatter.start()
+    try:
+        received = receive_file(receiver, chat_latency)
+    except SocketTimeout:
+        received = 0
+    seconds = monotonic() - started
+    done.append(True)
+    chatter.join()
+    uploader.join(SEND_TIMEOUT)
+    receiver.close()
+    sender.close()
+    server.stdin.write("/shutdown\n")
+    server.stdin.flush()
+    server.wait()
+    if received != size:
+        print(f"Error: {received} of {size} bytes of the file were received.", file=stderr)
+        exit(8)
+    return {"seconds": seconds, "mb_per_second": size / 1e6 / seconds, "chat_latency": summary(chat_latency)}
+
+
+# Throughput of /send on loopback with the writer thread of each client and with the event loop, the
+# sender uploads the file and the server relays each chunk to the receiver.
+# The sender chats during the transfer, so the report also shows how long chat messages wait behind the chunks
+def send_benchmark():
+    size = int(float(bench_options["file-size"]) * 1e6)
+    block = os.urandom(SEND_BLOCK)
+    with tempfile.NamedTemporaryFile(prefix="chatbench-", suffix=".bin", delete=False) as data_file:
+        for offset in range(0, size, SEND_BLOCK):
+            data_file.write(block[:size - offset])
+    config_filename = write_config()
+    threaded_args = [arg for arg in server_args if arg != "--async"]
+    report = {"file_bytes": size}
+    for writer, args in (("threaded", threaded_args), ("async", threaded_args + ["--async"])):
+        report[writer] = send_file_over(config_filename, data_file.name, size, args)
+    os.remove(config_filename)
+    os.remove(data_file.name)
+    return report
+
+
+# Counts the calls that write to the socket, each of them is one system call for a chat message
+class CountingSocket:
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+        self.calls = 0
+
+    def sendall(self, data):
+        self.calls += 1
+        self.wrapped.sendall(data)
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        return self.wrapped.sendmsg(buffers)
+
+    def shutdown(self, how):
+        self.wrapped.shutdown(how)
+
+    def close(self):
+        self.wrapped.close()
+
+
+def drain(member_end, expected):
+    received = 0
+    while received < expected:
+        received += len(member_end.recv(SEND_BLOCK))
+
+
+# Broadcasts to the FAN_OUT_MEMBERS members of one channel, over socketpairs. The old path is the
+# notify_channel() loop of the first version of the server: the message is encoded for each member
+# and written with one sendall() each. The new path encodes it once and queues the same bytes on the
+# OutboundSocket of each member, whose writer thread sends everything waiting with one sendmsg()
+def fan_out_run(path, message):
+    pairs = [socketpair() for _ in range(FAN_OUT_MEMBERS)]
+    counters = [CountingSocket(server_end) for server_end, _ in pairs]
+    members = counters if path == "old" else [OutboundSocket(counter) for counter in counters]
+    expected = FAN_OUT_BROADCASTS * len(message.encode())
+    readers = [Thread(target=drain, args=(member_end, expected)) for _, member_end in pairs]
+    for reader in readers:
+        reader.start()
+    started = perf_counter()
+    for _ in range(FAN_OUT_BROADCASTS):
+        if path == "old":
+            for member in members:
+                member.sendall(message.encode())
+        else:
+            encoded = encode_message(1, TEXT, message[:-1])
+            for member in members:
+                member.sendall(encoded)
+    for reader in readers:
+        reader.join()
+    seconds = perf_counter() - started
+    for member in members:
+        member.close()
+    for _, member_end in pairs:
+        member_end.close()
+    calls = sum(counter.calls for counter in counters)
+    return {"syscalls_per_broadcast": calls / FAN_OUT_BROADCASTS,
+            "broadcasts_per_second": FAN_OUT_BROADCASTS / seconds,
+            "messages_per_second": FAN_OUT_BROADCASTS * FAN_OUT_MEMBERS / seconds}
+
+
+def fan_out_benchmark():
+    chatserver_options["slow-consumer"] = "block"  # the broadcasts come faster than any reader, never drop them
+    message = "[user0] bench " + "x" * 40 + "\n"
+    return {"members": FAN_OUT_MEMBERS, "broadcasts": FAN_OUT_BROADCASTS,
+            "old": fan_out_run("old", message), "new": fan_out_run("new", message)}
+
+
+def run_benchmark(args=None, hot=True):
+    global server_lines
+    args = server_args if args is None else args
+    clients = int(bench_options["clients"])
+    processes = min(int(bench_options["processes"]), clients)
+    duration = float(bench_options["duration"])
+    rss_samples.clear()  # of the previous run, if any
+    server_lines = 0
+    config_filename = write_config()
+    server = start_server(config_filename, args=args)
+    sleep(2 * RSS_INTERVAL)
+    baseline_rss = rss_samples[-1]
+    start = monotonic() + START_DELAY
+    plan = {"scenario": bench_options["scenario"], "channels": int(bench_options["channels"]), "clients": clients,
+            "base_port": int(bench_options["base-port"]), "rate": float(bench_options["rate"]), "start": start,
+            "ramp": float(bench_options["ramp"]), "measure": start + float(bench_options["ramp"]) + SETTLE_TIME,
+            "hot": hot}
+    plan["end"] = plan["measure"] + duration
+    plan["handoff"] = plan["measure"] + duration / 2 if plan["scenario"] == "handoff" else None
+    context = multiprocessing.get_context("fork")
+    connections = []
+    for process in range(processes):
+        harness_end, load_end = context.Pipe()
+        numbers = list(range(process, clients, processes))
+        context.Process(target=run_load, args=(load_end, numbers, plan), daemon=True).start()
+        connections.append(harness_end)
+    sleep(max(0.0, plan["measure"] - monotonic()))
+    joined_rss = rss_samples[-1]
+    if plan["scenario"] == "empty":
+        while monotonic() + EMPTY_INTERVAL < plan["end"]:
+            sleep(EMPTY_INTERVAL)
+            server.stdin.write(f"/empty {channel_name(random.randrange(plan['channels']))}\n")
+            server.stdin.flush()
+    if plan["handoff"] is not None:  # the same command line again, the new server takes over from the old one
+        sleep(max(0.0, plan["handoff"] - monotonic()))
+        old_server, server = server, start_server(config_filename, taking_over=True, args=args)
+        handoff_seconds = monotonic() - plan["handoff"]
+        old_server.wait()
+    sleep(max(0.0, plan["end"] - monotonic()))
+    loaded_rss = rss_samples[-1]  # before the clients leave
+    results = new_results()
+    for connection in connections:
+        for name, value in connection.recv().items():
+            if isinstance(value, Histogram):
+                results[name].merge(value)
+            else:
+                results[name] += value
+    end_rss = rss_samples[-1]
+    server.stdin.write("/shutdown\n")
+    server.stdin.flush()
+    server.wait()
+    os.remove(config_filename)
+    if handoff_path is not None and os.path.exists(handoff_path):
+        os.remove(handoff_path)
+    report = {"scenario": plan["scenario"], "started": time(), "options": dict(bench_options),
+              "server_options": args, "clients": clients, "processes": processes}
+    for name in ("join_latency", "queue_wait", "broadcast_latency", "hot_broadcast_latency",
+                 "switch_in_place", "switch_reconnect", "handoff_join_latency"):
+        report[name] = summary(results[name])
+    if plan["handoff"] is not None:
+        report["handoff_seconds"] = handoff_seconds  # from starting the new server to its "Welcome"
+
+    report["events"] = {name: value for name, value in results.items() if not isinstance(value, Histogram)}
+    report["sent_per_second"] = results["sent"] / duration
+    report["delivered_per_second"] = results["delivered"] / duration
+    report["server_lines"] = server_lines
+    report["rss_bytes"] = {"baseline": baseline_rss, "joined": joined_rss, "loaded": loaded_rss,
+                           "peak": max(rss_samples), "end": end_rss}
+    report["rss_bytes_per_client"] = (loaded_rss - baseline_rss) / clients
+    return report
+
+
+# The quiet channels of the isolation scenario are measured while the first channel chats at the
+# same rate as them, then at HOT_RATE, then at HOT_RATE on a server whose channels share one lock
+def isolation_benchmark():
+    args = [arg for arg in server_args if arg != "--global-lock"]
+    quiet = run_benchmark(args, hot=False)
+    report = run_benchmark(args)
+    shared = run_benchmark(args + ["--global-lock"])
+    runs = {"no_hot_channel": quiet, "lock_per_channel": report, "global_lock": shared}
+    report["isolation"] = {name: {"quiet_channels": run["broadcast_latency"], "first_channel": run["hot_broadcast_latency"]}
+                           for name, run in runs.items()}
+    for quantile in ("p50_ms", "p99_ms"):
+        latency = {name: (run["broadcast_latency"] or {}).get(quantile, 0.0) for name, run in runs.items()}
+        report["isolation"][f"quiet_{quantile}_difference"] = {
+            "hot_channel": latency["lock_per_channel"] - latency["no_hot_channel"],
+            "global_lock": latency["global_lock"] - latency["lock_per_channel"]}
+    return report
+
+
+def print_isolation_table(isolation):
+    stdout.write(f"{'quiet channels':<16} {'p50 ms':>8} {'p99 ms':>8}\n")
+    for name in ("no_hot_channel", "lock_per_channel", "global_lock"):
+        latency = isolation[name]["quiet_channels"] or {}
+        stdout.write(f"{name:<16} {latency.get('p50_ms', 0):>8.2f} {latency.get('p99_ms', 0):>8.2f}\n")
+    for name in ("hot_channel", "global_lock"):
+        stdout.write(f"{'+' + name:<16} {isolation['quiet_p50_ms_difference'][name]:>+8.2f} "
+                     f"{isolation['quiet_p99_ms_difference'][name]:>+8.2f}\n")
+    stdout.flush()
+
+
+# The same steady load against 1 to --max-workers worker processes, one server per run
+def workers_benchmark():
+    args = [arg for arg in server_args if not arg.startswith("--workers=")]
+    runs = {}
+    for workers in range(1, int(bench_options["max-workers"]) + 1):
+        report = run_benchmark(args + [f"--workers={workers}"])
+        runs[workers] = {"sent_per_second": report["sent_per_second"],
+                         "delivered_per_second": report["delivered_per_second"],
+                         "broadcast_latency": report["broadcast_latency"], "peak_rss_bytes": report["rss_bytes"]["peak"]}
+    return runs
+
+
+def print_workers_table(runs):
+    stdout.write(f"{'workers':>7} {'sent/s':>10} {'delivered/s':>12} {'p50 ms':>8} {'p99 ms':>8}\n")
+    for workers, run in runs.items():
+        latency = run["broadcast_latency"] or {}
+        stdout.write(f"{workers:>7} {run['sent_per_second']:>10.0f} {run['delivered_per_second']:>12.0f} "
+                     f"{latency.get('p50_ms', 0):>8.2f} {latency.get('p99_ms', 0):>8.2f}\n")
+    stdout.flush()
+
+
+def print_report(report):
+    for name, value in report.items():
+        if name not in ("options", "server_options", "started") and value is not None:
+            stdout.write(f"{name}: {json.dumps(value)}\n")
+    stdout.flush()
+
+
+if __name__ == "__main__":
+    process_command_line()
+    if bench_options["scenario"] == "parser":
+        report = {"scenario": "parser", "started": time(), "messages": PARSER_MESSAGES, **parser_benchmark()}
+    elif bench_options["scenario"] == "fan-out":
+        report = {"scenario": "fan-out", "started": time(), **fan_out_benchmark()}
+    elif bench_options["scenario"] == "send":
+        report = {"scenario": "send", "started": time(), "server_options": server_args, **send_benchmark()}
+    elif bench_options["scenario"] == "isolation":
+        report = isolation_benchmark()
+    elif bench_options["scenario"] == "workers":
+        report = {"scenario": "workers", "started": time(), "options": dict(bench_options),
+                  "server_options": server_args, "runs": workers_benchmark()}
+    else:
+        report = run_benchmark()
+    with open(bench_options["output"], "w") as output_file:
+        json.dump(report, output_file, indent=2)
+        output_file.write("\n")
+    if report["scenario"] == "workers":
+        print_workers_table(report["runs"])
+    else:
+        print_report(report)
+    if report["scenario"] == "isolation":
+        print_isolation_table(report["isolation"])
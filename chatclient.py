@@ -1,22 +1,39 @@
 from sys import argv, stderr, stdout, stdin, exit
 from socket import *
-from threading import Thread, Event
+from threading import Thread, Event, Lock
+from itertools import count
 import os
 from time import sleep
+from chatframing import (LineFramer, encode_message, parse_line, USER_ERROR, USER_DUP, JOIN_SUCCESS,
+                         QUEUE_JOIN_SUCCESS, IN_QUEUE, QUEUE_MOVED, KICK, EMPTY, AFK, SWITCH_PORT,
+                         SWITCH_CHANNEL, FILE, FILE_DATA, FILE_END, TEXT, CHAT, HELLO, LIST, SWITCH,
+                         WHISPER, QUIT, QUIT_KICKED, JOINED, HISTORY, RESUME, CATCH_UP, FILE_READY)
 
-BUFSIZE = 1024
+BUFSIZE = 65536
+FILE_CHUNK_SIZE = 65536  # largest chunk the server relays
 
 port_number = None
+server_host = 'localhost'  # changed by "$Switch: <host> <port>" when another node serves the channel
 client_username = None
+channel_name = None  # named in the "$User:" line when the server serves every channel on one port
 server_connected = None
 status = None
 switching = False
 stop_thread = False
 current_server_socket = None
+receiving_files = {}  # {transfer_id: [file, path, size, received, progress]}
+receiving_id = None  # transfer whose chunk is being read
+sending_files = {}  # {upload_id: [file, size]} of the files being sent with /send
+upload_ids = count(1)
+send_lock = Lock()  # the chunks of a file are sent by the thread reading from the server
+protocol_version = 1  # 2 once the server answers "$Hello: v2"
+current_channel = None
+last_offsets = {}  # {channel_name: log offset of the last message seen}, sent by servers with --log-dir
+first_live_offset = None  # offset of the first message received since joining the channel
 
 
 def invalid_command_line():
-    print("Usage: chatclient port_number client_username", file=stderr)
+    print("Usage: chatclient port_number client_username [channel_name]", file=stderr)
     exit(3)
 
 
@@ -42,11 +59,14 @@ def is_whitespace(command):
 
 def process_command_line():
     global client_username
-    if len(argv) != 3:
+    global channel_name
+    if len(argv) != 3 and len(argv) != 4:
         invalid_command_line()
-    if is_whitespace(argv[1]) or is_whitespace(argv[2]):
+    if any(is_whitespace(arg) for arg in argv[1:]):
         invalid_command_line()
     client_username = argv[2]
+    if len(argv) == 4:
+        channel_name = argv[3]
 
 
 def port_checking():
@@ -58,12 +78,13 @@ def port_checking():
         cant_connect(argv[1])
 
 
+# "/list [prefix=name_prefix] [free] [page=number] [subscribe|unsubscribe]", the filters are checked by the server
 def check_command_list(command, server_socket):
-    if command != "/list\n":
-        stdout.write("[Server Message] Usage: /list\n")
+    if command[:6] not in ("/list\n", "/list ") or "" in command[:-1].split(" ")[1:]:
+        stdout.write("[Server Message] Usage: /list [prefix=name_prefix] [free] [page=number] [subscribe|unsubscribe]\n")
         stdout.flush()
     else:
-        server_socket.sendall("$List\n".encode())
+        send_message(server_socket, LIST, *command.split()[1:])
 
 
 def check_command_switch(line, server_socket):
@@ -72,7 +93,7 @@ def check_command_switch(line, server_socket):
         stdout.write("[Server Message] Usage: /switch channel_name\n")
         stdout.flush()
     else:
-        server_socket.sendall(line.encode())
+        send_message(server_socket, SWITCH, command[1])
 
 
 def check_command_send(line, server_socket):
@@ -88,14 +109,28 @@ def check_command_send(line, server_socket):
         stdout.write("[Server Message] Cannot send file to yourself.\n")
         stdout.flush()
         return
-    server_socket.sendall(line.encode())
+    try:
+        file = open(command[2], "rb")
+    except OSError:
+        stdout.write(f"[Server Message] \"{command[2]}\" does not exist.\n")
+        stdout.flush()
+        return
+    upload_id = str(next(upload_ids))
+    size = os.fstat(file.fileno()).st_size
+    sending_files[upload_id] = [file, size]
+    send_message(server_socket, FILE, upload_id, size, target_username, command[2])
 
 
 def check_command_whisper(line, server_socket):
     if status == "in-queue":
         return
-    command = line.split()
-    if len(command) != 3 or line.count(" ") != 2:
+    if protocol_version == 2:  # the whole message is sent, spaces included
+        command = line[:-1].split(" ", 2)
+        valid = len(command) == 3 and "" not in command
+    else:
+        command = line.split()
+        valid = len(command) == 3 and line.count(" ") == 2
+    if not valid:
         stdout.write("[Server Message] Usage: /whisper receiver_client_username chat_message\n")
         stdout.flush()
         return
@@ -104,7 +139,21 @@ def check_command_whisper(line, server_socket):
     if target_username == client_username:  # whispers to self
         stdout.write(f"[{client_username} whispers to you] {chat_message}\n")
         stdout.flush()
-    server_socket.sendall(line.encode())
+    send_message(server_socket, WHISPER, target_username, chat_message)
+
+
+def check_command_history(line, server_socket):
+    command = line.split()
+    if len(command) != 2 or line.count(" ") != 1 or not command[1].isdigit() or int(command[1]) < 1:
+        stdout.write("[Server Message] Usage: /history number_of_messages\n")
+        stdout.flush()
+    else:
+        send_message(server_socket, HISTORY, command[1])
+
+
+def send_message(server_socket, kind, *fields):
+    with send_lock:
+        server_socket.sendall(encode_message(protocol_version, kind, *fields))
 
 
 # A 2nd thread to continuously read data sent from server
@@ -114,7 +163,7 @@ def read_from_stdin():
     try:
         for line in stdin:
             if line == "/quit\n":
-                current_server_socket.send("$Quit\n".encode())
+                send_message(current_server_socket, QUIT)
                 quit()
             elif line[:5] == "/quit":
                 stdout.write("[Server Message] Usage: /quit\n")
@@ -127,24 +176,26 @@ def read_from_stdin():
                 check_command_send(line, current_server_socket)
             elif line[:8] == "/whisper":
                 check_command_whisper(line, current_server_socket)
+            elif line[:8] == "/history":
+                check_command_history(line, current_server_socket)
             elif line[0] != "/" and line[0] != "$":
-                current_server_socket.send(line.encode())
+                send_message(current_server_socket, CHAT, line.rstrip("\n"))
     except Exception as e:
         pass
     quit()
 
 
 # Client Runtime Behaviour - when clients successfully connected to the channel
-def channel_connected(message, server_socket):
-    if message[:4] == "$01-":
+def channel_connected(kind, fields, server_socket):
+    if kind == JOIN_SUCCESS or kind == IN_QUEUE:
         print(f"Welcome to chatclient, {client_username}.")
-    if message[4:16] == "JoinSuccess:":
-        stdout.write(f"[Server Message] You have joined the channel \"{message[17:]}\".\n")
+    if kind == JOIN_SUCCESS or kind == QUEUE_JOIN_SUCCESS:
+        stdout.write(f"[Server Message] You have joined the channel \"{fields[0]}\".\n")
         stdout.flush()
-        server_socket.sendall("$Joined\n".encode())
+        send_message(server_socket, JOINED)
         status = "in-channel"
-    elif message[4:12] == "InQueue:":
-        stdout.write(f"[Server Message] You are in the waiting queue and there are {message[13:]} user(s) ahead of you.\n")
+    else:
+        stdout.write(f"[Server Message] You are in the waiting queue and there are {fields[0]} user(s) ahead of you.\n")
         stdout.flush()
         status = "in-queue"
 
@@ -156,59 +207,230 @@ def removed(server_socket):
     quit()
 
 
-def switch_channel(line):
+# The server serves every channel on one port: reconnect to it, naming the new channel
+def switch_channel_on_port(fields):
+    global switching
+    global channel_name
+    channel_name = fields[0]
+    switching = True
+
+
+def switch_channel(fields):
     global switching
     global port_number
-    port_number = int(line.split()[1])
+    global server_host
+    if len(fields) == 2:
+        server_host = fields[0]
+    port_number = int(fields[-1])
     switching = True
 
 
+# Never overwrite an existing file, e.g. when the sender runs in the same directory
+def unused_path(name):
+    path = name
+    copy = 1
+    while os.path.exists(path):
+        path = f"{name}.{copy}"
+        copy += 1
+    return path
+
+
+def file_offer(fields):
+    transfer_id, size, sender = fields[:3]
+    name = " ".join(fields[3:])  # the text protocol splits names with spaces
+    path = unused_path(name)
+    receiving_files[transfer_id] = [open(path, "wb"), path, int(size), 0, 0]
+    stdout.write(f"[Server Message] Receiving \"{name}\" ({size} bytes) from {sender}.\n")
+    stdout.flush()
+
+
+# In the text protocol, the length of the chunk is given and the raw bytes follow.
+# A protocol v2 frame holds the whole chunk
+def file_data(fields, framer):
+    global receiving_id
+    transfer_id, chunk = fields
+    if isinstance(chunk, bytes):
+        store_chunk(transfer_id, chunk)
+        return
+    receiving_id = transfer_id
+    framer.expect_raw(int(chunk))
+    write_file_data(framer)
+
+
+# Chunks are written to disk as they arrive, so memory use does not depend on the size of the file
+def write_file_data(framer):
+    if receiving_id is None or not framer.raw_remaining:
+        return
+    store_chunk(receiving_id, framer.read_raw())
+
+
+def store_chunk(transfer_id, chunk):
+    receiving = receiving_files[transfer_id]
+    receiving[0].write(chunk)
+    receiving[3] += len(chunk)
+    progress = receiving[3] * 10 // receiving[2] * 10
+    if receiving[4] < progress < 100:
+        receiving[4] = progress
+        stdout.write(f"[Server Message] Receiving \"{receiving[1]}\": {progress}%\n")
+        stdout.flush()
+
+
+def file_end(fields):
+    file, path, size, _, _ = receiving_files.pop(fields[0])
+    file.close()
+    stdout.write(f"[Server Message] Received \"{path}\" ({size} bytes).\n")
+    stdout.flush()
+
+
+# The file is uploaded by this client, one chunk for each one the server grants with
+# "$FileReady: <upload_id> <count>". A count of 0 means the server refused or stopped the upload
+def file_ready(kind, fields, server_socket, framer):
+    upload_id, granted = fields[0], int(fields[1])
+    if upload_id not in sending_files:
+        return
+    file, size = sending_files[upload_id]
+    finished = granted == 0
+    for _ in range(granted):
+        chunk = file.read(FILE_CHUNK_SIZE)
+        if chunk:
+            send_chunk(server_socket, upload_id, chunk)
+        if not chunk or file.tell() >= size:
+            finished = True
+            break
+    if not finished:
+        return
+    del sending_files[upload_id]
+    file.close()
+    send_message(server_socket, FILE_END, upload_id)
+
+
+# In the text protocol, the line gives the length of the chunk and the raw bytes follow it
+def send_chunk(server_socket, upload_id, chunk):
+    if protocol_version == 2:
+        data = encode_message(2, FILE_DATA, upload_id, chunk)
+    else:
+        data = f"$FileData: {upload_id} {len(chunk)}\n".encode() + chunk
+    with send_lock:
+        server_socket.sendall(data)
+
+
 def handle_server(server_socket):
+    framer = LineFramer()
     with server_socket:
         try:
-            while message := server_socket.recv(BUFSIZE).decode():
-                while "\n" in message:
-                    newline_index = message.index("\n")
-                    data = message[:(newline_index+1)]
-                    message = message[(newline_index+1):]
-                    if data[:10] == "$UserError":
-                        username_error(data[:-1][12:])
-                        os._exit(2)
-                    elif data[:8] == "$UserDup":
-                        username_error(data[:-1][10:])
-                    elif data[:4] == "$01-" or data[:4] == "$02-":
-                        channel_connected(data[:-1], server_socket)
-                        server_connected.set()
-                    elif data == "$Kick\n":
-                        server_socket.sendall("$Quit-kicked\n".encode())
-                        removed(server_socket)
-                    elif data == "$Empty\n":
-                        # server_socket.sendall(data.encode())
-                        removed(server_socket)
-                    elif data == "$AFK\n":
-                        quit()
-                    elif data[:7] == "$Switch":
-                        switch_channel(data)
-                    elif data[0] != "$":
-                        stdout.write(data)
-                        stdout.flush()
+            while message := server_socket.recv(BUFSIZE):
+                framer.feed(message)
+                write_file_data(framer)
+                for data in framer.messages():
+                    kind, fields = data if isinstance(data, tuple) else parse_line(data)
+                    if kind in server_handlers:
+                        server_handlers[kind](kind, fields, server_socket, framer)
         except Exception:
             pass
 
 
+# Handlers of the messages from the server, for both protocols
+def user_error(kind, fields, server_socket, framer):
+    username_error(fields[0])
+    if kind == USER_ERROR:
+        os._exit(2)
+
+
+def joined(kind, fields, server_socket, framer):
+    global current_channel
+    global first_live_offset
+    channel_connected(kind, fields, server_socket)
+    server_connected.set()
+    if kind == JOIN_SUCCESS or kind == QUEUE_JOIN_SUCCESS:
+        current_channel = fields[0]
+        first_live_offset = None
+        if current_channel in last_offsets:  # back in a channel: ask for what was said meanwhile
+            send_message(server_socket, RESUME, last_offsets[current_channel])
+
+
+def kicked(kind, fields, server_socket, framer):
+    if kind == KICK:
+        send_message(server_socket, QUIT_KICKED)
+    removed(server_socket)
+
+
+def afk(kind, fields, server_socket, framer):
+    quit()
+
+
+def switch(kind, fields, server_socket, framer):
+    if kind == SWITCH_CHANNEL:
+        switch_channel_on_port(fields)
+    else:
+        switch_channel(fields)
+
+
+def file_transfer(kind, fields, server_socket, framer):
+    if kind == FILE:
+        file_offer(fields)
+    elif kind == FILE_DATA:
+        file_data(fields, framer)
+    else:
+        file_end(fields)
+
+
+def hello(kind, fields, server_socket, framer):
+    global protocol_version
+    if "v2" in fields:
+        protocol_version = 2
+
+
+def print_text(kind, fields, server_socket, framer):
+    stdout.write(fields[0] + "\n")
+    stdout.flush()
+
+
+# Channel messages of protocol v2 carry their offset in the server's log
+def channel_text(kind, fields, server_socket, framer):
+    global first_live_offset
+    if len(fields) == 2:
+        offset = int(fields[1])
+        if first_live_offset is None:
+            first_live_offset = offset
+        last_offsets[current_channel] = max(offset, last_offsets.get(current_channel, offset))
+    print_text(kind, fields, server_socket, framer)
+
+
+# Messages missed while away, the ones also received live since joining are skipped
+def catch_up(kind, fields, server_socket, framer):
+    offset = int(fields[1])
+    if first_live_offset is not None and offset >= first_live_offset:
+        return
+    last_offsets[current_channel] = max(offset, last_offsets.get(current_channel, offset))
+    print_text(kind, fields, server_socket, framer)
+
+
+server_handlers = {USER_ERROR: user_error, USER_DUP: user_error, JOIN_SUCCESS: joined, QUEUE_JOIN_SUCCESS: joined,
+                   IN_QUEUE: joined, QUEUE_MOVED: joined, KICK: kicked, EMPTY: kicked, AFK: afk,
+                   SWITCH_PORT: switch, SWITCH_CHANNEL: switch, FILE: file_transfer, FILE_DATA: file_transfer,
+                   FILE_END: file_transfer, FILE_READY: file_ready, HELLO: hello, TEXT: channel_text,
+                   CHAT: print_text, CATCH_UP: catch_up}
+
+
 def connect_server():
     global switching
     global stop_thread
     global current_server_socket
+    global protocol_version
 
     # Connect to server
     server_socket = socket(AF_INET, SOCK_STREAM)
     try:
-        server_socket.connect(('localhost', port_number))
+        server_socket.connect((server_host, port_number))
         # as soon as connections accepted, send server the username
         switching = False
+        protocol_version = 1
         user_msg = f"$User: {client_username}\n"
-        server_socket.send(user_msg.encode())
+        if channel_name is not None:
+            user_msg = f"$User: {client_username} {channel_name}\n"
+        # servers that know "$Hello:" move us to the new channel on this connection on /switch,
+        # and answer "$Hello: v2" if they can read protocol v2
+        server_socket.send((user_msg + "$Hello: switch v2\n").encode())
     except Exception:
         cant_connect(port_number)
 
@@ -0,0 +1,164 @@
+import struct
+
+MAX_LINE_LENGTH = 65536
+MAX_FRAME_LENGTH = 2 * MAX_LINE_LENGTH  # a frame can hold a whole chunk of a file
+
+# Protocol v2, negotiated with "$Hello: v2": a frame starts with a 0 byte, which never starts a
+# line of the text protocol, so both can be read from the same stream. It is followed by the
+# length of the fields, the message type, and the fields, each preceded by its length
+FRAME_HEADER = struct.Struct(">BIB")
+FIELD_LENGTH = struct.Struct(">I")
+
+# Message types shared by both protocols
+(USER, HELLO, LIST, SWITCH, SEND, WHISPER, CHAT, QUIT, QUIT_KICKED, JOINED,
+ TEXT, JOIN_SUCCESS, QUEUE_JOIN_SUCCESS, IN_QUEUE, QUEUE_MOVED, USER_ERROR, USER_DUP, KICK, EMPTY, AFK,
+ SWITCH_PORT, SWITCH_CHANNEL, FILE, FILE_DATA, FILE_END, HISTORY, RESUME, CATCH_UP, FILE_READY) = range(1, 30)
+
+# Text protocol form of each type, "{}" is replaced by the fields separated by spaces
+TEXT_FORMS = {
+    USER: "$User: {}", HELLO: "$Hello: {}", LIST: "$List {}", SWITCH: "/switch {}", SEND: "/send {}",
+    WHISPER: "/whisper {}", CHAT: "{}", QUIT: "$Quit", QUIT_KICKED: "$Quit-kicked", JOINED: "$Joined",
+    TEXT: "{}", JOIN_SUCCESS: "$01-JoinSuccess: {}", QUEUE_JOIN_SUCCESS: "$02-JoinSuccess: {}",
+    IN_QUEUE: "$01-InQueue: {}", QUEUE_MOVED: "$02-InQueue: {}", USER_ERROR: "$UserError: {}",
+    USER_DUP: "$UserDup: {}", KICK: "$Kick", EMPTY: "$Empty", AFK: "$AFK", SWITCH_PORT: "$Switch: {}",
+    SWITCH_CHANNEL: "$SwitchChannel: {}", FILE: "$File: {}", FILE_DATA: "$FileData: {}", FILE_END: "$FileEnd: {}",
+    HISTORY: "/history {}", RESUME: "$Resume: {}", CATCH_UP: "{}", FILE_READY: "$FileReady: {}",
+}
+# {first word of the line: type}, lines of any other first word are CHAT or TEXT
+TEXT_TYPES = {form.partition(" ")[0]: kind for kind, form in TEXT_FORMS.items() if form[0] in "$/"}
+BINARY_TYPES = {FILE_DATA}  # the last field is raw bytes, the others are text
+
+
+class LineTooLong(Exception):
+    pass
+
+
+class BadFrame(Exception):
+    pass
+
+
+def encode_frame(kind, *fields):
+    parts = []
+    for field in fields:
+        data = field if isinstance(field, bytes) else str(field).encode()
+        parts += [FIELD_LENGTH.pack(len(data)), data]
+    payload = b"".join(parts)
+    return FRAME_HEADER.pack(0, len(payload), kind) + payload
+
+
+def encode_message(version, kind, *fields):
+    if version == 2:
+        return encode_frame(kind, *fields)
+    form = TEXT_FORMS[kind] if fields else TEXT_FORMS[kind].replace(" {}", "")  # a "$List" without filters
+    text = form.format(" ".join(str(field) for field in fields))
+    return (text.replace("\n", " ") + "\n").encode()  # a v2 field may hold a newline
+
+
+# Type and fields of a line of the text protocol
+def parse_line(line):
+    word, _, rest = line[:-1].partition(" ")
+    kind = TEXT_TYPES.get(word)
+    if kind is not None:
+        return kind, rest.split(" ") if rest else []
+    if line[0] == "$" or line[0] == "/":
+        return None, []
+    return CHAT, [line[:-1]]
+
+
+# Splits a byte stream into lines. Received chunks are appended to one bytearray and
+# consumed with a sliding offset, so each byte is scanned once however many lines a
+# chunk holds. A line is only decoded once it is complete, which keeps multi-byte
+# UTF-8 characters split across two recv() calls intact, and a partial line at the
+# end of a chunk waits for the rest of it.
+class LineFramer:
+    def __init__(self, max_line_length=MAX_LINE_LENGTH):
+        self.buffer = bytearray()
+        self.start = 0  # first byte not consumed yet
+        self.scanned = 0  # no newline before this offset
+        self.max_line_length = max_line_length
+        self.raw_remaining = 0  # raw bytes to read with read_raw() before the next line
+
+    def feed(self, data):
+        if self.start == len(self.buffer):
+            self.buffer.clear()
+            self.start = self.scanned = 0
+        elif self.start > len(self.buffer) // 2:
+            # compact only when at least half the buffer is consumed, so the cost stays linear
+            del self.buffer[:self.start]
+            self.scanned -= self.start
+            self.start = 0
+        self.buffer += data
+
+    # Return the next complete line including its "\n", or None until more data is fed
+    def next_line(self):
+        if self.raw_remaining:
+            return None
+        end = self.buffer.find(b"\n", self.scanned)
+        if end < 0:
+            self.scanned = len(self.buffer)
+            if self.scanned - self.start > self.max_line_length:
+                raise LineTooLong()
+            return None
+        if end - self.start >= self.max_line_length:
+            raise LineTooLong()
+        with memoryview(self.buffer) as view:
+            line = str(view[self.start:end + 1], "utf-8", "replace")
+        self.start = self.scanned = end + 1
+        return line
+
+    # The next count bytes of the stream are not text, they are returned by read_raw()
+    def expect_raw(self, count):
+        self.raw_remaining = count
+
+    # Return as many of the expected raw bytes as have been received so far
+    def read_raw(self):
+        length = min(self.raw_remaining, len(self.buffer) - self.start)
+        data = bytes(self.buffer[self.start:self.start + length])
+        self.start = self.scanned = self.start + length
+        self.raw_remaining -= length
+        return data
+
+    # The bytes received and not consumed yet, a partial line or frame
+    def unread(self):
+        return bytes(self.buffer[self.start:])
+
+    def lines(self):
+        while (line := self.next_line()) is not None:
+            yield line
+
+    # Return the next line, or (type, fields) if the next message is a protocol v2 frame
+    def next_message(self):
+        if self.raw_remaining:
+            return None
+        if self.start < len(self.buffer) and self.buffer[self.start] == 0:
+            return self.next_frame()
+        return self.next_line()
+
+    def next_frame(self):
+        if len(self.buffer) - self.start < FRAME_HEADER.size:
+            return None
+        _, length, kind = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        if length > MAX_FRAME_LENGTH:
+            raise LineTooLong()
+        end = self.start + FRAME_HEADER.size + length
+        if len(self.buffer) < end:
+            return None
+        fields = []
+        offset = self.start + FRAME_HEADER.size
+        with memoryview(self.buffer) as view:
+            while offset < end:
+                if offset + FIELD_LENGTH.size > end:
+                    raise BadFrame()
+                (field_length,) = FIELD_LENGTH.unpack_from(self.buffer, offset)
+                offset += FIELD_LENGTH.size
+                if offset + field_length > end:
+                    raise BadFrame()
+                fields.append(bytes(view[offset:offset + field_length]))
+                offset += field_length
+        self.start = self.scanned = end
+        last = len(fields) - 1 if kind in BINARY_TYPES else len(fields)
+        return kind, [str(field, "utf-8", "replace") for field in fields[:last]] + fields[last:]
+
+    def messages(self):
+        while (message := self.next_message()) is not None:
+            yield message
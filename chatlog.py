@@ -0,0 +1,185 @@
+import mmap
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from threading import Condition, Lock, Thread
+from time import time
+
+SEGMENT_SIZE = 16 * 1024 * 1024  # a new segment file is started once the current one is this big
+INDEX_INTERVAL = 4096  # bytes of records between two entries of the sparse index
+RECORD_HEADER = struct.Struct(">IIQd")  # length and crc32 of the message, offset, timestamp
+INDEX_ENTRY = struct.Struct(">QdQ")  # offset, timestamp, position of the record in the segment
+
+
+# One file of records, named after the offset of its first record, and its sparse index:
+# an entry every INDEX_INTERVAL bytes, so a lookup reads at most that much past the entry
+class Segment:
+    def __init__(self, directory, base_offset):
+        path = os.path.join(directory, f"{base_offset:020d}")
+        self.base_offset = base_offset
+        self.next_offset = base_offset
+        self.file = open(path + ".log", "a+b")
+        self.index_file = open(path + ".index", "a+b")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.index_file.seek(0)
+        data = self.index_file.read()
+        self.index = [INDEX_ENTRY.unpack_from(data, position)
+                      for position in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size)]
+        self.indexed_position = self.index[-1][2] if self.index else None
+
+    # The last segment may end with a record cut by a crash: the records are checked one by one,
+    # the file is cut after the last complete one and its index is written again
+    def recover(self):
+        self.index = []
+        self.indexed_position = None
+        self.index_file.truncate(0)
+        position = 0
+        self.file.seek(0)
+        data = self.file.read()
+        while position + RECORD_HEADER.size <= len(data):
+            length, crc, offset, timestamp = RECORD_HEADER.unpack_from(data, position)
+            end = position + RECORD_HEADER.size + length
+            if end > len(data) or zlib.crc32(data[position + RECORD_HEADER.size:end]) != crc:
+                break
+            self.add_index_entry(offset, timestamp, position)
+            self.next_offset = offset + 1
+            position = end
+        self.file.truncate(position)
+        self.size = position
+        self.index_file.flush()
+
+    def add_index_entry(self, offset, timestamp, position):
+        if self.indexed_position is None or position - self.indexed_position >= INDEX_INTERVAL:
+            self.index.append((offset, timestamp, position))
+            self.index_file.write(INDEX_ENTRY.pack(offset, timestamp, position))
+            self.indexed_position = position
+
+    def write(self, records):
+        parts = []
+        for offset, timestamp, message in records:
+            self.add_index_entry(offset, timestamp, self.size)
+            parts += [RECORD_HEADER.pack(len(message), zlib.crc32(message), offset, timestamp), message]
+            self.size += RECORD_HEADER.size + len(message)
+            self.next_offset = offset + 1
+        self.file.write(b"".join(parts))
+        self.file.flush()
+        self.index_file.flush()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        os.fsync(self.index_file.fileno())
+
+    # Records from offset on, read through a memory map of the file
+    def read(self, offset, limit):
+        records = []
+        if self.size == 0 or limit <= 0:
+            return records
+        entry = bisect_right(self.index, (offset, float("inf"))) - 1
+        position = self.index[entry][2] if entry >= 0 else 0
+        with mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ) as view:
+            while position < self.size and len(records) < limit:
+                length, _, record_offset, timestamp = RECORD_HEADER.unpack_from(view, position)
+                start = position + RECORD_HEADER.size
+                if record_offset >= offset:
+                    records.append((record_offset, timestamp, view[start:start + length].decode()))
+                position = start + length
+        return records
+
+    # Offset of the first record written at or after timestamp, or None
+    def offset_at(self, timestamp):
+        entry = bisect_right([entry[1] for entry in self.index], timestamp) - 1
+        offset = self.index[entry][0] if entry >= 0 else self.base_offset
+        while records := self.read(offset, 64):
+            for record_offset, record_timestamp, _ in records:
+                if record_timestamp >= timestamp:
+                    return record_offset
+            offset = records[-1][0] + 1
+        return None
+
+    def close(self):
+        self.file.close()
+        self.index_file.close()
+
+
+# Append-only log of the messages of one channel, stored as segment files in its own directory.
+# append() only queues the record: a commit thread writes everything queued since its last
+# commit and syncs it with a single fsync(), so under load many messages share one fsync and
+# the caller never waits for the disk. A crash loses at most the records not committed yet
+class ChannelLog:
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log"))
+        self.directory = directory
+        self.segments = [Segment(directory, base) for base in bases] or [Segment(directory, 0)]
+        self.segments[-1].recover()
+        self.next_offset = self.segments[-1].next_offset
+        self.pending = []  # [(offset, timestamp, encoded message)] not written yet
+        self.condition = Condition()
+        self.write_lock = Lock()
+        Thread(target=self.commit_forever, daemon=True).start()
+
+    # Return the offset of the message in the log
+    def append(self, message):
+        with self.condition:
+            offset = self.next_offset
+            self.next_offset += 1
+            self.pending.append((offset, time(), message.encode()))
+            self.condition.notify()
+        return offset
+
+    def commit_forever(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+            self.commit()
+
+    def commit(self):
+        with self.write_lock:
+            self.write_pending()
+            self.segments[-1].sync()
+
+    # Also used by readers, written records can be read before they are synced
+    def write_pending(self):
+        with self.condition:
+            records, self.pending = self.pending, []
+        while records:
+            segment = self.segments[-1]
+            if segment.size >= SEGMENT_SIZE:
+                segment.sync()
+                segment = Segment(self.directory, records[0][0])
+                self.segments.append(segment)
+            count = 1
+            size = segment.size + RECORD_HEADER.size + len(records[0][2])
+            while count < len(records) and size < SEGMENT_SIZE:
+                size += RECORD_HEADER.size + len(records[count][2])
+                count += 1
+            segment.write(records[:count])
+            records = records[count:]
+
+    # Up to limit messages from offset on, as (offset, timestamp, message)
+    def read(self, offset, limit):
+        with self.write_lock:
+            self.write_pending()
+            first = max(0, bisect_right([segment.base_offset for segment in self.segments], offset) - 1)
+            records = []
+            for segment in self.segments[first:]:
+                records += segment.read(offset, limit - len(records))
+            return records
+
+    # Offset of the first message written at or after timestamp, or None
+    def offset_at(self, timestamp):
+        with self.write_lock:
+            self.write_pending()
+            starts = [segment.index[0][1] if segment.index else float("inf") for segment in self.segments]
+            first = max(0, bisect_right(starts, timestamp) - 1)
+            for segment in self.segments[first:]:
+                offset = segment.offset_at(timestamp)
+                if offset is not None:
+                    return offset
+            return None
+
+    def close(self):
+        self.commit()
+        for segment in self.segments:
+            segment.close()
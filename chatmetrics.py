@@ -0,0 +1,175 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from math import ceil
+from threading import Lock, Thread
+
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+QUANTILES = (0.5, 0.99, 0.999)
+counter_lock = Lock()  # guards the counters updated outside of any channel lock
+
+
+# Latency histogram in the style of HdrHistogram. Values are recorded in microseconds, in
+# buckets whose width doubles every SUB_BUCKETS buckets, so recording is a few integer
+# operations and a percentile is never off by more than 1/SUB_BUCKETS of its value
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (64 * SUB_BUCKETS)
+        self.count = 0
+        self.total = 0.0  # seconds
+        self.max = 0
+
+    def record(self, seconds):
+        value = int(seconds * 1e6)
+        if value < SUB_BUCKETS:
+            index = value
+        else:
+            shift = value.bit_length() - SUB_BUCKET_BITS - 1
+            index = ((shift + 1) << SUB_BUCKET_BITS) + (value >> shift) - SUB_BUCKETS
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, value)
+
+    # Highest value of the bucket holding the given fraction of the values, in seconds
+    def percentile(self, fraction):
+        rank = ceil(fraction * self.count)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if index < SUB_BUCKETS:
+                    return index / 1e6
+                shift = (index >> SUB_BUCKET_BITS) - 1
+                highest = (((index & (SUB_BUCKETS - 1)) + SUB_BUCKETS + 1) << shift) - 1
+                return min(highest, self.max) / 1e6
+        return 0.0
+
+    def merge(self, other):
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+
+# Counters of one channel, updated under the lock of the channel
+class ChannelStats:
+    def __init__(self):
+        self.members = 0  # gauges, set when the metrics are collected
+        self.queue = 0
+        self.messages = 0
+        self.bytes_sent = 0
+        self.fan_out = Histogram()  # time to hand a broadcast to every member
+        self.joins = 0
+        self.dequeues = 0
+        self.queue_wait = Histogram()  # time spent in the waiting queue
+        self.disconnects = {"left": 0, "kicked": 0, "afk": 0, "emptied": 0}
+        self.throttled = {"chat": 0, "whisper": 0, "list": 0, "switch": 0}  # messages over a rate limit
+        self.queued_at = {}  # {username: time they entered the waiting queue}
+
+    def __getstate__(self):  # sent to the coordinator in --workers mode
+        state = dict(self.__dict__)
+        state["queued_at"] = {}
+        return state
+
+
+class Metrics:
+    def __init__(self, channel_names):
+        self.connections = 0
+        self.open_connections = 0
+        self.bytes_received = 0
+        self.list_requests = 0
+        self.list_latency = Histogram()
+        self.channels = {name: ChannelStats() for name in channel_names}
+
+    def connection_opened(self):
+        with counter_lock:
+            self.connections += 1
+            self.open_connections += 1
+
+    def connection_closed(self):
+        with counter_lock:
+            self.open_connections -= 1
+
+    def received(self, length):
+        with counter_lock:
+            self.bytes_received += length
+
+    def listed(self, seconds):
+        with counter_lock:
+            self.list_requests += 1
+            self.list_latency.record(seconds)
+
+    def count_throttled(self, channel_name, kind):
+        with counter_lock:
+            self.channels[channel_name].throttled[kind] += 1
+
+    # Add the metrics of another process, whose channels are not in this one
+    def merge(self, other):
+        self.connections += other.connections
+        self.open_connections += other.open_connections
+        self.bytes_received += other.bytes_received
+        self.list_requests += other.list_requests
+        self.list_latency.merge(other.list_latency)
+        self.channels.update(other.channels)
+
+
+def render_histogram(lines, name, labels, histogram):
+    for quantile in QUANTILES:
+        lines.append(f"{name}{{{labels}quantile=\"{quantile}\"}} {histogram.percentile(quantile):.6f}")
+    lines.append(f"{name}_sum{{{labels.rstrip(',')}}} {histogram.total:.6f}")
+    lines.append(f"{name}_count{{{labels.rstrip(',')}}} {histogram.count}")
+
+
+# Prometheus text exposition format
+def render_prometheus(metrics):
+    lines = []
+    for name, kind, value in [("connections_total", "counter", metrics.connections),
+                              ("open_connections", "gauge", metrics.open_connections),
+                              ("received_bytes_total", "counter", metrics.bytes_received),
+                              ("list_requests_total", "counter", metrics.list_requests)]:
+        lines += [f"# TYPE chatserver_{name} {kind}", f"chatserver_{name} {value}"]
+    lines.append("# TYPE chatserver_list_seconds summary")
+    render_histogram(lines, "chatserver_list_seconds", "", metrics.list_latency)
+    channels = sorted(metrics.channels.items())
+    for name, kind, attribute in [("members", "gauge", "members"), ("queue_length", "gauge", "queue"),
+                                  ("messages_total", "counter", "messages"),
+                                  ("sent_bytes_total", "counter", "bytes_sent"),
+                                  ("joins_total", "counter", "joins"), ("dequeues_total", "counter", "dequeues")]:
+        lines.append(f"# TYPE chatserver_channel_{name} {kind}")
+        for channel_name, stats in channels:
+            lines.append(f"chatserver_channel_{name}{{channel=\"{channel_name}\"}} {getattr(stats, attribute)}")
+    lines.append("# TYPE chatserver_channel_disconnects_total counter")
+    for channel_name, stats in channels:
+        for reason, count in stats.disconnects.items():
+            lines.append(f"chatserver_channel_disconnects_total{{channel=\"{channel_name}\",reason=\"{reason}\"}} {count}")
+    lines.append("# TYPE chatserver_channel_throttled_total counter")
+    for channel_name, stats in channels:
+        for kind, count in stats.throttled.items():
+            lines.append(f"chatserver_channel_throttled_total{{channel=\"{channel_name}\",kind=\"{kind}\"}} {count}")
+    for name, attribute in [("fan_out_seconds", "fan_out"), ("queue_wait_seconds", "queue_wait")]:
+        lines.append(f"# TYPE chatserver_channel_{name} summary")
+        for channel_name, stats in channels:
+            render_histogram(lines, f"chatserver_channel_{name}", f"channel=\"{channel_name}\",",
+                             getattr(stats, attribute))
+    return "\n".join(lines) + "\n"
+
+
+# Serve GET /metrics on the loopback interface, collect() returns the Metrics to render
+def start_http_server(port, collect):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = render_prometheus(collect()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # the server's output is for chat events only
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
@@ -1,24 +1,115 @@
 from sys import argv, stderr, stdout, stdin, exit
 from socket import *
-from threading import Event, Thread, Lock, current_thread
-from time import sleep
+from threading import Condition, Event, Thread, Lock, RLock, current_thread
+from time import sleep, monotonic, perf_counter, time
+from math import ceil
+from collections import deque
+from enum import Enum
+from itertools import count
+import asyncio
+import json
+import multiprocessing
 import os
+import select
+import selectors
+import signal
+import struct
+from chatframing import (LineFramer, encode_frame, encode_message, parse_line, USER, HELLO,
+                         LIST, SWITCH, SEND, WHISPER, CHAT, QUIT, QUIT_KICKED, TEXT, JOIN_SUCCESS,
+                         QUEUE_JOIN_SUCCESS, IN_QUEUE, QUEUE_MOVED, USER_ERROR, USER_DUP, KICK, EMPTY,
+                         AFK, SWITCH_PORT, SWITCH_CHANNEL, FILE, FILE_DATA, FILE_END, HISTORY, RESUME,
+                         CATCH_UP, FILE_READY, TEXT_FORMS, LineTooLong)
+from chatlog import ChannelLog
+from chatmetrics import ChannelStats, Metrics, start_http_server, QUANTILES
+from chattrace import Tracer, TracedLock
 
 cant_listen_detected = False
-lock = Lock()
-disconnect_client_lock = Lock()
+channel_locks = {}  # {channel_name: Lock}, each channel is processed independently of the others, see new_channel_lock()
 create_all_ports = Event()
-remaining_ports = -1
 BUFSIZE = 1024
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024  # buffers per sendmsg() call
+FILE_CHUNK_SIZE = 65536  # chat messages can be sent between two chunks of a file
+UPLOAD_WINDOW = 4  # chunks of a file relayed to its receiver at a time, see Upload
+QUEUE_UPDATE_INTERVAL = 0.05  # seconds between two queue position updates of a channel
+TIMER_TICK = 0.05  # resolution of the timer wheel in seconds
+TIMER_SLOTS = 1024
+RESUME_LIMIT = 1000  # messages sent at most for one "$Resume:"
+SWITCH_RESERVATION = 5  # seconds a name stays reserved in the channel a client switches to, until it reconnects
+OUTPUT_BATCH_BYTES = 65536  # server output is written once this much is waiting...
+OUTPUT_FLUSH_INTERVAL = 0.02  # ...or once the first waiting line is this old, in seconds
+RATE_LIMIT_MAX_DELAY = 5  # seconds a message may be delayed by a rate limit, it is dropped beyond
+RATE_LIMITED_TYPES = {CHAT: "chat", WHISPER: "whisper", LIST: "list", SWITCH: "switch"}
+RATE_LIMIT_NOUNS = {CHAT: "messages", WHISPER: "whispers", LIST: "list requests", SWITCH: "switch requests"}
+HANDOFF_DRAIN_TIMEOUT = 2  # seconds for the output of the clients to be sent before a handoff, late clients are dropped
+HANDOFF_TIMEOUT = 10  # seconds a server waits for the other one during a handoff
+HANDOFF_FDS_PER_MESSAGE = 250  # SCM_RIGHTS carries at most 253 descriptors in one message
+HANDOFF_HEADER = struct.Struct(">II")  # length of the JSON state, number of descriptors sent after it
+LIST_PAGE_SIZE = 50  # channels in each page of "/list page=<number>"
+DIRECTORY_PUSH_INTERVAL = 0.1  # seconds between two pushes of channel changes to the subscribers of /list
+LIST_USAGE = "[Server Message] Usage: /list [prefix=name_prefix] [free] [page=number] [subscribe|unsubscribe]"
+TRACE_SAMPLE_INTERVAL = 0.02  # seconds between two samples of the stacks of every thread while tracing
+TRACE_TOP = 10  # locks and handlers in the /trace report
+# {message type: name in the /trace report}, the first word of its text form
+MESSAGE_NAMES = {kind: form.partition(" ")[0].rstrip(":") if form[0] in "$/" else "chat"
+                 for kind, form in TEXT_FORMS.items()}
+USER_COMMAND_WORDS = {"kick": 2, "mute": 3}  # words of the admin commands naming a user without a channel
+transfer_ids = count(1)
+upload_lock = Lock()  # guards the uploads of every session, whose sender and receiver are served by different threads
 afk_time = 100
 config_filename = None
-channel_names = []
-channel_port = []
-channel_capacity = []
-listening_channel_sockets = None
-client_info = {}  # {channel_name: {client_username: [client_socket, in-channel/in-queue/disconnected}}
-channel_users = {}  # {channel_name: [[user_1, user_2], [user_1_in_queue, user_2_in_queue]]}
-client_address_users = {}  # {client_address: [client_username, channel_name]}
+channel_names = []  # in the order of the configuration file
+channel_indexes = {}  # {channel_name: position in channel_names}
+listening_channel_sockets = {}  # {channel_name: listening socket} of the channels served here
+event_loop = None  # only set when the server runs in --async mode
+channel_servers = {}  # {channel_name: asyncio Server}, in --async mode, None for the shared port of --port mode
+reload_lock = Lock()  # /reload from stdin and from SIGHUP may overlap
+global_lock = RLock()  # the lock of every channel with --global-lock, see new_channel_lock()
+server_options = {"async": False, "outbound-queue": "1024", "slow-consumer": "kick", "block-timeout": "10",
+                  "workers": "1", "node": "", "port": "", "history": "100", "history-bytes": "65536",
+                  "replay": "0", "log-dir": "", "output-format": "text", "output-queue": "65536",
+                  "output-overflow": "block", "metrics": False, "metrics-port": "",
+                  "handoff": "", "global-lock": False}
+slow_consumer_policies = ["drop", "kick", "block"]
+output_formats = ["text", "json"]
+output_overflow_policies = ["drop", "block"]
+rate_limit_scopes = ["client", "channel"]
+rate_limit_policies = ["delay", "drop", "notify"]
+channels = {}  # {channel_name: Channel}
+channel_history = {}  # {channel_name: MessageHistory}
+user_sessions = {}  # {username: {channel_name: Session}} of the users of every channel served here
+user_lock = Lock()  # guards user_sessions, taken after the channel locks
+channel_logs = {}  # {channel_name: ChannelLog} of the channels served here, with --log-dir
+# Rate limits of the "limit" lines of the configuration file, empty when there are none
+rate_limits = {}  # {channel_name: {message type: [(scope, type, rate, burst, policy)]}}
+channel_buckets = {}  # {(channel_name, message type): TokenBucket} of the limits of channel scope
+bucket_lock = Lock()  # guards channel_buckets, they are taken from before any channel lock
+queue_updates_scheduled = set()  # channels whose waiting users will be told their new position
+metrics = None  # Metrics of the channels served by this process, only with --metrics
+tracer = None  # Tracer while /trace is on
+# --workers mode: channels are shared out between worker processes, coordinated by the main process
+owned_channels = None  # channels served by this worker, None when a single process serves them all
+coordinator_connection = None  # worker side of the pipe to the coordinator
+coordinator_send_lock = Lock()
+coordinator_requests = {}  # {request_id: [Event, reply]}
+request_ids = count(1)
+remote_channels = {}  # {channel_name: [current_capacity, in_queue]} of the channels of other workers
+worker_connections = []  # coordinator side of the pipe to each worker
+worker_send_locks = []
+directory_lock = Lock()
+directory = {}  # coordinator view of every channel: {channel_name: [current_capacity, in_queue, {usernames}]}
+directory_users = {}  # {username: {channel_names}}, the same view indexed by user
+# --node cluster mode: several servers share one configuration, each channel is served by one node
+cluster_nodes = {}  # {node_id: [host, relay_port]}
+channel_owner = []  # node_id given on each channel line, or None
+remote_users = {}  # {channel_name: {usernames}} of the channels served by other nodes
+peer_queues = {}  # {node_id: [Condition, deque of encoded relay messages]}
+RELAY_RETRY_MAX = 5  # seconds between two attempts to reach a node that is down
+# --port mode: every channel is served on one port, the channel is named in the "$User:" line
+single_port_socket = None
+# --handoff mode: a new server process takes over the listening sockets and the clients of this one
+open_sessions = None  # every Session of this process, only kept with --handoff
+handoff_gate = None  # HandoffGate of the threaded server
+taken_over = 0  # connections handed off by the previous process
 
 
 def invalid_command_line():
@@ -35,193 +126,842 @@ def is_whitespace(command):
     return len(command.strip()) == 0
 
 
+# Options look like --name or --name=value and may appear anywhere on the command line
+def process_options(options):
+    for option in options:
+        name, has_value, value = option[2:].partition("=")
+        if name not in server_options:
+            invalid_command_line()
+        if isinstance(server_options[name], bool):
+            if has_value:
+                invalid_command_line()
+            server_options[name] = True
+        else:
+            if not has_value or is_whitespace(value):
+                invalid_command_line()
+            server_options[name] = value
+
+
 def process_command_line():
     global afk_time
     global config_filename
-    if len(argv) != 2 and len(argv) != 3:
+    args = [arg for arg in argv[1:] if not arg.startswith("--")]
+    process_options([arg for arg in argv[1:] if arg.startswith("--")])
+    if len(args) != 1 and len(args) != 2:
         invalid_command_line()
-    if len(argv) == 3:
-        if not argv[1].isdigit():
+    if len(args) == 2:
+        if not args[0].isdigit():
             invalid_command_line()
-        if int(argv[1]) < 1 or int(argv[1]) > 1000:
+        if int(args[0]) < 1 or int(args[0]) > 1000:
             invalid_command_line()
-        afk_time = int(argv[1])
-        config_filename = argv[2]
+        afk_time = int(args[0])
+        config_filename = args[1]
     else:
-        config_filename = argv[1]
+        config_filename = args[0]
+    if not server_options["outbound-queue"].isdigit() or int(server_options["outbound-queue"]) < 1:
+        invalid_command_line()
+    if server_options["slow-consumer"] not in slow_consumer_policies:
+        invalid_command_line()
+    if not server_options["block-timeout"].isdigit():
+        invalid_command_line()
+    if not server_options["workers"].isdigit() or int(server_options["workers"]) < 1:
+        invalid_command_line()
+    if server_options["node"] and int(server_options["workers"]) > 1:
+        invalid_command_line()
+    for name in ("history", "history-bytes"):
+        if not server_options[name].isdigit() or int(server_options[name]) < 1:
+            invalid_command_line()
+    if not server_options["replay"].isdigit():
+        invalid_command_line()
+    if server_options["output-format"] not in output_formats:
+        invalid_command_line()
+    if not server_options["output-queue"].isdigit() or int(server_options["output-queue"]) < 1:
+        invalid_command_line()
+    if server_options["output-overflow"] not in output_overflow_policies:
+        invalid_command_line()
+    if server_options["port"]:
+        port = server_options["port"]
+        if not port.isdigit() or int(port) < 1024 or int(port) > 65535:
+            invalid_command_line()
+        if server_options["node"] or int(server_options["workers"]) > 1:
+            invalid_command_line()
+    if server_options["metrics-port"]:
+        port = server_options["metrics-port"]
+        if not port.isdigit() or int(port) < 1024 or int(port) > 65535:
+            invalid_command_line()
+        server_options["metrics"] = True
+    if server_options["handoff"] and (server_options["node"] or int(server_options["workers"]) > 1):
+        invalid_command_line()
     if is_whitespace(config_filename):
         invalid_command_line()
 
 
+# Server output goes through a bounded queue drained by its own thread, so a slow terminal or
+# pipe never holds a channel lock. Lines are written in batches, once OUTPUT_BATCH_BYTES are
+# waiting or the first of them is OUTPUT_FLUSH_INTERVAL old. When --output-queue lines are
+# waiting, a new line waits for room or, with --output-overflow=drop, is dropped
+class OutputWriter:
+    def __init__(self):
+        self.pid = None
+
+    # Threads do not survive a fork, each --workers process starts its own writer
+    def start(self):
+        self.pid = os.getpid()
+        self.lines = []
+        self.size = 0
+        self.dropped = 0
+        self.condition = Condition()
+        self.write_lock = Lock()  # held while a batch is taken and written, so batches stay in order
+        Thread(target=self.write_forever, daemon=True).start()
+
+    def write(self, line):
+        if server_options["output-format"] == "json":
+            line = json.dumps({"time": time(), "message": line[:-1]}) + "\n"
+        with self.condition:
+            if len(self.lines) >= int(server_options["output-queue"]):
+                if server_options["output-overflow"] == "drop":
+                    self.dropped += 1
+                    return
+                self.condition.wait_for(lambda: len(self.lines) < int(server_options["output-queue"]))
+            self.lines.append(line)
+            self.size += len(line)
+            self.condition.notify_all()
+
+    def write_forever(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.lines)
+            with self.write_lock:
+                with self.condition:
+                    deadline = monotonic() + OUTPUT_FLUSH_INTERVAL
+                    while self.size < OUTPUT_BATCH_BYTES and (remaining := deadline - monotonic()) > 0:
+                        self.condition.wait(remaining)
+                self.write_batch()
+
+    def write_batch(self):
+        with self.condition:
+            batch = self.lines
+            self.lines = []
+            self.size = 0
+            self.condition.notify_all()
+        if batch:
+            stdout.write("".join(batch))
+            stdout.flush()
+
+    # Before the process exits
+    def flush(self):
+        if self.pid == os.getpid():
+            with self.write_lock:
+                self.write_batch()
+
+
+def write_output(line):
+    output_writer.write(line)
+
+
+output_writer = OutputWriter()
+
+
+class InvalidConfiguration(Exception):
+    pass
+
+
+# Everything read from the configuration file. Names and ports are indexed as they are read,
+# so a line is checked in constant time however many channels come before it
+class Configuration:
+    def __init__(self):
+        self.names = []
+        self.ports = []
+        self.capacities = []
+        self.owners = []  # node_id given on each channel line, or None
+        self.indexes = {}  # {channel_name: index}
+        self.used_ports = set()
+        self.nodes = {}  # {node_id: [host, relay_port]}
+        self.limit_lines = []  # [scope, kind, rate, burst, policy, channel_name or None] as read from the file
+        self.rate_limits = {}
+        self.channel_buckets = {}
+
+
 def check_channel_name(name):
     for letter in name:
         if not (letter.isalpha() or letter.isdigit() or letter == "_"):
-            invalid_file()
+            raise InvalidConfiguration()
 
 
-def check_file_format(line):
-    global channel_names
-    global channel_port
-    global channel_capacity
-    if len(line) != 4 or line[0] != "channel":
-        invalid_file()
+# node <node_id> <host> <relay_port>, only valid in --node cluster mode
+def check_node_format(line, config):
+    check_channel_name(line[1])
+    if line[1] in config.nodes or not line[3].isdigit() or int(line[3]) < 1024 or int(line[3]) > 65535:
+        raise InvalidConfiguration()
+    config.nodes[line[1]] = [line[2], int(line[3])]
+
+
+# limit <client|channel> <chat|whisper|list|switch> <rate> <burst> <delay|drop|notify> [channel_name]
+# A limit of client scope applies to each connection, one of channel scope to everyone in the
+# channel together. A limit naming a channel replaces the limit of the same scope and kind there
+def check_limit_format(line, config):
+    if (len(line) not in (6, 7) or line[1] not in rate_limit_scopes or line[2] not in RATE_LIMITED_TYPES.values()
+            or not line[4].isdigit() or int(line[4]) < 1 or line[5] not in rate_limit_policies):
+        raise InvalidConfiguration()
+    try:
+        rate = float(line[3])
+    except ValueError:
+        raise InvalidConfiguration()
+    if not 0 < rate < float("inf"):
+        raise InvalidConfiguration()
+    config.limit_lines.append([line[1], line[2], rate, int(line[4]), line[5], line[6] if len(line) == 7 else None])
+
+
+def check_file_format(line, config):
+    if line and line[0] == "limit":
+        check_limit_format(line, config)
+        return
+    if server_options["node"] and len(line) == 4 and line[0] == "node":
+        check_node_format(line, config)
+        return
+    # in cluster mode, a channel line may end with the node serving the channel
+    if server_options["node"] and len(line) == 5 and line[0] == "channel":
+        owner = line.pop()
+    elif len(line) != 4 or line[0] != "channel":
+        raise InvalidConfiguration()
+    else:
+        owner = None
     check_channel_name(line[1])
     if not (line[2].isdigit() and line[3].isdigit()):
-        invalid_file()
+        raise InvalidConfiguration()
     port, capacity = int(line[2]), int(line[3])
     if (port < 1024 or port > 65535 or capacity < 1 or capacity > 8 or
-            line[1] in channel_names or port in channel_port):
-        invalid_file()
-    channel_names.append(line[1])
-    channel_port.append(port)
-    channel_capacity.append(capacity)
+            line[1] in config.indexes or port in config.used_ports):
+        raise InvalidConfiguration()
+    config.indexes[line[1]] = len(config.names)
+    config.used_ports.add(port)
+    config.names.append(line[1])
+    config.ports.append(port)
+    config.capacities.append(capacity)
+    config.owners.append(owner)
+
+
+# Read and check the whole file, raise InvalidConfiguration if anything is wrong with it
+def read_configuration():
+    config = Configuration()
+    try:
+        with open(config_filename, 'r') as config_file:
+            lines = config_file.readlines()
+    except Exception:
+        raise InvalidConfiguration()
+    if not lines:
+        raise InvalidConfiguration()
+    for line in lines:
+        check_file_format(line.strip().split(), config)
+    if server_options["node"]:
+        check_cluster_configuration(config)
+    build_rate_limits(config)
+    return config
 
 
 def check_valid_file():
+    global channel_names
+    global channel_indexes
+    global channel_owner
+    global owned_channels
+    global rate_limits
+    global channel_buckets
     try:
-        config_file = open(config_filename, 'r')
-    except Exception:
-        # print(e)  # only for testing
+        config = read_configuration()
+    except InvalidConfiguration:
         invalid_file()
-    if not config_file.readline():
-        invalid_file()
-    config_file.seek(0)
-    for line in config_file:
-        check_file_format(line.strip().split())
-
-
-def listen_to_channel_sockets(port_num, index):
-    global cant_listen_detected
+    channel_names, channel_indexes, channel_owner = config.names, config.indexes, config.owners
+    cluster_nodes.update(config.nodes)
+    if server_options["node"]:
+        owned_channels = {name for index, name in enumerate(channel_names)
+                          if channel_owner[index] == server_options["node"]}
+    rate_limits, channel_buckets = config.rate_limits, config.channel_buckets
+    return config
+
+
+def build_rate_limits(config):
+    limits = {}  # {(channel_name or None, scope, kind): limit}
+    for scope, kind, rate, burst, policy, channel_name in config.limit_lines:
+        if (channel_name is not None and channel_name not in config.indexes) or (channel_name, scope, kind) in limits:
+            raise InvalidConfiguration()
+        limits[(channel_name, scope, kind)] = (scope, kind, rate, burst, policy)
+    if not limits:
+        return
+    for channel_name in config.names:
+        config.rate_limits[channel_name] = {}
+        for kind, kind_name in RATE_LIMITED_TYPES.items():
+            for scope in rate_limit_scopes:
+                limit = limits.get((channel_name, scope, kind_name)) or limits.get((None, scope, kind_name))
+                if limit is None:
+                    continue
+                config.rate_limits[channel_name].setdefault(kind, []).append(limit)
+                if scope == "channel":
+                    config.channel_buckets[(channel_name, kind)] = TokenBucket(limit[2], limit[3])
+
+
+# Channels without a node on their line are shared out between the nodes in the order of the file
+def check_cluster_configuration(config):
+    nodes = list(config.nodes)
+    if server_options["node"] not in config.nodes:
+        raise InvalidConfiguration()
+    for index, owner in enumerate(config.owners):
+        if owner is None:
+            config.owners[index] = nodes[index % len(nodes)]
+        elif owner not in config.nodes:
+            raise InvalidConfiguration()
+
+
+# Return a socket listening on the port, or None if the port cannot be used
+def open_listening_socket(port_num):
     listening_socket = socket(AF_INET, SOCK_STREAM)
     # set socket option to allow the reuse of address
     listening_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     try:
         listening_socket.bind(('', port_num))
     except Exception:
+        listening_socket.close()
+        return None
+    listening_socket.listen(5)
+    return listening_socket
+
+
+def listen_to_channel_sockets(channel_name):
+    global cant_listen_detected
+    port_num = channels[channel_name].port
+    listening_socket = open_listening_socket(port_num)
+    if listening_socket is None:
         print(f"Error: unable to listen on port {port_num}.", file=stderr)
         cant_listen_detected = True
-    listening_socket.listen(5)
-    listening_channel_sockets[index] = listening_socket
+        return
+    listening_channel_sockets[channel_name] = listening_socket
 
 
-def start_server(port_num, index):
-    global remaining_ports
-    name = channel_names[index]
-    capacity = channel_capacity[index]
-    listening_socket = listening_channel_sockets[index]
-    stdout.write(f"Channel \"{name}\" is created on port {port_num}, with a capacity of {capacity}.\n")
-    stdout.flush()
-    remaining_ports -= 1  # tell program 1 port has been created
-    create_all_ports.wait()  # wait until all ports are created to continue
-    process_connections(listening_socket, index)  # generate threads per client
+def print_channel_banner(channel_name):
+    channel = channels[channel_name]
+    port_num = server_options["port"] or channel.port
+    write_output(f"Channel \"{channel_name}\" is created on port {port_num}, with a capacity of {channel.capacity}.\n")
 
 
-def process_connections(listening_socket, index):
-    while True:
-        client_socket, client_address = listening_socket.accept()
-        client_thread = Thread(target=handle_client, 
-                            args=(client_socket, client_address, index))
-        client_thread.start()
+# One listening socket with a large backlog for every channel, so the number of ports,
+# accept queues and threads does not grow with the number of channels
+def listen_to_single_port():
+    global single_port_socket
+    port_num = int(server_options["port"])
+    single_port_socket = socket(AF_INET, SOCK_STREAM)
+    single_port_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    try:
+        single_port_socket.bind(('', port_num))
+    except Exception:
+        print(f"Error: unable to listen on port {port_num}.", file=stderr)
+        os._exit(6)
+    single_port_socket.listen(SOMAXCONN)
+
+
+# Threaded server: one thread accepts the connections of every channel, waiting on all the
+# listening sockets with a selector, then each client gets its own thread. Sockets are only
+# registered and closed by that thread, other threads queue the change and wake it up
+class Acceptor:
+    def start(self):
+        self.selector = selectors.DefaultSelector()
+        self.changes = deque()  # (listening_socket, channel_name) to add, (listening_socket, None) to close
+        self.wakeup_receiver, self.wakeup_sender = socketpair()
+        self.wakeup_sender.setblocking(False)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ)
+        Thread(target=self.run, daemon=True).start()
+
+    # channel_name is None for the shared port of --port mode
+    def add(self, listening_socket, channel_name):
+        self.changes.append((listening_socket, channel_name, True))
+        self.wake_up()
+
+    def remove(self, listening_socket):
+        self.changes.append((listening_socket, None, False))
+        self.wake_up()
+
+    def wake_up(self):
+        try:
+            self.wakeup_sender.send(b"\0")
+        except BlockingIOError:
+            pass  # a wake up is already waiting
+
+    def run(self):
+        create_all_ports.wait()  # wait until all ports are created to continue
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.wakeup_receiver:
+                    self.apply_changes()
+                    continue
+                if handoff_gate is not None:
+                    handoff_gate.enter()  # left by handle_client() once the session is known
+                try:
+                    client_socket, client_address = key.fileobj.accept()
+                except OSError:
+                    if handoff_gate is not None:
+                        handoff_gate.leave()
+                    continue
+                Thread(target=handle_client, args=(client_socket, client_address, key.data)).start()
+
+    def apply_changes(self):
+        self.wakeup_receiver.recv(4096)
+        while self.changes:
+            listening_socket, channel_name, add = self.changes.popleft()
+            if add:
+                self.selector.register(listening_socket, selectors.EVENT_READ, channel_name)
+            else:
+                self.selector.unregister(listening_socket)
+                listening_socket.close()
+
+
+acceptor = Acceptor()
+
+
+# Start accepting the connections of a channel, on the event loop in --async mode
+def serve_channel(channel_name):
+    listening_socket = listening_channel_sockets[channel_name]
+    if event_loop is None:
+        acceptor.add(listening_socket, channel_name)
+    else:
+        event_loop.create_task(start_channel_server(channel_name, listening_socket))
+
+
+async def start_channel_server(channel_name, listening_socket):
+    channel_servers[channel_name] = await event_loop.create_server(lambda: ChannelProtocol(channel_name),
+                                                                   sock=listening_socket)
+
+
+# One after the other in a single task, much cheaper than a task or a run of the loop for each
+async def start_channel_servers(names):
+    for name in names:
+        await start_channel_server(name, listening_channel_sockets[name])
+
+
+def stop_serving(channel_name):
+    listening_socket = listening_channel_sockets.pop(channel_name)
+    if event_loop is None:
+        acceptor.remove(listening_socket)
+        return
+    server = channel_servers.pop(channel_name, None)
+    if server is not None:
+        server.close()
+    listening_socket.close()
+
 
+# Sessions restored by a handoff may not know their address
+def client_host(client):
+    return client.address[0] if client.address else None
 
-def duplicate_usernames(username, channel_name):
-    if any(username in queue for queue in channel_users[channel_name]):
+
+# A name reserved for a client switching in is taken for everyone else until it expires. The
+# reconnection of that client comes from the same host, the protocol carries nothing else to
+# recognise it, see check_switch_command(). Checks made without a host never match a reservation
+def duplicate_usernames(username, channel_name, host=None):
+    channel = channels[channel_name]
+    if username in channel.sessions:
         return True
-    return False
+    reservation = channel.reserved.get(username)
+    if reservation is None:
+        return False
+    if reservation[1] < monotonic():
+        del channel.reserved[username]
+        return False
+    return host is None or reservation[0] not in (None, host)
+
+
+# Server-wide index of the users, kept next to Channel.sessions under the channel lock: a user is
+# added when they join or wait for a channel, and removed when they leave, switch or are emptied.
+# A name is unique in each channel, not across them, so it maps to a session for each channel
+def index_user(client):
+    with user_lock:
+        user_sessions.setdefault(client.username, {})[client.channel_name] = client
+
+
+def unindex_user(username, channel_name):
+    with user_lock:
+        sessions = user_sessions.get(username)
+        if sessions is not None:
+            sessions.pop(channel_name, None)
+            if not sessions:
+                del user_sessions[username]
+
+
+# Members of any channel with this name, muted or not, waiting users excepted
+def find_members(username):
+    with user_lock:
+        sessions = list(user_sessions.get(username, {}).values())
+    return [session for session in sessions if session.state is State.IN_CHANNEL or session.state is State.MUTED]
+
+
+def find_member(channel_name, username):
+    with user_lock:
+        session = user_sessions.get(username, {}).get(channel_name)
+    if session is not None and (session.state is State.IN_CHANNEL or session.state is State.MUTED):
+        return session
+    return None
 
 
 # Print to server, send message to client for them to print
 def client_join_room(client_username, channel_name, client_socket, code):
-    stdout.write(f"[Server Message] {client_username} has joined the channel \"{channel_name}\".\n")
-    stdout.flush()
-    message = f"$0{code}-JoinSuccess: {channel_name}\n"
-    client_socket.sendall(message.encode())
+    write_output(f"[Server Message] {client_username} has joined the channel \"{channel_name}\".\n")
+    send_message(client_socket, JOIN_SUCCESS if code == 1 else QUEUE_JOIN_SUCCESS, channel_name)
+    replay_history(channel_name, client_socket, int(server_options["replay"]))
 
 
 def notify_users_ahead(num_users_ahead, client_socket, code):
-    message = f"$0{code}-InQueue: {num_users_ahead}\n"
-    client_socket.sendall(message.encode())
+    send_message(client_socket, IN_QUEUE if code == 1 else QUEUE_MOVED, num_users_ahead)
 
 
 # When first accepting client's connection, check for username duplicates, channel capacity,
 # queue capacity and return a message that will be sent to client
-def client_first_connection(client_username, index, client_address, client_socket):
-    global channel_users
-    global client_address_users
-    channel_name = channel_names[index]
+def client_first_connection(client):
+    client_username, channel_name, client_socket = client.username, client.channel_name, client.socket
+    channel = channels[channel_name]
     # Name duplicates
-    if duplicate_usernames(client_username, channel_name):
-        client_socket.sendall(f"$UserError: {channel_name}\n".encode())
+    if duplicate_usernames(client_username, channel_name, client_host(client)):
+        send_message(client_socket, USER_ERROR, channel_name)
         return False
-    # If not error, client info will be stored
-    client_address_users[client_address] = [client_username, channel_name]
-    capacity = channel_capacity[index]
+    channel.reserved.pop(client_username, None)
+    capacity = channel.capacity
     # Enough capacity to join successfully
-    if len(channel_users[channel_name][0]) < capacity:
+    if len(channel.members) < capacity:
         client_join_room(client_username, channel_name, client_socket, code=1)
-        channel_users[channel_name][0].append(client_username)
-        client_info[channel_name][client_username] = [client_socket, "in-channel"]
+        channel.members[client_username] = client
+        client.state = State.IN_CHANNEL
     # Wait in queue with X users ahead
     else:
-        num_users_ahead = len(channel_users[channel_name][1])
-        channel_users[channel_name][1].append(client_username)
-        client_info[channel_name][client_username] = [client_socket, "in-queue"]
+        num_users_ahead = len(channel.queue)
+        channel.queue.append(client_username)
+        channel.queue.notified[client_username] = num_users_ahead
+        client.state = State.IN_QUEUE
         notify_users_ahead(num_users_ahead, client_socket, code=1)
+        if metrics is not None:
+            metrics.channels[channel_name].queued_at[client_username] = monotonic()
+    channel.sessions[client_username] = client
+    index_user(client)
+    if metrics is not None:
+        metrics.channels[channel_name].joins += 1
+    publish_channel(channel_name, joined=[client_username])
     return True
 
 
+# Only queues the message for each member, slow members are handled by their own writer.
+# The message is encoded once and the same bytes object is shared by every member
 def notify_channel(channel_name, message, kick=False, username=""):
-    try:
-        if not kick:
-            stdout.write(message)
-            stdout.flush()
-        for other_client_name in channel_users[channel_name][0]:
-            if other_client_name == username:
-                continue
-            client_socket = client_info[channel_name][other_client_name][0]
-            client_socket.sendall(message.encode())
-    except:
-        # print("Error while handling notifying channels", file=stdout)
-        pass
+    if not kick:
+        write_output(message)
+    active_tracer = tracer
+    if metrics is not None or active_tracer is not None:
+        started = perf_counter()
+    offset = channel_logs[channel_name].append(message) if channel_logs else None
+    encoded_messages = {}  # {protocol version: encoded message}
+    members = channels[channel_name].members
+    for other_client_name, session in members.items():
+        if other_client_name == username:
+            continue
+        client_socket = session.socket
+        if client_socket.version not in encoded_messages:
+            encoded_messages[client_socket.version] = encode_broadcast(client_socket.version, TEXT, message, offset)
+        client_socket.sendall(encoded_messages[client_socket.version])
+    if active_tracer is not None:
+        active_tracer.fanned_out(channel_name, len(members), perf_counter() - started)
+    if metrics is not None:
+        stats = metrics.channels[channel_name]
+        stats.fan_out.record(perf_counter() - started)
+        stats.messages += 1
+        stats.bytes_sent += sum(len(encoded_messages[session.socket.version])
+                                for other_client_name, session in members.items() if other_client_name != username)
+    channel_history[channel_name].append(message, offset, encoded_messages)
+
+
+# With --log-dir, protocol v2 broadcasts also carry their offset in the log of the channel,
+# the client can then ask for what it missed with "$Resume: <offset>"
+def encode_broadcast(version, kind, message, offset):
+    if version == 2 and offset is not None:
+        return encode_message(version, kind, message[:-1], offset)
+    return encode_message(version, kind, message[:-1])
+
+
+# The last messages of a channel go out in one write, encoded only once for each protocol version
+def replay_history(channel_name, client_socket, count):
+    if count > 0:
+        client_socket.sendall(channel_history[channel_name].encoded(client_socket.version, count))
 
 
 def dequeue(channel_name):
-    with disconnect_client_lock:
-        next_client = channel_users[channel_name][1].pop(0)  # remove first client's name in the queue
-        next_client_socket = client_info[channel_name][next_client][0]  # get their socket
-        channel_users[channel_name][0].append(next_client)  # add them to the room
-        client_info[channel_name][next_client][1] = "in-channel"  # set their status "in-channel"
-        client_join_room(next_client, channel_name, next_client_socket, code=2)  # server and joined client will print msg to the terminal
+    channel = channels[channel_name]
+    next_client = channel.queue.popleft()  # remove first client's name in the queue
+    session = channel.sessions[next_client]
+    channel.members[next_client] = session  # add them to the room
+    session.state = State.IN_CHANNEL
+    client_join_room(next_client, channel_name, session.socket, code=2)  # server and joined client will print msg to the terminal
+    publish_channel(channel_name)
+    if metrics is not None:
+        stats = metrics.channels[channel_name]
+        stats.dequeues += 1
+        if next_client in stats.queued_at:
+            stats.queue_wait.record(monotonic() - stats.queued_at.pop(next_client))
 
 
 # disconnect -> notify channel -> join room/notify users
-def disconnect_client(channel_name, username, client_socket, index, kick=False, AFK=False):
-    if client_info[channel_name][username][1] == "disconnected":
+def disconnect_client(client, kick=False, AFK=False):
+    if client.state is State.DISCONNECTED:
         return
-    client_socket.close()
+    client.socket.close()
     if kick:
-        stdout.write(f"[Server Message] Kicked {username}.\n")
-        stdout.flush()
-    if client_info[channel_name][username][1][:10] == "in-channel":  # [:10] in case they are muted
-            channel_users[channel_name][0].remove(username) # remove a specific client in the room
+        write_output(f"[Server Message] Kicked {client.username}.\n")
+    leave_channel(client, kick=kick, AFK=AFK)
+
+
+# The connection itself stays open, see switch_in_place(). The session is dropped from the
+# indexes of the channel, so nothing is left behind once the connection is gone
+def leave_channel(client, kick=False, AFK=False):
+    channel_name, username = client.channel_name, client.username
+    channel = channels[channel_name]
+    if client.state is not State.IN_QUEUE:  # in the channel, muted or not
+            del channel.members[username]  # remove a specific client in the room
             if not AFK:
                 left_notification(username, channel_name, kick=kick)
-            capacity = channel_capacity[index]
-            position = 0
+            capacity = channel.capacity
             # check queue and notify people in the queues
-            if len(channel_users[channel_name][0]) < capacity and len(channel_users[channel_name][1]) > 0:
+            if len(channel.members) < capacity and len(channel.queue) > 0:
                 dequeue(channel_name)
-    # if remove people in queue, notify the one after (find the index of the removed one)
+    # if remove people in queue, the ones after them move up
     else:
         left_notification(username, channel_name, kick=False)
-        position = channel_users[channel_name][1].index(username)
-        channel_users[channel_name][1].remove(username)
+        channel.queue.remove(username)
     # notify others in the queue
-    client_info[channel_name][username][1] = "disconnected"
-    for pos in range(position, len(channel_users[channel_name][1])):
-        other_client_name = channel_users[channel_name][1][pos]
-        other_client_socket = client_info[channel_name][other_client_name][0]
-        notify_users_ahead(pos, other_client_socket, code=2)
+    del channel.sessions[username]
+    unindex_user(username, channel_name)
+    client.state = State.DISCONNECTED
+    if metrics is not None:
+        stats = metrics.channels[channel_name]
+        stats.disconnects["kicked" if kick else "afk" if AFK else "left"] += 1
+        stats.queued_at.pop(username, None)
+    publish_channel(channel_name, left=[username])
+    schedule_queue_update(channel_name)
+
+
+# Departures are coalesced: at most one update per QUEUE_UPDATE_INTERVAL for each channel,
+# and a waiting user only hears about their final position, once, if it changed
+def schedule_queue_update(channel_name):
+    if channel_name in queue_updates_scheduled or len(channels[channel_name].queue) == 0:
+        return
+    queue_updates_scheduled.add(channel_name)
+    call_later(QUEUE_UPDATE_INTERVAL, update_queue_positions, channel_name)
+
+
+def update_queue_positions(channel_name):
+    with channel_locks[channel_name]:
+        queue_updates_scheduled.discard(channel_name)
+        queue = channels[channel_name].queue
+        for position, other_client_name in enumerate(queue):
+            if queue.notified.get(other_client_name) != position:
+                queue.notified[other_client_name] = position
+                other_client_socket = channels[channel_name].sessions[other_client_name].socket
+                notify_users_ahead(position, other_client_socket, code=2)
+
+
+def call_later(delay, function, *args):
+    return timer_wheel.call_at(monotonic() + delay, function, *args)
+
+
+class WheelTimer:
+    def __init__(self, deadline, function, args):
+        self.deadline = deadline  # may be moved later at no cost, the wheel checks it when the slot is reached
+        self.function = function
+        self.args = args
+        self.tick = 0  # tick of the slot the timer is in
+        self.cancelled = False
+
+
+# Hashed timing wheel shared by every connection for AFK deadlines, mute expiry and other
+# timed events. A timer is appended to the slot of its tick in O(1). Re-arming only moves its
+# deadline: when the slot is reached, a timer whose deadline moved is put back further along.
+# Ticks are driven by one thread, or by the event loop in --async mode, which runs the callbacks
+class TimerWheel:
+    def __init__(self, tick, slots):
+        self.tick_length = tick
+        self.slots = [[] for _ in range(slots)]
+        self.start = monotonic()
+        self.current_tick = 0
+        self.lock = Lock()
+
+    def call_at(self, deadline, function, *args):
+        timer = WheelTimer(deadline, function, args)
+        with self.lock:
+            self.insert(timer)
+        return timer
+
+    def insert(self, timer):
+        timer.tick = max(self.current_tick + 1, ceil((timer.deadline - self.start) / self.tick_length))
+        self.slots[timer.tick % len(self.slots)].append(timer)
+
+    # Return the timers due up to now, in the order of their ticks
+    def expire(self):
+        now = monotonic()
+        due = []
+        with self.lock:
+            while self.start + (self.current_tick + 1) * self.tick_length <= now:
+                self.current_tick += 1
+                slot_index = self.current_tick % len(self.slots)
+                slot = self.slots[slot_index]
+                self.slots[slot_index] = []
+                for timer in slot:
+                    if timer.cancelled:
+                        continue
+                    if timer.tick > self.current_tick:  # due in a later round of the wheel
+                        self.slots[slot_index].append(timer)
+                    elif timer.deadline > now:  # re-armed since it was inserted
+                        self.insert(timer)
+                    else:
+                        due.append(timer)
+        return due
+
+    def run_due(self):
+        for timer in self.expire():
+            if not timer.cancelled:
+                timer.function(*timer.args)
+
+    def run(self):
+        while True:
+            sleep(self.tick_length)
+            self.run_due()
+
+    def run_on_loop(self):
+        self.run_due()
+        event_loop.call_later(self.tick_length, self.run_on_loop)
+
+
+timer_wheel = TimerWheel(TIMER_TICK, TIMER_SLOTS)
+
+
+# Waiting queue of a channel. Each user gets an increasing sequence number and a Fenwick tree
+# counts the users still waiting by sequence number, so leaving from anywhere in the queue and
+# finding how many users are ahead of someone are O(log n), and the first user is popped in O(1)
+class WaitingQueue:
+    def __init__(self):
+        self.sequence = {}  # {username: sequence number}
+        self.users = []  # username by sequence number, None once they left
+        self.head = 0  # sequence number of the first user still waiting
+        self.tree = [0] * 17
+        self.notified = {}  # {username: last position sent to them}
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __contains__(self, username):
+        return username in self.sequence
+
+    def __iter__(self):
+        for username in self.users[self.head:]:
+            if username is not None:
+                yield username
+
+    def append(self, username):
+        if len(self.users) == len(self.tree) - 1:
+            self.renumber()
+        self.sequence[username] = len(self.users)
+        self.users.append(username)
+        self.add(len(self.users) - 1, 1)
+
+    def popleft(self):
+        while self.users[self.head] is None:
+            self.head += 1
+        username = self.users[self.head]
+        self.leave(username)
+        return username
+
+    # Return how many users were ahead of the removed one
+    def remove(self, username):
+        position = self.position(username)
+        self.leave(username)
+        return position
+
+    def position(self, username):
+        return self.count_before(self.sequence[username])
+
+    def leave(self, username):
+        number = self.sequence.pop(username)
+        self.notified.pop(username, None)
+        self.users[number] = None
+        self.add(number, -1)
+
+    def add(self, number, delta):
+        number += 1
+        while number < len(self.tree):
+            self.tree[number] += delta
+            number += number & -number
+
+    def count_before(self, number):
+        total = 0
+        while number > 0:
+            total += self.tree[number]
+            number -= number & -number
+        return total
+
+    # Drop the users who left and start the numbering again, with room for as many new users
+    def renumber(self):
+        self.users = list(self)
+        self.head = 0
+        self.sequence = {username: number for number, username in enumerate(self.users)}
+        self.tree = [0] * (2 * len(self.users) + 17)
+        for number in range(1, len(self.tree)):  # linear time construction of the tree
+            if number <= len(self.users):
+                self.tree[number] += 1
+            parent = number + (number & -number)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[number]
+
+
+# Members and waiting users of one channel. Both are indexed by username, so looking a user up
+# is O(1), and a member leaving does not shift the others. The port and capacity can be changed
+# by /reload, under the lock of the channel
+class Channel:
+    __slots__ = ("port", "capacity", "members", "queue", "sessions", "reserved")
+
+    def __init__(self, port, capacity):
+        self.port = port
+        self.capacity = capacity
+        self.members = {}  # {username: Session} in order of arrival
+        self.queue = WaitingQueue()  # usernames
+        self.sessions = {}  # {username: Session} of the members and of the waiting users
+        self.reserved = {}  # {username: (host, deadline)} of the clients reconnecting after a /switch
+
+
+# Ring buffer of the last broadcasts of a channel, bounded by --history messages and
+# --history-bytes bytes. Each entry keeps the encodings already made for the members, they
+# count towards the bytes along with the UTF-8 size of the message
+class MessageHistory:
+    def __init__(self, max_messages, max_bytes):
+        self.entries = deque()  # [message, log offset, {protocol version: encoded message}, bytes]
+        self.size = 0
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+
+    def append(self, message, offset, encoded_messages):
+        size = len(message.encode()) + sum(len(encoded) for encoded in encoded_messages.values())
+        self.entries.append([message, offset, encoded_messages, size])
+        self.size += size
+        self.trim()
+
+    def trim(self):
+        while len(self.entries) > self.max_messages or self.size > self.max_bytes:
+            self.size -= self.entries.popleft()[3]
+
+    # The last count messages, as one bytes object. Encodings made here are kept too, so the
+    # oldest entries may be dropped afterwards
+    def encoded(self, version, count):
+        start = max(0, len(self.entries) - count)
+        parts = []
+        for index in range(start, len(self.entries)):
+            entry = self.entries[index]
+            message, offset, encoded_messages = entry[:3]
+            if version not in encoded_messages:
+                encoded_messages[version] = encode_broadcast(version, TEXT, message, offset)
+                entry[3] += len(encoded_messages[version])
+                self.size += len(encoded_messages[version])
+            parts.append(encoded_messages[version])
+        self.trim()
+        return b"".join(parts)
 
 
 def timeout_notification(username, channel_name):
@@ -230,263 +970,2115 @@ def timeout_notification(username, channel_name):
 
 
 def left_notification(username, channel_name, kick=False):
-    with disconnect_client_lock:
-        left_channel_msg = f"[Server Message] {username} has left the channel.\n"
-        notify_channel(channel_name, left_channel_msg, kick=kick)
+    left_channel_msg = f"[Server Message] {username} has left the channel.\n"
+    notify_channel(channel_name, left_channel_msg, kick=kick)
+
+
+def is_local_channel(channel_name):
+    return owned_channels is None or channel_name in owned_channels
+
+
+# Reading the length of a list is atomic, so the counts of other channels can be read without
+# waiting for them. The counts of channels served by other workers come from the coordinator
+def channel_occupancy(channel_name):
+    if not is_local_channel(channel_name):
+        return remote_channels[channel_name]
+    return len(channels[channel_name].members), len(channels[channel_name].queue)
+
+
+def has_room(channel_name):
+    return channel_occupancy(channel_name)[0] < channels[channel_name].capacity
+
+
+# Directory of the channels for /list. The line of a channel is encoded once for each protocol
+# version and kept until the channel changes: publish_channel() tells it about every join,
+# leave and dequeue. The listing of every channel is kept as one bytes object too, so a plain
+# /list is a single cached write. Subscribers of "/list subscribe" are sent the lines of the
+# channels that changed, at most once every DIRECTORY_PUSH_INTERVAL
+class ChannelDirectory:
+    def __init__(self):
+        self.lock = Lock()  # taken after the channel locks, never held while sending
+        self.lines = {}  # {channel_name: {protocol version: encoded line}}
+        self.listings = {}  # {protocol version: encoded lines of every channel}
+        self.changed = set()  # channels changed since the last push to the subscribers
+        self.subscribers = set()  # Sessions, their subscription is the prefix of the channels they follow
+        self.push_scheduled = False
+
+    def channel_changed(self, channel_name):
+        with self.lock:
+            self.lines.pop(channel_name, None)
+            self.listings.clear()
+            if self.subscribers:
+                self.changed.add(channel_name)
+                if not self.push_scheduled:
+                    self.push_scheduled = True
+                    call_later(DIRECTORY_PUSH_INTERVAL, self.push_changes)
+
+    # Called with the lock held. A channel removed by /reload is listed as removed
+    def line(self, channel_name, version):
+        encoded = self.lines.setdefault(channel_name, {})
+        if version not in encoded:
+            if channel_name not in channel_indexes:
+                encoded[version] = encode_message(version, TEXT, f"[Channel] {channel_name} removed")
+            else:
+                # in --port mode, every channel is reached through the shared port, as print_channel_banner() shows
+                port = server_options["port"] or channels[channel_name].port
+                capacity = channels[channel_name].capacity
+                current_capacity, in_queue = channel_occupancy(channel_name)
+                encoded[version] = encode_message(
+                    version, TEXT, f"[Channel] {channel_name} {port} Capacity: {current_capacity}/{capacity}, Queue: {in_queue}")
+        return encoded[version]
+
+    # The lines of the given channels, or of every channel
+    def listing(self, version, names=None):
+        with self.lock:
+            if names is not None:
+                return b"".join(self.line(name, version) for name in names)
+            if version not in self.listings:
+                self.listings[version] = b"".join(self.line(name, version) for name in channel_names)
+            return self.listings[version]
+
+    # After /reload: every line is encoded again, as the order of the channels may have changed too
+    def reload(self, changed):
+        with self.lock:
+            self.lines.clear()
+            self.listings.clear()
+        for channel_name in changed:
+            self.channel_changed(channel_name)
+
+    def subscribe(self, client, prefix):
+        with self.lock:
+            client.subscription = prefix
+            self.subscribers.add(client)
+
+    def unsubscribe(self, client):
+        with self.lock:
+            client.subscription = None
+            self.subscribers.discard(client)
+
+    def push_changes(self):
+        updates = []
+        with self.lock:
+            self.push_scheduled = False
+            changed, self.changed = sorted(self.changed), set()
+            for client in self.subscribers:
+                lines = [self.line(name, client.socket.version) for name in changed
+                         if name.startswith(client.subscription)]
+                if lines:
+                    updates.append((client.socket, b"".join(lines)))
+        for client_socket, data in updates:
+            client_socket.sendall(data)
+
+
+channel_directory = ChannelDirectory()
+
+
+# Called without any channel lock, the reply is built from the directory and sent in one write
+def list_channels(client_socket, prefix="", free=False, page=None):
+    started = perf_counter()
+    version = client_socket.version
+    names = None  # every channel
+    if prefix or free:
+        names = [name for name in channel_names if name.startswith(prefix) and (not free or has_room(name))]
+    if page is None:
+        reply = channel_directory.listing(version, names)
+    else:
+        names = channel_names if names is None else names
+        pages = max(1, ceil(len(names) / LIST_PAGE_SIZE))
+        if page > pages:
+            reply = encode_message(version, TEXT, f"[Server Message] Page {page} does not exist, there are {pages}.")
+        else:
+            reply = (channel_directory.listing(version, names[(page - 1) * LIST_PAGE_SIZE:page * LIST_PAGE_SIZE])
+                     + encode_message(version, TEXT, f"[Server Message] Page {page} of {pages}."))
+    if not reply:
+        reply = encode_message(version, TEXT, "[Server Message] No channel matches.")
+    client_socket.sendall(reply)
+    if metrics is not None:
+        metrics.listed(perf_counter() - started)
+
+
+# Called without any channel lock, the two channels are locked one after the other
+# so that two clients switching in opposite directions can never deadlock
+def check_switch_command(channel_name, client):
+    username, client_socket, this_channel = client.username, client.socket, client.channel_name
+    if channel_name not in channel_indexes:
+        send_message(client_socket, TEXT, f"[Server Message] Channel \"{channel_name}\" does not exist.")
+        return
+    # clients that sent "$Hello: switch" stay connected when the channel is served by this process
+    if "switch" in client.capabilities and is_local_channel(channel_name):
+        switch_in_place(client, channel_name)
+        return
+    if is_local_channel(channel_name):
+        # the name is reserved under the same lock as the check, so two clients of that name
+        # switching at once cannot both pass it before either of them reconnects
+        with channel_locks[channel_name]:
+            duplication = duplicate_usernames(username, channel_name)
+            if not duplication:
+                channels[channel_name].reserved[username] = (client_host(client), monotonic() + SWITCH_RESERVATION)
+    elif cluster_nodes:
+        duplication = username in remote_users[channel_name]
+    else:
+        duplication = ask_coordinator("has_user", channel_name, username)
+    if duplication:
+        send_message(client_socket, USER_DUP, channel_name)
+    else:
+        port_num = channels[channel_name].port
+        if single_port_socket is not None:  # the client reconnects to the same port
+            send_message(client_socket, SWITCH_CHANNEL, channel_name)
+        elif is_local_channel(channel_name) or not cluster_nodes:
+            send_message(client_socket, SWITCH_PORT, port_num)
+        else:  # the client has to reconnect to the node serving the channel
+            send_message(client_socket, SWITCH_PORT, cluster_nodes[channel_owner[channel_indexes[channel_name]]][0], port_num)
+        # wait a bit for client to set up
+        if event_loop is not None:  # never block the event loop
+            call_later(0.1, run_in_channel, this_channel, disconnect_client, client)
+            return
+        sleep(0.1)
+        run_in_channel(this_channel, disconnect_client, client)
 
 
-def list_channels(client_socket):
-    list_message = ""
-    for i, channel in enumerate(channel_names):
-        port = channel_port[i]
-        capacity = channel_capacity[i]
-        current_capacity = len(channel_users[channel][0])
-        in_queue = len(channel_users[channel][1])
-        list_message = f"[Channel] {channel} {port} Capacity: {current_capacity}/{capacity}, Queue: {in_queue}\n"
-        client_socket.sendall(list_message.encode())
+# Leave one channel and join the other under the locks of both, so no other client can take the
+# name or the place in between. The locks are taken in name order, so two clients switching in
+# opposite directions cannot deadlock
+def switch_in_place(client, channel_name):
+    if channel_name == client.channel_name:
+        send_message(client.socket, USER_DUP, channel_name)
+        return
+    first, second = sorted([client.channel_name, channel_name])
+    with channel_locks[first], channel_locks[second]:
+        if channel_name not in channel_indexes:  # removed by /reload in between
+            send_message(client.socket, TEXT, f"[Server Message] Channel \"{channel_name}\" does not exist.")
+            return
+        if duplicate_usernames(client.username, channel_name):
+            send_message(client.socket, USER_DUP, channel_name)
+            return
+        leave_channel(client)  # like a reconnection, the mute does not follow the client
+        client.channel_name = channel_name
+        client_first_connection(client)
 
 
-def check_switch_command(line, username, client_socket, index, this_channel):
-    command = line.split()
-    channel_name = command[1]
-    if channel_name not in channel_names:
-        client_socket.sendall(f"[Server Message] Channel \"{channel_name}\" does not exist.\n".encode())
-    elif duplicate_usernames(username, channel_name):
-        client_socket.sendall(f"$UserDup: {channel_name}\n".encode())
+# "$File: <upload_id> <size> <receiver> <path>" from a client starts the upload of one of its files.
+# The receiver gets "$File: <id> <size> <sender> <name>", then each chunk the sender uploads as a
+# "$FileData: <id> <length>" line followed by <length> raw bytes, and finally "$FileEnd: <id>".
+# The server never opens a file, it only relays what the sender uploads
+def file_command(client, fields):
+    if client.state is not State.IN_CHANNEL or len(fields) < 4 or not fields[1].isdigit():
+        return
+    upload_id, size, target_username, filepath = fields[0], int(fields[1]), fields[2], " ".join(fields[3:])
+    receiver = channels[client.channel_name].members.get(target_username)
+    if target_username == client.username:
+        send_message(client.socket, TEXT, "[Server Message] Cannot send file to yourself.")
+    elif receiver is None:
+        send_message(client.socket, TEXT, f"[Server Message] {target_username} is not in the channel.")
+    elif client.uploads is None or upload_id not in client.uploads:
+        upload = Upload(upload_id, client, receiver, filepath)
+        with upload_lock:
+            if client.uploads is None:
+                client.uploads = {}
+            if receiver.incoming is None:
+                receiver.incoming = set()
+            client.uploads[upload_id] = upload
+            receiver.incoming.add(upload)
+        write_output(f"[Server Message] {client.username} sends \"{filepath}\" to {target_username}.\n")
+        send_message(receiver.socket, FILE, upload.transfer_id, size, client.username, os.path.basename(filepath))
+        send_message(client.socket, FILE_READY, upload_id, UPLOAD_WINDOW)
+        return
+    send_message(client.socket, FILE_READY, upload_id, 0)  # the sender closes its file
+
+
+# "$FileData: <upload_id> <length>", the raw bytes of the chunk follow the line, see client_messages().
+# A protocol v2 frame holds the whole chunk
+def file_data_command(client, fields):
+    upload = client.uploads.get(fields[0]) if client.uploads is not None else None
+    if isinstance(fields[1], bytes):
+        if upload is not None and len(fields[1]) <= FILE_CHUNK_SIZE:
+            relay_chunk(upload, fields[1])
+    elif fields[1].isdigit() and int(fields[1]) <= FILE_CHUNK_SIZE:
+        client.framer.expect_raw(int(fields[1]))
+        client.receiving = upload  # None if unknown or aborted, the chunk is then read and dropped
     else:
-        pos = channel_names.index(channel_name)
-        port_num = channel_port[pos]
-        client_socket.sendall(f"$Switch: {port_num}\n".encode())
-        # wait a bit for client to set up
-        sleep(0.1)
-        disconnect_client(this_channel, username, client_socket, index)
+        client.socket.close()  # the rest of the stream can not be told from raw bytes
+    return False
 
 
-# REF: The implementation of checking if a file is readable is Python is learned from
-# REF: https://www.geeksforgeeks.org/check-if-file-is-readable-in-python/
-def check_send_command(line, client_socket, channel_name):
-    stop_processing = False
-    command = line.split()
-    target_username = command[1]
-    if target_username not in channel_users[channel_name][0]:
-        client_socket.sendall(f"[Server Message] {target_username} is not in the channel.\n".encode())
-        stop_processing = True
-    filepath = command[2]
-    try:
-        with open(filepath) as file:
-            pass
-    except IOError:
-        client_socket.sendall(f"[Server Message] \"{filepath}\" does not exist.\n".encode())
-        stop_processing = True
-    if stop_processing:
+# "$FileEnd: <upload_id>", the last chunk was uploaded, or the sender acknowledges that the upload was stopped
+def file_end_command(client, fields):
+    with upload_lock:
+        upload = client.uploads.pop(fields[0], None) if client.uploads is not None else None
+        if upload is not None and upload.receiver.incoming is not None:
+            upload.receiver.incoming.discard(upload)
+    if upload is not None and not upload.cancelled:
+        done_message = f"[Server Message] Sent \"{upload.filepath}\" to {upload.receiver.username}."
+        receiver_socket = upload.receiver.socket
+        receiver_socket.sendall(RelayedChunk(encode_message(receiver_socket.version, FILE_END, upload.transfer_id),
+                                             lambda: send_message(client.socket, TEXT, done_message)))
+    return False
+
+
+# The bytes of the chunk being uploaded that were received so far, it is relayed once complete
+def receive_chunk(client):
+    data = client.framer.read_raw()
+    upload = client.receiving
+    if upload is None:
         return
+    upload.chunk += data
+    if not client.framer.raw_remaining:
+        client.receiving = None
+        relay_chunk(upload, bytes(upload.chunk))
+        upload.chunk.clear()
 
 
-def check_whisper_command(line, client_socket, channel_name, username):
-    command = line.split()
-    target_username = command[1]
-    chat_message = command[2]
+def relay_chunk(upload, chunk):
+    if upload.cancelled:
+        return
+    receiver_socket = upload.receiver.socket
+    if receiver_socket.version == 2:
+        data = encode_frame(FILE_DATA, upload.transfer_id, chunk)
+    else:
+        data = f"$FileData: {upload.transfer_id} {len(chunk)}\n".encode() + chunk
+    receiver_socket.sendall(RelayedChunk(data, lambda: grant_chunk(upload)))
+
+
+# Once a chunk was written to the receiver, the sender may upload one more
+def grant_chunk(upload):
+    if not upload.cancelled:
+        send_message(upload.sender.socket, FILE_READY, upload.upload_id, 1)
+
+
+# The receiver does not get the rest of a file whose sender left, and the sender of a file
+# whose receiver left is told to stop
+def stop_uploads(client):
+    with upload_lock:
+        uploads, client.uploads = client.uploads, None
+        incoming, client.incoming = client.incoming, None
+        for upload in (uploads or {}).values():
+            if upload.receiver.incoming is not None:
+                upload.receiver.incoming.discard(upload)
+    for upload in (uploads or {}).values():
+        if not upload.cancelled:
+            upload.cancelled = True
+            send_message(upload.receiver.socket, TEXT,
+                         f"[Server Message] {client.username} left, \"{upload.filepath}\" was not fully sent.")
+    for upload in incoming or ():
+        if not upload.cancelled:
+            upload.cancelled = True
+            send_message(upload.sender.socket, TEXT,
+                         f"[Server Message] {client.username} left, \"{upload.filepath}\" was not fully sent.")
+            send_message(upload.sender.socket, FILE_READY, upload.upload_id, 0)
+
+
+# A file uploaded by its sender. The sender uploads a chunk for each one "$FileReady:" grants:
+# UPLOAD_WINDOW at first, then one each time a chunk was written to the receiver, so a slow
+# receiver slows the sender down and the server holds at most UPLOAD_WINDOW chunks of a file
+class Upload:
+    __slots__ = ("upload_id", "transfer_id", "sender", "receiver", "filepath", "chunk", "cancelled")
+
+    def __init__(self, upload_id, sender, receiver, filepath):
+        self.upload_id = upload_id  # chosen by the sender
+        self.transfer_id = next(transfer_ids)  # seen by the receiver
+        self.sender = sender
+        self.receiver = receiver
+        self.filepath = filepath
+        self.chunk = bytearray()  # the part of the current chunk received so far
+        self.cancelled = False
+
+
+# A chunk of an upload, or its end, queued for the receiver. It is never dropped by the "drop"
+# policy, and on_sent is called once it was written
+class RelayedChunk:
+    __slots__ = ("data", "on_sent")
+
+    def __init__(self, data, on_sent):
+        self.data = data
+        self.on_sent = on_sent
+
+
+# The text protocol only carries the first word of the message, protocol v2 carries all of it.
+# A member of this channel gets it first, otherwise the only member of that name in another channel.
+# Names are unique in each channel only, so when several channels have one, the sender picks it with
+# "/whisper channel_name:username". The receiver's socket queues the message, their channel is not locked
+def check_whisper_command(target_username, chat_message, client_socket, channel_name, username):
     if target_username != username:
-        if target_username not in channel_users[channel_name][0]:
-            client_socket.sendall(f"[Server Message] {target_username} is not in the channel.\n".encode())
+        receiver = channels[channel_name].members.get(target_username)
+        if receiver is None:
+            receivers = find_members(target_username)
+            if len(receivers) > 1:
+                names = ", ".join(sorted(session.channel_name for session in receivers))
+                send_message(client_socket, TEXT, f"[Server Message] {target_username} is in channels {names}, "
+                                                  f"use /whisper channel_name:{target_username}.")
+                return
+            if receivers:
+                receiver = receivers[0]
+            elif ":" in target_username:  # channel names have no ":"
+                receiver = find_member(*target_username.split(":", 1))
+        if receiver is None:
+            send_message(client_socket, TEXT, f"[Server Message] {target_username} is not in the channel.")
+            return
+        send_message(receiver.socket, TEXT, f"[{username} whispers to you] {chat_message}")
+        send_message(client_socket, TEXT, f"[{username} whispers to {target_username}] {chat_message}")
+    write_output(f"[{username} whispers to {target_username}] {chat_message}\n")
+
+
+# Members are compared by identity: session.state is State.IN_CHANNEL
+class State(Enum):
+    IN_CHANNEL = "in-channel"
+    MUTED = "in-channel-muted"
+    IN_QUEUE = "in-queue"
+    DISCONNECTED = "disconnected"
+
+
+class Session:
+    # State of one connected client, shared by the threaded and the event-loop servers.
+    # In --port mode, channel_name is None until the "$User:" line names the channel.
+    # There is one per connection, so its attributes are slots rather than a dict
+    __slots__ = ("socket", "address", "username", "channel_name", "state", "muted_until",
+                 "duplication", "afk_timer", "capabilities", "buckets", "held", "framer", "subscription",
+                 "uploads", "incoming", "receiving")
+
+    def __init__(self, client_socket, client_address, channel_name):
+        self.socket = client_socket
+        self.address = client_address
+        self.username = None
+        self.channel_name = channel_name
+        self.state = None  # a State once the "$User:" line is accepted
+        self.muted_until = 0.0
+        self.duplication = False
+        self.afk_timer = None
+        self.capabilities = set()  # announced with "$Hello:" after "$User:"
+        self.buckets = None  # {limit: TokenBucket} of the rate limits of client scope, once one is used
+        self.held = None  # (wait, type, fields) of a message delayed by a rate limit, in --async mode
+        self.framer = LineFramer()  # what was received from the client and not processed yet
+        self.subscription = None  # prefix of the channels followed with "/list subscribe"
+        self.uploads = None  # {upload_id: Upload} of the files this client sends, once it sends one
+        self.incoming = None  # set of the Uploads of the files sent to this client
+        self.receiving = None  # the Upload whose chunk is being read, see receive_chunk()
+
+
+# Handle one message sent by a client, a line of the text protocol or a decoded protocol v2 frame.
+# Return True if the client is active in the channel, so the AFK timer should restart
+def process_message(client, message):
+    kind, fields = message if isinstance(message, tuple) else parse_line(message)
+    if isinstance(message, tuple) and kind == USER and any(field.split() != [field] for field in fields):
+        client.socket.close()  # the text protocol could not carry these names
+        return False
+    if client.channel_name is None:
+        fields = select_channel(client, kind, fields)
+        if fields is None:
+            return False
+    if rate_limits and kind in RATE_LIMITED_TYPES:
+        wait = throttle(client, kind)
+        if wait is None:
+            return False
+        if wait > 0:
+            if event_loop is not None:  # never block the event loop, see ChannelProtocol.release()
+                client.held = (wait, kind, fields)
+                return False
+            sleep(wait)  # no lock is held here, only this client waits
+    return dispatch_message(client, kind, fields)
+
+
+def dispatch_message(client, kind, fields):
+    active_tracer = tracer  # /trace may turn it off meanwhile
+    if active_tracer is None:
+        return handle_message(client, kind, fields)
+    started = perf_counter()
+    try:
+        return handle_message(client, kind, fields)
+    finally:
+        # unknown "$..." and "/..." lines and frames are ignored, they are traced as such
+        active_tracer.record(active_tracer.handlers, MESSAGE_NAMES.get(kind, "unknown"), perf_counter() - started)
+
+
+def handle_message(client, kind, fields):
+    # These read other channels, so they must not hold this channel's lock
+    if kind in unlocked_handlers:
+        return unlocked_handlers[kind](client, fields)
+    with channel_locks[client.channel_name]:
+        process_channel_message(client, kind, fields)
+        return is_active(client)
+
+
+# Token bucket: rate tokens per second, at most burst of them, each message takes one
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    # Return 0 if a token was taken, else the seconds until there is one. With reserve, the
+    # token is taken anyway, unless the wait is too long: later messages then wait after this one
+    def take(self, reserve):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        wait = (1 - self.tokens) / self.rate
+        if reserve and wait <= RATE_LIMIT_MAX_DELAY:
+            self.tokens -= 1
+        return wait
+
+
+# Check the rate limits of the client and of its channel for a message of this type.
+# Return 0 if the message can be processed now, the seconds it has to wait first with the delay
+# policy, or None if it is dropped
+def throttle(client, kind):
+    limits = rate_limits.get(client.channel_name, {}).get(kind)  # a channel may be gone after /reload
+    if not limits:
+        return 0
+    wait = 0
+    for limit in limits:
+        scope, _, rate, burst, policy = limit
+        if scope == "client":
+            if client.buckets is None:
+                client.buckets = {}
+            if limit not in client.buckets:
+                client.buckets[limit] = TokenBucket(rate, burst)
+            limit_wait = client.buckets[limit].take(policy == "delay")
+        else:
+            with bucket_lock:
+                bucket = channel_buckets.get((client.channel_name, kind))  # None if /reload removed the limit
+                limit_wait = bucket.take(policy == "delay") if bucket is not None else 0
+        if limit_wait > 0 and (policy != "delay" or limit_wait > RATE_LIMIT_MAX_DELAY):
+            if metrics is not None:
+                metrics.count_throttled(client.channel_name, RATE_LIMITED_TYPES[kind])
+            if policy == "notify":
+                send_message(client.socket, TEXT, f"[Server Message] You are sending {RATE_LIMIT_NOUNS[kind]} too fast.")
+            return None
+        wait = max(wait, limit_wait)
+    if wait > 0 and metrics is not None:
+        metrics.count_throttled(client.channel_name, RATE_LIMITED_TYPES[kind])
+    return wait
+
+
+# "$List [prefix=<name prefix>] [free] [page=<number>] [subscribe|unsubscribe]". A subscriber
+# gets the listing, then the line of each channel of the prefix as it changes
+def list_command(client, fields):
+    prefix, free, page, subscription = "", False, None, None
+    for field in fields:
+        name, has_value, value = field.partition("=")
+        if name == "prefix" and has_value:
+            prefix = value
+        elif field == "free":
+            free = True
+        elif name == "page" and value.isdigit() and int(value) > 0:
+            page = int(value)
+        elif field == "subscribe" or field == "unsubscribe":
+            subscription = field
+        else:
+            send_message(client.socket, TEXT, LIST_USAGE)
+            return is_active(client)
+    if subscription == "unsubscribe":
+        channel_directory.unsubscribe(client)
+        send_message(client.socket, TEXT, "[Server Message] You no longer receive channel updates.")
+        return is_active(client)
+    list_channels(client.socket, prefix, free, page)
+    if subscription == "subscribe":
+        channel_directory.subscribe(client, prefix)
+        send_message(client.socket, TEXT, "[Server Message] You will receive channel updates.")
+    return is_active(client)
+
+
+def switch_command(client, fields):
+    if client.state is None:  # not in any channel yet, or a duplicate name
+        return False
+    check_switch_command(fields[0], client)
+    return is_active(client)
+
+
+# "$Hello: <capability>...", the client can switch channels in place and/or read protocol v2
+def hello_command(client, fields):
+    client.capabilities.update(fields)
+    if "v2" in client.capabilities and client.socket.version == 1:
+        client.socket.version = 2
+        send_message(client.socket, HELLO, "v2")
+    return False
+
+
+# "$User: <username> <channel_name>" on the shared port of --port mode.
+# Return the fields of the "$User:" message of the per-port mode, or None if the client is turned away
+def select_channel(client, kind, fields):
+    if kind == USER and len(fields) == 1:
+        fields = fields[0].split(" ")
+    if kind != USER or len(fields) != 2:
+        client.socket.close()
+        return None
+    if fields[1] not in channel_indexes:
+        send_message(client.socket, TEXT, f"[Server Message] Channel \"{fields[1]}\" does not exist.")
+        client.socket.close()
+        return None
+    client.channel_name = fields[1]
+    return fields[:1]
+
+
+def is_active(client):
+    if client.duplication or client.username is None:
+        return False
+    return client.state is State.IN_CHANNEL  # if not muted
+
+
+def process_channel_message(client, kind, fields):
+    if kind == USER:
+        if client.channel_name not in channel_indexes:  # removed by /reload since the client connected
+            client.socket.close()
             return
-        receiver_socket = client_info[channel_name][target_username][0]  # get receiver info if in the channel
-        receiver_socket.sendall(f"[{username} whispers to you] {chat_message}\n".encode())
-        client_socket.sendall(f"[{username} whispers to {target_username}] {chat_message}\n".encode())
-    stdout.write(f"[{username} whispers to {target_username}] {chat_message}\n")
-    stdout.flush()
-
-
-# REF: The use of socket.settimeout() is inspired by the code at
-# REF: https://stackoverflow.com/questions/34371096/how-to-use-python-socket-settimeout-properly
-def handle_client(client_socket, client_address, index):
-    duplication = False
-    with client_socket:
+        client.username = " ".join(fields)
+        if not client_first_connection(client):
+            client.duplication = True
+        return
+    if kind == QUIT or kind == QUIT_KICKED:
+        disconnect_client(client, kick=kind == QUIT_KICKED)
+    elif client.state is State.MUTED:
+        duration = max(1, ceil(client.muted_until - monotonic()))
+        send_message(client.socket, TEXT, f"[Server Message] You are still in mute for {duration} seconds.")
+    elif kind in channel_handlers:
+        channel_handlers[kind](client, fields)
+
+
+# "/send <user> <path>" of older clients, which expected the server to read the file
+def send_command(client, fields):
+    send_message(client.socket, TEXT, "[Server Message] Files are uploaded by the client, update your client to send them.")
+
+
+def whisper_command(client, fields):
+    check_whisper_command(fields[0], fields[1], client.socket, client.channel_name, client.username)
+
+
+# "/history <count>", members get the last messages of the channel again
+def history_command(client, fields):
+    if client.state is State.IN_CHANNEL and fields[0].isdigit():
+        replay_history(client.channel_name, client.socket, int(fields[0]))
+
+
+# "$Resume: <offset>", members get the messages of the log after the offset they last saw
+def resume_command(client, fields):
+    if not channel_logs or not fields[0].isdigit():
+        return
+    if client.state is State.IN_CHANNEL:
+        records = channel_logs[client.channel_name].read(int(fields[0]) + 1, RESUME_LIMIT)
+        version = client.socket.version
+        client.socket.sendall(b"".join(encode_broadcast(version, CATCH_UP, message, offset)
+                                       for offset, _, message in records))
+
+
+def chat_message(client, fields):
+    if client.state is State.IN_CHANNEL:  # if not muted
+        notify_channel(client.channel_name, f"[{client.username}] {fields[0]}\n")
+
+
+# The chunks of an upload are read even from a muted client, the stream can not be parsed otherwise
+unlocked_handlers = {LIST: list_command, SWITCH: switch_command, HELLO: hello_command, FILE_DATA: file_data_command,
+                     FILE_END: file_end_command}
+channel_handlers = {SEND: send_command, FILE: file_command, WHISPER: whisper_command, HISTORY: history_command,
+                    RESUME: resume_command, CHAT: chat_message}
+
+
+def send_message(client_socket, kind, *fields):
+    client_socket.sendall(encode_message(client_socket.version, kind, *fields))
+
+
+# Re-arming only moves the deadline of the timer, there is no system call per message
+def restart_afk_timer(client):
+    deadline = monotonic() + afk_time
+    if client.afk_timer is None:
+        client.afk_timer = timer_wheel.call_at(deadline, went_afk, client)
+    else:
+        client.afk_timer.deadline = deadline
+
+
+def went_afk(client):
+    with channel_locks[client.channel_name]:
+        if client.state is State.DISCONNECTED:
+            return
+        # also send this to all clients in the channel
+        timeout_notification(client.username, client.channel_name)
+        send_message(client.socket, AFK)
+        disconnect_client(client, AFK=True)
+
+
+# error or EOF - client disconnected, a slow consumer is reported as kicked
+def connection_closed(client):
+    if client.afk_timer is not None:
+        client.afk_timer.cancelled = True
+    if client.subscription is not None:
+        channel_directory.unsubscribe(client)
+    if client.uploads is not None or client.incoming is not None:
+        stop_uploads(client)
+    if client.username is None or client.duplication:
+        client.socket.close()
+        return
+    with channel_locks[client.channel_name]:
+        disconnect_client(client, kick=client.socket.overflowed)
+
+
+def handle_client(client_socket, client_address, channel_name):
+    client = Session(OutboundSocket(client_socket), client_address, channel_name)
+    if metrics is not None:
+        metrics.connection_opened()
+    if handoff_gate is not None:
+        open_sessions.add(client)
+        handoff_gate.leave()  # entered by the acceptor before accept()
+    read_from_client(client, client_socket)
+
+
+# The raw socket is closed by the writer, once everything queued for the client has been sent.
+# unread is what a client taken over from the previous server had sent and it had not processed
+def read_from_client(client, client_socket, unread=b""):
+    try:
+        if handoff_gate is None:
+            while data := client_socket.recv(BUFSIZE):
+                receive(client, data)
+        else:
+            # with --handoff, a message is read and processed inside the gate, so a handoff
+            # never sees a message half processed, and what was not read yet goes to the new server
+            if unread:
+                with handoff_gate:
+                    receive(client, unread)
+            poller = select.poll()
+            poller.register(client_socket, select.POLLIN)
+            while True:
+                poller.poll()
+                with handoff_gate:
+                    data = client_socket.recv(BUFSIZE)
+                    if not data:
+                        break
+                    receive(client, data)
+    except Exception:
+        pass  # the client is disconnected below, unless it already sent "$Quit"
+    if open_sessions is not None:
+        open_sessions.discard(client)
+    connection_closed(client)
+    if metrics is not None:
+        metrics.connection_closed()
+
+
+def receive(client, data):
+    if metrics is not None:
+        metrics.received(len(data))
+    client.framer.feed(data)
+    for message in client_messages(client, tracer):
+        if process_message(client, message):
+            restart_afk_timer(client)
+
+
+# The messages received from the client, the raw bytes of an uploaded chunk between two of them
+# go to receive_chunk(). The time taken to parse each message is recorded for /trace
+def client_messages(client, active_tracer):
+    framer = client.framer
+    while True:
+        if framer.raw_remaining:
+            receive_chunk(client)
+            if framer.raw_remaining:
+                return
+        started = perf_counter()
+        message = framer.next_message()
+        if message is None:
+            return
+        if active_tracer is not None:
+            active_tracer.parsed(perf_counter() - started)
+        yield message
+
+
+# Bounded queue of data waiting to be sent to one client, drained by its own writer thread,
+# so that sendall() never blocks the channel on the network
+class OutboundSocket:
+    def __init__(self, client_socket):
+        self.socket = client_socket
+        self.pending = deque()
+        self.condition = Condition()
+        self.closing = False
+        self.writing = False  # a batch is being written
+        self.overflowed = False
+        self.version = 1  # protocol used to send to the client, see hello_command()
+        Thread(target=self.write_pending, daemon=True).start()
+
+    def sendall(self, data):
+        with self.condition:
+            if self.closing:
+                return
+            if len(self.pending) >= int(server_options["outbound-queue"]):
+                policy = server_options["slow-consumer"]
+                if policy == "block":
+                    self.condition.wait_for(lambda: len(self.pending) < int(server_options["outbound-queue"])
+                                            or self.closing, int(server_options["block-timeout"]))
+                    if self.closing:
+                        return
+                if policy == "drop":
+                    drop_oldest(self.pending)
+                elif len(self.pending) >= int(server_options["outbound-queue"]):
+                    self.overflow()
+                    return
+            self.pending.append(data)
+            self.condition.notify_all()
+
+    # The caller may be iterating over the members of the channel, so the client is only
+    # kicked once its reader sees the connection closed, see connection_closed()
+    def overflow(self):
+        self.closing = True
+        self.overflowed = True
+        self.pending.clear()
+        self.condition.notify_all()
+        try:
+            self.socket.shutdown(SHUT_RDWR)  # also wakes up the writer and the reader of this socket
+        except OSError:
+            pass
+
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+
+    def is_closing(self):
+        return self.closing
+
+    # Everything queued was handed to the kernel, see hand_off()
+    def drained(self):
+        with self.condition:
+            return not self.pending and not self.writing
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    # Everything queued since the last write goes out in a single sendmsg() call
+    def write_pending(self):
+        while True:
+            with self.condition:
+                self.writing = False
+                self.condition.wait_for(lambda: self.pending or self.closing)
+                if not self.pending:
+                    break
+                batch = list(self.pending)
+                self.pending.clear()
+                self.writing = True
+                self.condition.notify_all()
+            try:
+                self.write_batch(batch)
+            except OSError:
+                with self.condition:
+                    self.closing = True
+                    self.pending.clear()
+                    self.condition.notify_all()
+                break
         try:
-            while data := client_socket.recv(BUFSIZE).decode():
-                # print(f"Message at client_socket: {message}", file=stdout)
-                with lock:
-                    while "\n" in data:
-                        newline_index = data.index("\n")
-                        message = data[:(newline_index+1)]
-                        data = data[(newline_index+1):]
-                        if message[:6] == "$User:":
-                            username = message[:-1][7:]
-                            channel_name = channel_names[index]
-                            if not client_first_connection(message[:-1][7:], index, client_address, client_socket):
-                                duplication = True
-                        elif message[:5] == "$Quit":
-                            kicked = True if message[:-1][6:] == "kicked" else False
-                            disconnect_client(channel_name, username, client_socket, index, kick=kicked)
-                        elif message == "$List\n":
-                            list_channels(client_socket)
-                        elif message[:7] == "/switch":
-                            check_switch_command(message, username, client_socket, index, channel_name)
-                        elif client_info[channel_name][username][1][:16] == "in-channel-muted":
-                            duration = client_info[channel_name][username][1][17:]
-                            client_socket.sendall(f"[Server Message] You are still in mute for {duration} seconds.\n".encode())
-                        elif message[:5] == "/send":
-                            check_send_command(message, client_socket, channel_name)
-                        elif message[:8] == "/whisper":
-                            check_whisper_command(message, client_socket, channel_name, username)
-                        elif message[0] != "$" and message[0] != "/":
-                            if client_info[channel_name][username][1] == "in-channel":  # if not muted
-                                username, channel_name = client_address_users[client_address]
-                                to_send = f"[{username}] {message}" # message already includes \n
-                                notify_channel(channel_name, to_send)
-                        if client_info[channel_name][username][1] == "in-channel":  # if not muted
-                            client_socket.settimeout(afk_time)
-        except TimeoutError:
-            # also send this to all clients in the channel
-            timeout_notification(username, channel_name)
-            client_socket.sendall("$AFK\n".encode())
-            disconnect_client(channel_name, username, client_socket, index, AFK=True)
+            self.socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+    def write_batch(self, batch):
+        relayed = [item for item in batch if isinstance(item, RelayedChunk)]
+        send_batch(self.socket, [item.data if isinstance(item, RelayedChunk) else item for item in batch])
+        for item in relayed:
+            item.on_sent()
+
+
+# --global-lock serializes every channel on one lock, the baseline of the isolation benchmark.
+# It is reentrant, as switch_in_place() and hand_off() take the locks of several channels
+def new_channel_lock():
+    return global_lock if server_options["global-lock"] else Lock()
+
+
+def run_in_channel(channel_name, function, *args):
+    with channel_locks[channel_name]:
+        return function(*args)
+
+
+# The oldest message is lost, the chunks of the files being sent are kept
+def drop_oldest(pending):
+    for position, data in enumerate(pending):
+        if not isinstance(data, RelayedChunk):
+            del pending[position]
+            return
+
+
+# Gathering write of several buffers, a partially sent buffer is resumed from where it stopped
+def send_batch(client_socket, batch):
+    if not hasattr(client_socket, "sendmsg"):
+        client_socket.sendall(b"".join(batch))
+        return
+    start = 0
+    while start < len(batch):
+        sent = client_socket.sendmsg(batch[start:start + IOV_MAX])
+        while start < len(batch) and sent >= len(batch[start]):
+            sent -= len(batch[start])
+            start += 1
+        if sent:
+            batch[start] = memoryview(batch[start])[sent:]
+
+
+# Socket-like wrapper so the channel logic can write to an asyncio transport without blocking.
+# Data is queued while the transport buffer is full, with the same slow consumer policies as
+# OutboundSocket, except that "block" keeps queueing until its timeout, as the loop cannot wait.
+# Everything sent during one iteration of the loop is written with a single writelines()
+class TransportSocket:
+    def __init__(self, transport):
+        self.transport = transport
+        self.pending = deque()
+        self.paused_since = None
+        self.flush_scheduled = False
+        self.overflowed = False
+        self.version = 1
+
+    def sendall(self, data):
+        if self.transport.is_closing():
+            return
+        if self.paused_since is not None and len(self.pending) >= int(server_options["outbound-queue"]):
+            policy = server_options["slow-consumer"]
+            if policy == "drop":
+                drop_oldest(self.pending)
+            elif policy == "kick" or monotonic() - self.paused_since > int(server_options["block-timeout"]):
+                self.overflowed = True
+                self.pending.clear()
+                self.transport.abort()  # connection_lost() then kicks the client
+                return
+        self.pending.append(data)
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.paused_since is None and not self.flush_scheduled:
+            self.flush_scheduled = True
+            event_loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if self.paused_since is not None or self.transport.is_closing():
+            return
+        batch = list(self.pending)
+        self.pending.clear()
+        self.transport.writelines([item.data if isinstance(item, RelayedChunk) else item for item in batch])
+        for item in batch:
+            if isinstance(item, RelayedChunk):
+                item.on_sent()
+
+    def pause_writing(self):
+        self.paused_since = monotonic()
+
+    def resume_writing(self):
+        self.paused_since = None
+        self.flush()
+
+    def is_closing(self):
+        return self.transport.is_closing()
+
+    def drained(self):
+        return not self.pending and self.transport.get_write_buffer_size() == 0
+
+    def fileno(self):
+        return self.transport.get_extra_info("socket").fileno()
+
+    def close(self):
+        if not self.transport.is_closing():
+            # sent before the transport closes, unfinished files are dropped
+            self.transport.writelines([data for data in self.pending if not isinstance(data, RelayedChunk)])
+            self.pending.clear()
+        self.transport.close()
+
+
+# Event-loop counterpart of handle_client(): every client of every channel is served by one thread
+class ChannelProtocol(asyncio.Protocol):
+    def __init__(self, channel_name, restored=False):
+        self.channel_name = channel_name
+        self.client = None
+        self.transport = None
+        self.restored = restored  # taken over from the previous server, see take_over()
+
+    def connection_made(self, transport):
+        client_address = transport.get_extra_info("peername")
+        self.transport = transport
+        self.client = Session(TransportSocket(transport), client_address, self.channel_name)
+        if self.restored:  # nothing is read before the state of the session is restored
+            transport.pause_reading()
+        if open_sessions is not None:
+            open_sessions.add(self.client)
+        if metrics is not None:
+            metrics.connection_opened()
+
+    def pause_writing(self):
+        self.client.socket.pause_writing()
+
+    def resume_writing(self):
+        self.client.socket.resume_writing()
+
+    def data_received(self, data):
+        if metrics is not None:
+            metrics.received(len(data))
+        self.client.framer.feed(data)
+        self.process_messages()
+
+    # What the previous server had received from the client and not processed yet
+    def take_over(self, unread):
+        self.client.framer.feed(unread)
+        self.process_messages()
+        if self.client.held is None:
+            self.transport.resume_reading()
+
+    def process_messages(self):
+        try:
+            for message in client_messages(self.client, tracer):
+                if process_message(self.client, message):
+                    restart_afk_timer(self.client)
+                if self.client.held is not None:  # delayed by a rate limit, so are the next messages
+                    self.transport.pause_reading()
+                    event_loop.call_later(self.client.held[0], self.release)
+                    return
         except Exception:
-            # print(f"Message at Exception: {message}", file=stdout)
-            if message[:5] != "$Quit":
-                disconnect_client(channel_name, username, client_socket, index, kick=False)
-            # print(f"Connection from {username} closed.")
-    # error or EOF - client disconnected
-    if duplication:
-        client_socket.close()
-    else:
-        disconnect_client(channel_name, username, client_socket, index, kick=False)  # abruptly closed
+            self.client.socket.close()
+
+    def release(self):
+        _, kind, fields = self.client.held
+        self.client.held = None
+        if self.transport.is_closing():
+            return
+        try:
+            if dispatch_message(self.client, kind, fields):
+                restart_afk_timer(self.client)
+        except Exception:
+            self.client.socket.close()
+            return
+        self.transport.resume_reading()
+        self.process_messages()
+
+    def connection_lost(self, exc):
+        if open_sessions is not None:
+            open_sessions.discard(self.client)
+        connection_closed(self.client)
+        if metrics is not None:
+            metrics.connection_closed()
+
+
+def run_event_loop(names, handoff):
+    asyncio.set_event_loop(event_loop)
+    if handoff is not None:
+        event_loop.run_until_complete(restore_sessions_on_loop(*handoff))
+    event_loop.run_until_complete(start_channel_servers(names))
+    if single_port_socket is not None:
+        event_loop.run_until_complete(start_single_port_server())
+    create_all_ports.set()
+    timer_wheel.run_on_loop()
+    event_loop.run_forever()
+
+
+async def start_single_port_server():
+    channel_servers[None] = await event_loop.create_server(lambda: ChannelProtocol(None), sock=single_port_socket)
+
+
+# Start the --async server: a single thread runs the event loop for all the given channels and their clients.
+# handoff is what take_over() received from the previous server, if any
+def start_event_loop_server(names, handoff=None):
+    global event_loop
+    event_loop = asyncio.new_event_loop()
+    Thread(target=run_event_loop, args=(names, handoff), daemon=True).start()
+    create_all_ports.wait()
+
+
+# Admin commands from stdin run on the event loop in --async mode, they lock the channel they change.
+# In --workers mode, the coordinator hands them to the worker serving the channel
+def run_admin_command(function, line):
+    command = line.split()
+    names_channel = (len(command) > 1 and command[1] in channel_indexes
+                     and len(command) != USER_COMMAND_WORDS.get(function.__name__))
+    if worker_connections and names_channel:
+        ask_worker(channel_indexes[command[1]] % len(worker_connections), "admin", function.__name__, line)
+        return
+    if cluster_nodes and names_channel and not is_local_channel(command[1]):
+        relay_to_node(channel_owner[channel_indexes[command[1]]],
+                      {"type": "admin", "function": function.__name__, "line": line})
+        return
+    if event_loop is None:
+        function(line)
+        return
+    done = Event()
+
+    def run():
+        try:
+            function(line)
+        finally:
+            done.set()
+    event_loop.call_soon_threadsafe(run)
+    done.wait()
 
 
 # REF: The use of os._exit() is inspired by the code at
 # REF: https://stackoverflow.com/questions/1489669/how-to-exit-the-entire-application-from-a-python-thread
 def server_shutdown(command):
     if command != "/shutdown\n":
-        stdout.write("Usage: /shutdown\n")
-        stdout.flush()
+        write_output("Usage: /shutdown\n")
         return
-    stdout.write("[Server Message] Server shuts down.\n")
-    stdout.flush()
+    write_output("[Server Message] Server shuts down.\n")
+    output_writer.flush()
+    for log in channel_logs.values():
+        log.close()
+    for process in multiprocessing.active_children():
+        process.kill()
     os._exit(0)
 
 
 def channel_exists(channel_name):
-    if channel_name not in channel_names:
-        stdout.write(f"[Server Message] Channel \"{channel_name}\" does not exist.\n")
-        stdout.flush()
+    if channel_name not in channel_indexes:
+        write_output(f"[Server Message] Channel \"{channel_name}\" does not exist.\n")
         return False
     return True
 
 
 def client_not_in_channel(client_username, channel_name):
-    if client_username not in channel_users[channel_name][0]:
-        stdout.write(f"[Server Message] {client_username} is not in the channel.\n")
-        stdout.flush()
+    if client_username not in channels[channel_name].members:
+        write_output(f"[Server Message] {client_username} is not in the channel.\n")
         return True
     return False
 
 
+# Channels in which the user is a member, found in the server-wide index. The coordinator of
+# --workers mode has no sessions, it knows the channels of each user from the workers
+def channels_of(username):
+    if worker_connections:
+        with directory_lock:
+            return sorted(directory_users.get(username, ()))
+    return sorted(session.channel_name for session in find_members(username))
+
+
+# "/kick client_username" and "/mute client_username duration" act on the user in every channel
+# they are a member of, as if the command had named each of these channels
+def in_every_channel(function, words):
+    names = channels_of(words[0])
+    if not names:
+        write_output(f"[Server Message] {words[0]} is not in any channel.\n")
+    for channel_name in names:
+        line = f"/{function.__name__} {channel_name} {' '.join(words)}\n"
+        if worker_connections:  # handed to the worker serving the channel
+            run_admin_command(function, line)
+        else:
+            function(line)
+
+
 def kick(orig_command):
     command = orig_command.split()
-    if len(command) != 3 or orig_command.count(" ") != 2:
-        stdout.write("Usage: /kick channel_name client_username\n")
-        stdout.flush()
+    if len(command) not in (2, 3) or orig_command.count(" ") != len(command) - 1:
+        write_output("Usage: /kick [channel_name] client_username\n")
+        return
+    if len(command) == 2:
+        in_every_channel(kick, command[1:])
         return
     channel_name = command[1]
     client_username = command[2]
     if not channel_exists(channel_name):
         return
-    if client_not_in_channel(client_username, channel_name):
-        return
-    # If the command is valid, kick!
-    client_socket = client_info[channel_name][client_username][0]
-    # Sending the message below will make client sends a "$Quit" message, the socket will then be disconnected
-    # handling by Exception catch in handle_client() - maybe should not do this
-    client_socket.sendall("$Kick\n".encode())
+    with channel_locks[channel_name]:
+        if client_not_in_channel(client_username, channel_name):
+            return
+        # If the command is valid, kick!
+        client_socket = channels[channel_name].members[client_username].socket
+        # Sending the message below will make client sends a "$Quit" message, the socket will then be disconnected
+        # handling by Exception catch in handle_client() - maybe should not do this
+        send_message(client_socket, KICK)
 
 
 def empty(line):
     command = line.split()
     if len(command) != 2 or line.count(" ") != 1:
-        stdout.write("Usage: /empty channel_name\n")
-        stdout.flush()
+        write_output("Usage: /empty channel_name\n")
         return
     channel_name = command[1]
     if not channel_exists(channel_name):
         return
-    for client_username in channel_users[channel_name][0]:
-        client_socket = client_info[channel_name][client_username][0]
-        client_socket.sendall("$Empty\n".encode())
-        client_socket.close()
-        client_info[channel_name][client_username][1] = "disconnected"
-    stdout.write(f"[Server Message] \"{channel_name}\" has been emptied.\n")
-    stdout.flush()
-    channel_users[channel_name][0] = []
-    capacity = channel_capacity[channel_names.index(channel_name)]
-    while len(channel_users[channel_name][0]) < capacity and len(channel_users[channel_name][1]) > 0:
-        dequeue(channel_name)
+    with channel_locks[channel_name]:
+        channel = channels[channel_name]
+        for client_username, session in channel.members.items():
+            send_message(session.socket, EMPTY)
+            session.socket.close()
+            session.state = State.DISCONNECTED
+            del channel.sessions[client_username]
+            unindex_user(client_username, channel_name)
+        if metrics is not None:
+            metrics.channels[channel_name].disconnects["emptied"] += len(channel.members)
+        write_output(f"[Server Message] \"{channel_name}\" has been emptied.\n")
+        emptied = list(channel.members)
+        channel.members = {}
+        publish_channel(channel_name, left=emptied)
+        while len(channel.members) < channel.capacity and len(channel.queue) > 0:
+            dequeue(channel_name)
 
 
 def mute(line):
     command = line.split()
-    if len(command) != 4 or line.count(" ") != 3:
-        stdout.write("Usage: /mute channel_name client_username duration\n")
-        stdout.flush()
+    if len(command) not in (3, 4) or line.count(" ") != len(command) - 1:
+        write_output("Usage: /mute [channel_name] client_username duration\n")
+        return
+    if len(command) == 3:
+        if not command[2].isdigit() or int(command[2]) <= 0:
+            write_output("[Server Message] Invalid mute duration.\n")
+            return
+        in_every_channel(mute, command[1:])
         return
     channel_name = command[1]
     if not channel_exists(channel_name):
         return
-    client_username = command[2]
-    if client_not_in_channel(client_username, channel_name):
+    with channel_locks[channel_name]:
+        client_username = command[2]
+        if client_not_in_channel(client_username, channel_name):
+            return
+        duration = command[3]
+        if not duration.isdigit() or int(duration) <= 0:
+            write_output("[Server Message] Invalid mute duration.\n")
+            return
+        session = channels[channel_name].members[client_username]
+        session.state = State.MUTED
+        session.muted_until = monotonic() + int(duration)
+        client_socket = session.socket
+        call_later(int(duration), unmute, session)
+        write_output(f"[Server Message] Muted {client_username} for {duration} seconds.\n")
+        send_message(client_socket, TEXT, f"[Server Message] You have been muted for {duration} seconds.")
+        message = f"[Server Message] {client_username} has been muted for {duration} seconds.\n"
+        notify_channel(channel_name, message, kick=True, username=client_username)  # kick=True to avoid server to print again
+
+
+# Admin commands that can be handed to the worker or the node serving the channel they name
+admin_commands = {"kick": kick, "empty": empty, "mute": mute}
+
+
+# A later /mute of the same client moves the deadline, then only the last timer unmutes them.
+# A client who left or switched channels since is no longer MUTED
+def unmute(session):
+    with channel_locks[session.channel_name]:
+        if session.state is State.MUTED and monotonic() >= session.muted_until:
+            session.state = State.IN_CHANNEL
+
+
+# /reload, also run on SIGHUP: the configuration file is read again and only the channels that
+# changed are touched. A channel that grows lets its waiting users in at once, one that shrinks
+# keeps its members until they leave. A channel whose port cannot be used is left as it was
+def reload(line):
+    global channel_names
+    global channel_indexes
+    global rate_limits
+    global channel_buckets
+    if line != "/reload\n":
+        write_output("Usage: /reload\n")
+        return
+    if worker_connections or owned_channels is not None:
+        write_output("[Server Message] /reload is not supported with --workers or --node.\n")
         return
-    duration = command[3]
-    if not duration.isdigit() or int(duration) <= 0:
-        stdout.write("[Server Message] Invalid mute duration.\n")
-        stdout.flush()
+    try:
+        config = read_configuration()
+    except InvalidConfiguration:
+        write_output("[Server Message] Invalid configuration file, nothing was reloaded.\n")
         return
-    client_info[channel_name][client_username][1] = f"in-channel-muted-{duration}"
-    stdout.write(f"[Server Message] Muted {client_username} for {duration} seconds.\n")
-    stdout.flush()
-    client_socket = client_info[channel_name][client_username][0]
-    client_socket.sendall(f"[Server Message] You have been muted for {duration} seconds.\n".encode())
-    message = f"[Server Message] {client_username} has been muted for {duration} seconds.\n"
-    notify_channel(channel_name, message, kick=True, username=client_username)  # kick=True to avoid server to print again
+    with reload_lock:
+        removed = [name for name in channel_names if name not in config.indexes]
+        for name in removed:  # first, their ports may be used by other channels now
+            if name in listening_channel_sockets:
+                stop_serving(name)
+        names, added, resized, moved = [], [], [], []
+        for index, name in enumerate(config.names):
+            port, capacity = config.ports[index], config.capacities[index]
+            if name not in channel_indexes:
+                if not add_channel(name, port, capacity):
+                    continue
+                added.append(name)
+            else:
+                if port != channels[name].port:
+                    move_channel(name, port)
+                    moved.append(name)
+                if capacity != channels[name].capacity:
+                    resized.append((name, capacity))
+            names.append(name)
+        with bucket_lock:
+            rate_limits, channel_buckets = config.rate_limits, config.channel_buckets
+        channel_names, channel_indexes = names, {name: index for index, name in enumerate(names)}
+        for name in removed:
+            remove_channel(name)
+        for name, capacity in resized:
+            resize_channel(name, capacity)
+        for name in added:  # once the name is known, "$User:" lines for it are accepted
+            print_channel_banner(name)
+            if not server_options["port"]:
+                serve_channel(name)
+        channel_directory.reload(added + removed + moved + [name for name, _ in resized])
+        write_output(f"[Server Message] Configuration reloaded: {len(added)} added, {len(removed)} removed, "
+                     f"{len(resized)} resized.\n")
+
+
+# Return False if the channel cannot listen on its port. A channel removed by an earlier
+# /reload comes back with its history and counters
+def add_channel(channel_name, port, capacity):
+    if not server_options["port"]:
+        listening_socket = open_listening_socket(port)
+        if listening_socket is None:
+            write_output(f"[Server Message] Unable to listen on port {port}, "
+                         f"channel \"{channel_name}\" is not created.\n")
+            return False
+        listening_channel_sockets[channel_name] = listening_socket
+    if channel_name in channels:
+        with channel_locks[channel_name]:
+            channels[channel_name].port = port
+            channels[channel_name].capacity = capacity
+        return True
+    channels[channel_name] = Channel(port, capacity)
+    channel_history[channel_name] = MessageHistory(int(server_options["history"]), int(server_options["history-bytes"]))
+    channel_locks[channel_name] = new_channel_lock()
+    open_channel_logs([channel_name])
+    if metrics is not None:
+        metrics.channels[channel_name] = ChannelStats()
+    return True
+
+
+# Members stay connected, new clients reach the channel on its new port
+def move_channel(channel_name, port):
+    if not server_options["port"]:
+        listening_socket = open_listening_socket(port)
+        if listening_socket is None:
+            write_output(f"[Server Message] Unable to listen on port {port}, "
+                         f"channel \"{channel_name}\" stays on port {channels[channel_name].port}.\n")
+            return
+        stop_serving(channel_name)
+        listening_channel_sockets[channel_name] = listening_socket
+        serve_channel(channel_name)
+    channels[channel_name].port = port
+    write_output(f"[Server Message] Channel \"{channel_name}\" moved to port {port}.\n")
+
+
+# Like /empty, for the waiting users too. The channel itself is kept, so timers and
+# connections still running for its clients find it, but nobody can join it any more
+def remove_channel(channel_name):
+    with channel_locks[channel_name]:
+        channel = channels[channel_name]
+        for username, session in channel.sessions.items():
+            send_message(session.socket, EMPTY)
+            session.socket.close()
+            session.state = State.DISCONNECTED
+            unindex_user(username, channel_name)
+        if metrics is not None:
+            metrics.channels[channel_name].disconnects["emptied"] += len(channel.sessions)
+            metrics.channels[channel_name].queued_at.clear()
+        channel.members = {}
+        channel.queue = WaitingQueue()
+        channel.sessions = {}
+        write_output(f"[Server Message] Channel \"{channel_name}\" has been removed.\n")
+
+
+def resize_channel(channel_name, capacity):
+    with channel_locks[channel_name]:
+        channel = channels[channel_name]
+        channel.capacity = capacity
+        while len(channel.members) < channel.capacity and len(channel.queue) > 0:
+            dequeue(channel_name)
+        schedule_queue_update(channel_name)
+        write_output(f"[Server Message] Channel \"{channel_name}\" now has a capacity of {capacity}.\n")
+
+
+# The gauges are read when the metrics are collected. In --workers mode, the coordinator
+# collects the metrics of every worker, each of them holds the channels it serves
+def collect_metrics():
+    if worker_connections:
+        collected = Metrics([])
+        for worker in range(len(worker_connections)):
+            collected.merge(ask_worker(worker, "metrics"))
+        return collected
+    for channel_name, stats in list(metrics.channels.items()):  # /reload may add channels meanwhile
+        stats.members = len(channels[channel_name].members)
+        stats.queue = len(channels[channel_name].queue)
+    return metrics
+
+
+def milliseconds(histogram):
+    return ", ".join(f"p{quantile * 100:g} {histogram.percentile(quantile) * 1000:.3f} ms"
+                     for quantile in QUANTILES)
+
+
+# Read without the channel locks: the counters may be a message apart from each other
+def stats(line):
+    command = line.split()
+    if len(command) > 2 or line.count(" ") != len(command) - 1:
+        write_output("Usage: /stats [channel_name]\n")
+        return
+    if len(command) == 2 and not channel_exists(command[1]):
+        return
+    if not server_options["metrics"]:
+        write_output("[Server Message] Metrics are disabled, start the server with --metrics.\n")
+        return
+    collected = collect_metrics()
+    if len(command) == 1:
+        write_output(f"[Stats] Connections: {collected.connections}, open: {collected.open_connections}, "
+                     f"received: {collected.bytes_received} bytes\n")
+        write_output(f"[Stats] List requests: {collected.list_requests}, {milliseconds(collected.list_latency)}\n")
+    for channel_name in command[1:] or channel_names:
+        channel = collected.channels.get(channel_name)
+        if channel is None:
+            write_output(f"[Server Message] Channel \"{channel_name}\" is served by another node.\n")
+            continue
+        write_output(f"[Stats] {channel_name} Members: {channel.members}, Queue: {channel.queue}, "
+                     f"Messages: {channel.messages}, Sent: {channel.bytes_sent} bytes, Joins: {channel.joins}, "
+                     f"Dequeues: {channel.dequeues}, Left: {channel.disconnects['left']}, "
+                     f"Kicked: {channel.disconnects['kicked']}, AFK: {channel.disconnects['afk']}, "
+                     f"Emptied: {channel.disconnects['emptied']}\n")
+        write_output(f"[Stats] {channel_name} Throttled: "
+                     + ", ".join(f"{kind} {count}" for kind, count in channel.throttled.items()) + "\n")
+        write_output(f"[Stats] {channel_name} Fan-out: {milliseconds(channel.fan_out)}; "
+                     f"Queue wait: {milliseconds(channel.queue_wait)}\n")
+
+
+# /trace on, then /trace off [stack_file]: lock wait and hold times, handler durations and the
+# slowest fan-outs are reported, the stacks sampled from every thread meanwhile are written to
+# stack_file for flamegraph.pl. While it is off, the hot path only checks that there is no tracer
+def trace(line):
+    global tracer
+    global bucket_lock
+    command = line.split()
+    if (len(command) < 2 or command[1] not in ("on", "off") or len(command) > (3 if command[1] == "off" else 2)
+            or line.count(" ") != len(command) - 1):
+        write_output("Usage: /trace on|off [stack_file]\n")
+        return
+    if worker_connections:
+        write_output("[Server Message] /trace is not supported with --workers.\n")
+        return
+    if command[1] == "on":
+        if tracer is not None:
+            write_output("[Server Message] Tracing is already on.\n")
+            return
+        active_tracer = Tracer(TRACE_SAMPLE_INTERVAL)
+        for name, lock in list(channel_locks.items()):
+            channel_locks[name] = active_tracer.trace_lock(lock, f"channel {name}")
+        bucket_lock = active_tracer.trace_lock(bucket_lock, "rate limit buckets")
+        tracer = active_tracer
+        write_output("[Server Message] Tracing is on.\n")
+        return
+    if tracer is None:
+        write_output("[Server Message] Tracing is off.\n")
+        return
+    active_tracer, tracer = tracer, None
+    for name, lock in list(channel_locks.items()):
+        if isinstance(lock, TracedLock):
+            channel_locks[name] = lock.lock
+    bucket_lock = bucket_lock.lock
+    active_tracer.stop()
+    report_trace(active_tracer)
+    if len(command) == 3:
+        try:
+            active_tracer.write_collapsed(command[2])
+        except OSError:
+            write_output(f"[Server Message] Unable to write \"{command[2]}\".\n")
+            return
+        write_output(f"[Trace] {active_tracer.sample_count} stack samples written to \"{command[2]}\".\n")
+
+
+# The locks waited for the longest in total, and the handlers that took the longest in total
+def report_trace(active_tracer):
+    with active_tracer.lock:
+        write_output(f"[Trace] Traced for {active_tracer.stopped - active_tracer.started:.3f} seconds.\n")
+        for name, waits in sorted(active_tracer.lock_waits.items(), key=lambda item: -item[1].total)[:TRACE_TOP]:
+            holds = active_tracer.lock_holds.get(name)
+            write_output(f"[Trace] Lock {name}: acquired {waits.count} times, wait {milliseconds(waits)}"
+                         + (f"; held {milliseconds(holds)}" if holds is not None else "") + "\n")
+        for name, durations in sorted(active_tracer.handlers.items(), key=lambda item: -item[1].total)[:TRACE_TOP]:
+            write_output(f"[Trace] Handler {name}: {durations.count} messages, {milliseconds(durations)}\n")
+        write_output(f"[Trace] Parsing: {active_tracer.parsing.count} messages, {milliseconds(active_tracer.parsing)}\n")
+        for seconds, channel_name, members in sorted(active_tracer.fan_outs, reverse=True):
+            write_output(f"[Trace] Fan-out in {channel_name} to {members} members: {seconds * 1000:.3f} ms\n")
+
+
+def open_channel_logs(names):
+    if server_options["log-dir"]:
+        for name in names:
+            channel_logs[name] = ChannelLog(os.path.join(server_options["log-dir"], name))
+
+
+# --handoff mode. Every generation of the server runs the same command line: a server that finds
+# another one listening on the Unix socket takes over from it, then listens there for its own
+# successor. The old server stops accepting and processing, waits for what it queued for its
+# clients to be sent, then passes its listening sockets and client sockets with SCM_RIGHTS,
+# along with the members, queues, mutes and history of its channels, and exits. Connections
+# that arrive meanwhile wait in the accept queues, which the new server inherits, so none is
+# refused. The new server may come with a new configuration file: the sockets of channels
+# that are gone or moved are closed
+class HandoffGate:
+    # Threaded server: accepting a connection and processing a message both happen inside the gate,
+    # close() waits for those inside and keeps the others out until open()
+    def __init__(self):
+        self.condition = Condition()
+        self.inside = 0
+        self.closed = False
+
+    def enter(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.closed)
+            self.inside += 1
+
+    def leave(self):
+        with self.condition:
+            self.inside -= 1
+            self.condition.notify_all()
+
+    def __enter__(self):
+        self.enter()
+
+    def __exit__(self, *exc_info):
+        self.leave()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.wait_for(lambda: self.inside == 0)
+
+    def open(self):
+        with self.condition:
+            self.closed = False
+            self.condition.notify_all()
+
+
+def listen_for_successor():
+    path = server_options["handoff"]
+    if os.path.exists(path):
+        os.unlink(path)  # left by the previous server
+    successor_socket = socket(AF_UNIX, SOCK_STREAM)
+    try:
+        successor_socket.bind(path)
+    except OSError:
+        print(f"Error: unable to listen on {path}.", file=stderr)
+        os._exit(6)
+    successor_socket.listen(1)
+    Thread(target=wait_for_successor, args=(successor_socket,), daemon=True).start()
+
+
+# A handoff only returns if it failed, this server then goes on as before
+def wait_for_successor(successor_socket):
+    while True:
+        successor, _ = successor_socket.accept()
+        successor.settimeout(HANDOFF_TIMEOUT)
+        if event_loop is None:
+            hand_off(successor)
+        else:
+            asyncio.run_coroutine_threadsafe(hand_off_on_loop(successor), event_loop).result()
+        successor.close()
+        write_output("[Server Message] Handoff to the new server failed, this server keeps running.\n")
+
+
+# Connections that arrive during the handoff wait in the accept queues, give them room
+def enlarge_accept_queues():
+    for listening_socket in list(listening_channel_sockets.values()) + [single_port_socket]:
+        if listening_socket is not None:
+            listening_socket.listen(SOMAXCONN)
+
+
+# Sessions that go on in the new server, the others are dropped with this one. A file being
+# sent is not handed off, the new server could not tell the raw bytes of its chunks from messages
+def is_transferable(client):
+    return (not client.duplication and client.state is not State.DISCONNECTED and not client.socket.is_closing()
+            and not client.uploads and not client.incoming)
+
+
+def wait_until_drained(sessions, deadline):
+    return monotonic() >= deadline or all(client.socket.drained() for client in sessions if is_transferable(client))
+
+
+# Threaded server: the channel locks are held until this process exits, so no timer or admin
+# command changes a channel after its state is sent
+def hand_off(successor):
+    with reload_lock:
+        enlarge_accept_queues()
+        handoff_gate.close()
+        names = sorted(channel_locks)
+        for name in names:
+            channel_locks[name].acquire()
+        try:
+            deadline = monotonic() + HANDOFF_DRAIN_TIMEOUT
+            while not wait_until_drained(list(open_sessions), deadline):
+                sleep(0.01)
+            send_state(successor)
+        finally:
+            for name in names:
+                channel_locks[name].release()
+            handoff_gate.open()
+
+
+# --async server: the state is sent from the loop in one go, so it is consistent without any lock.
+# The servers are closed so nothing more is accepted, their listening sockets are kept open
+async def hand_off_on_loop(successor):
+    global single_port_socket
+    for name in list(channel_servers):
+        if name is None:
+            single_port_socket = single_port_socket.dup()
+        else:
+            listening_channel_sockets[name] = listening_channel_sockets[name].dup()
+        channel_servers.pop(name).close()
+    enlarge_accept_queues()
+    await asyncio.sleep(0.05)  # connections accepted just before get their protocol
+    paused = []
+    for client in list(open_sessions):
+        if client.socket.transport.is_reading():
+            client.socket.transport.pause_reading()
+            paused.append(client)
+    deadline = monotonic() + HANDOFF_DRAIN_TIMEOUT
+    while not wait_until_drained(list(open_sessions), deadline):
+        await asyncio.sleep(0.01)
+    send_state(successor)
+    for client in paused:
+        if client.held is None:
+            client.socket.transport.resume_reading()
+    for name, listening_socket in list(listening_channel_sockets.items()):
+        if name not in channel_servers:
+            await start_channel_server(name, listening_socket)
+    if single_port_socket is not None and None not in channel_servers:
+        await start_single_port_server()
+
+
+# The state goes out as JSON, then the descriptors, HANDOFF_FDS_PER_MESSAGE at a time. This
+# process exits once the successor acknowledges it has everything
+def send_state(successor):
+    descriptors = []
+    data = json.dumps(handoff_state(descriptors)).encode()
+    for log in channel_logs.values():  # the successor opens them again
+        log.close()
+    try:
+        successor.sendall(HANDOFF_HEADER.pack(len(data), len(descriptors)) + data)
+        for start in range(0, len(descriptors), HANDOFF_FDS_PER_MESSAGE):
+            send_fds(successor, [b"F"], descriptors[start:start + HANDOFF_FDS_PER_MESSAGE])
+        if successor.recv(1) == b"K":
+            write_output("[Server Message] Handed off to the new server process.\n")
+            output_writer.flush()
+            os._exit(0)
+    except OSError:
+        pass
+    open_channel_logs(list(channel_logs))
+
+
+# Descriptors are sent as their position in descriptors
+def handoff_state(descriptors):
+    now = monotonic()
+    state = {"listeners": {}, "single_port": None, "channels": {}, "sessions": []}
+    for name, listening_socket in listening_channel_sockets.items():
+        state["listeners"][name] = len(descriptors)
+        descriptors.append(listening_socket.fileno())
+    if single_port_socket is not None:
+        state["single_port"] = len(descriptors)
+        descriptors.append(single_port_socket.fileno())
+    for name in channel_names:
+        channel = channels[name]
+        state["channels"][name] = {"members": list(channel.members), "queue": list(channel.queue),
+                                   "notified": channel.queue.notified,
+                                   "history": [[message, offset] for message, offset, *_ in channel_history[name].entries]}
+    for client in list(open_sessions):
+        if not is_transferable(client) or not client.socket.drained():
+            continue
+        unread = client.framer.unread()
+        if client.held is not None:  # delayed by a rate limit, it is processed again by the successor
+            unread = encode_frame(client.held[1], *client.held[2]) + unread
+        afk_timer = client.afk_timer
+        state["sessions"].append({
+            "fd": len(descriptors), "address": client.address, "channel": client.channel_name,
+            "username": client.username, "state": client.state.value if client.state is not None else None,
+            "muted_for": max(0.0, client.muted_until - now),
+            "afk_in": afk_timer.deadline - now if afk_timer is not None and not afk_timer.cancelled else None,
+            "capabilities": sorted(client.capabilities), "version": client.socket.version,
+            "subscription": client.subscription, "unread": unread.decode("latin-1")})
+        descriptors.append(client.socket.fileno())
+    return state
+
+
+def receive_exactly(connection, length):
+    data = b""
+    while len(data) < length:
+        chunk = connection.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError()
+        data += chunk
+    return data
+
+
+# Return (state, sockets) received from the server running with the same --handoff path,
+# or None if there is none. Once it acknowledged, the previous server exits, which frees the
+# ports it served alone (metrics, changed channels) before this one starts
+def take_over():
+    predecessor = socket(AF_UNIX, SOCK_STREAM)
+    try:
+        predecessor.connect(server_options["handoff"])
+    except OSError:
+        predecessor.close()
+        return None
+    try:
+        predecessor.settimeout(HANDOFF_TIMEOUT)
+        length, count = HANDOFF_HEADER.unpack(receive_exactly(predecessor, HANDOFF_HEADER.size))
+        state = json.loads(receive_exactly(predecessor, length))
+        descriptors = []
+        while len(descriptors) < count:
+            data, received, _, _ = recv_fds(predecessor, 1, HANDOFF_FDS_PER_MESSAGE)
+            if not data:
+                raise ConnectionError()
+            descriptors += received
+        predecessor.sendall(b"K")
+        predecessor.recv(1)  # end of file once the previous server exited
+    except (OSError, ValueError):
+        print("Error: unable to take over from the running server.", file=stderr)
+        os._exit(6)
+    predecessor.close()
+    return state, [socket(fileno=descriptor) for descriptor in descriptors]
+
+
+# Listening sockets of channels still on the same port are kept, the others are closed
+def adopt_listeners(state, sockets):
+    global single_port_socket
+    for name, position in state["listeners"].items():
+        listening_socket = sockets[position]
+        if (name in channel_indexes and not server_options["port"]
+                and listening_socket.getsockname()[1] == channels[name].port):
+            listening_channel_sockets[name] = listening_socket
+        else:
+            listening_socket.close()
+    if state["single_port"] is not None:
+        listening_socket = sockets[state["single_port"]]
+        if server_options["port"] and listening_socket.getsockname()[1] == int(server_options["port"]):
+            single_port_socket = listening_socket
+        else:
+            listening_socket.close()
+
+
+# Return the sessions taken over, as (saved session, socket). The clients of channels that
+# are gone are told so, like after /reload
+def sessions_taken_over(state, sockets):
+    sessions = []
+    for saved in state["sessions"]:
+        client_socket = sockets[saved["fd"]]
+        if saved["channel"] is not None and saved["channel"] not in channel_indexes:
+            try:
+                client_socket.sendall(encode_message(saved["version"], EMPTY))
+            except OSError:
+                pass
+            client_socket.close()
+            continue
+        sessions.append((saved, client_socket))
+    return sessions
+
+
+def restore_session(client, saved):
+    client.username = saved["username"]
+    client.state = State(saved["state"]) if saved["state"] is not None else None
+    client.capabilities = set(saved["capabilities"])
+    client.socket.version = saved["version"]
+    if client.state is State.MUTED:
+        client.muted_until = monotonic() + saved["muted_for"]
+        call_later(saved["muted_for"], unmute, client)
+    if saved["afk_in"] is not None:
+        client.afk_timer = call_later(saved["afk_in"], went_afk, client)
+    if client.username is not None:
+        channels[client.channel_name].sessions[client.username] = client
+        index_user(client)
+    if saved.get("subscription") is not None:  # not sent by servers older than "/list subscribe"
+        channel_directory.subscribe(client, saved["subscription"])
+    open_sessions.add(client)
+
+
+# Members and waiting users keep their order, those whose session could not be handed off
+# leave like any other client
+def restore_channels(state):
+    for name, saved in state["channels"].items():
+        if name not in channel_indexes:
+            continue
+        with channel_locks[name]:
+            channel = channels[name]
+            for message, offset in saved["history"]:
+                channel_history[name].append(message, offset, {})
+            for username in saved["members"]:
+                if username in channel.sessions:
+                    channel.members[username] = channel.sessions[username]
+                else:
+                    left_notification(username, name)
+            for username in saved["queue"]:
+                if username in channel.sessions:
+                    channel.queue.append(username)
+                else:
+                    left_notification(username, name)
+            channel.queue.notified.update((username, position) for username, position in saved["notified"].items()
+                                          if username in channel.queue)
+            while len(channel.members) < channel.capacity and len(channel.queue) > 0:
+                dequeue(name)
+            schedule_queue_update(name)
+
+
+# Threaded server: each client gets its reader and writer threads back
+def restore_sessions(state, sockets):
+    global taken_over
+    restored = []
+    for saved, client_socket in sessions_taken_over(state, sockets):
+        client = Session(OutboundSocket(client_socket), saved["address"] and tuple(saved["address"]), saved["channel"])
+        restore_session(client, saved)
+        if metrics is not None:
+            metrics.connection_opened()
+        restored.append((client, client_socket, saved["unread"].encode("latin-1")))
+    restore_channels(state)
+    for client, client_socket, unread in restored:
+        Thread(target=read_from_client, args=(client, client_socket, unread)).start()
+    taken_over = len(restored)
+
+
+# --async server: run before the servers start accepting
+async def restore_sessions_on_loop(state, sockets):
+    global taken_over
+    restored = []
+    for saved, client_socket in sessions_taken_over(state, sockets):
+        _, protocol = await event_loop.connect_accepted_socket(
+            lambda: ChannelProtocol(saved["channel"], restored=True), sock=client_socket)
+        restore_session(protocol.client, saved)
+        restored.append((protocol, saved["unread"].encode("latin-1")))
+    restore_channels(state)
+    for protocol, unread in restored:
+        protocol.take_over(unread)
+    taken_over = len(restored)
+
+
+# Called after every change of the members or the queue of a channel. In --workers mode, the
+# worker tells the coordinator about the channels it serves
+def publish_channel(channel_name, joined=(), left=()):
+    channel_directory.channel_changed(channel_name)
+    if cluster_nodes:
+        relay_channel(channel_name, joined, left)
+    if coordinator_connection is None:
+        return
+    current_capacity, in_queue = channel_occupancy(channel_name)
+    send_to_coordinator(("channel", channel_name, current_capacity, in_queue, list(joined), list(left)))
+
+
+def send_to_coordinator(message):
+    with coordinator_send_lock:
+        coordinator_connection.send(message)
+
+
+def ask_coordinator(*request):
+    request_id = next(request_ids)
+    coordinator_requests[request_id] = [Event(), None]
+    send_to_coordinator((request[0], request_id, *request[1:]))
+    coordinator_requests[request_id][0].wait()
+    return coordinator_requests.pop(request_id)[1]
+
+
+def listen_to_coordinator():
+    while True:
+        message = coordinator_connection.recv()
+        if message[0] == "directory":
+            remote_channels[message[1]] = message[2:]
+            channel_directory.channel_changed(message[1])
+        elif message[0] == "reply":
+            coordinator_requests[message[1]][1] = message[2]
+            coordinator_requests[message[1]][0].set()
+        elif message[0] == "admin":
+            run_admin_command(admin_commands[message[2]], message[3])
+            send_to_coordinator(("reply", message[1], None))
+        elif message[0] == "metrics":
+            send_to_coordinator(("reply", message[1], collect_metrics()))
+
+
+# Body of a worker process: it only accepts connections on its own channels,
+# the state of every other channel stays empty in this process
+def run_worker(connection, indexes):
+    global coordinator_connection
+    global owned_channels
+    global metrics
+    coordinator_connection = connection
+    owned_channels = {channel_names[index] for index in indexes}
+    if server_options["metrics"]:
+        metrics = Metrics(owned_channels)
+    output_writer.start()
+    open_channel_logs(owned_channels)  # after the fork, the commit threads of the logs run in this worker
+    for other_connection in worker_connections:  # inherited from the coordinator, which started earlier workers
+        other_connection.close()
+    worker_connections.clear()
+    remote_channels.update({name: (0, 0) for name in channel_names if name not in owned_channels})
+    for name in channel_names:
+        if name not in owned_channels:
+            listening_channel_sockets.pop(name).close()
+    Thread(target=listen_to_coordinator, daemon=True).start()
+    if server_options["async"]:
+        start_event_loop_server([channel_names[index] for index in indexes])
+    else:
+        Thread(target=timer_wheel.run, daemon=True).start()
+        create_all_ports.set()  # the coordinator forks the workers before it sets its own
+        acceptor.start()
+        for index in indexes:
+            serve_channel(channel_names[index])
+    Event().wait()
+
+
+# Coordinator side of --workers mode. Channel i is served by worker i % N. The coordinator keeps
+# the occupancy and usernames of every channel, so it can answer duplicate name checks for
+# /switch and pass occupancy changes on to the other workers for $List
+def start_workers(count):
+    context = multiprocessing.get_context("fork")
+    for worker in range(count):
+        coordinator_end, worker_end = context.Pipe()
+        indexes = [index for index in range(len(channel_names)) if index % count == worker]
+        context.Process(target=run_worker, args=(worker_end, indexes), daemon=True).start()
+        worker_connections.append(coordinator_end)
+        worker_send_locks.append(Lock())
+    for name in channel_names:
+        directory[name] = [0, 0, set()]
+    for worker in range(count):
+        Thread(target=coordinate_worker, args=(worker,), daemon=True).start()
+
+
+def send_to_worker(worker, message):
+    with worker_send_locks[worker]:
+        worker_connections[worker].send(message)
+
+
+def ask_worker(worker, *request):
+    request_id = next(request_ids)
+    coordinator_requests[request_id] = [Event(), None]
+    send_to_worker(worker, (request[0], request_id, *request[1:]))
+    coordinator_requests[request_id][0].wait()
+    return coordinator_requests.pop(request_id)[1]
+
+
+def coordinate_worker(worker):
+    while True:
+        message = worker_connections[worker].recv()
+        if message[0] == "channel":
+            _, channel_name, current_capacity, in_queue, joined, left = message
+            with directory_lock:
+                entry = directory[channel_name]
+                entry[0], entry[1] = current_capacity, in_queue
+                entry[2].update(joined)
+                entry[2].difference_update(left)
+                for username in joined:
+                    directory_users.setdefault(username, set()).add(channel_name)
+                for username in left:
+                    user_channels = directory_users.get(username)
+                    if user_channels is not None:
+                        user_channels.discard(channel_name)
+                        if not user_channels:
+                            del directory_users[username]
+            for other_worker in range(len(worker_connections)):
+                if other_worker != worker:
+                    send_to_worker(other_worker, ("directory", channel_name, current_capacity, in_queue))
+        elif message[0] == "has_user":
+            _, request_id, channel_name, username = message
+            with directory_lock:
+                found = username in directory[channel_name][2]
+            send_to_worker(worker, ("reply", request_id, found))
+        elif message[0] == "reply":
+            coordinator_requests[message[1]][1] = message[2]
+            coordinator_requests[message[1]][0].set()
+
+
+# Relay between the nodes of a cluster: every node sends the changes of its own channels to every
+# other node, as JSON lines over one TCP connection per node. Messages queued while a connection
+# is busy go out in one write, and a node that is down is retried with an increasing delay. After
+# each (re)connection, the full state of the sender's channels is sent first
+def relay_channel(channel_name, joined=(), left=()):
+    current_capacity, in_queue = channel_occupancy(channel_name)
+    message = {"type": "channel", "name": channel_name, "current": current_capacity, "queue": in_queue,
+               "joined": list(joined), "left": list(left)}
+    for node_id in peer_queues:
+        relay_to_node(node_id, message)
+
+
+def relay_to_node(node_id, message):
+    condition, pending = peer_queues[node_id]
+    with condition:
+        pending.append((json.dumps(message) + "\n").encode())
+        condition.notify()
+
+
+def channel_snapshot(channel_name):
+    with channel_locks[channel_name]:
+        current_capacity, in_queue = channel_occupancy(channel_name)
+        users = list(channels[channel_name].sessions)
+    return {"type": "snapshot", "name": channel_name, "current": current_capacity, "queue": in_queue,
+            "users": users}
+
+
+def send_to_node(node_id):
+    condition, pending = peer_queues[node_id]
+    retry_delay = 0.1
+    while True:
+        try:
+            node_socket = create_connection(tuple(cluster_nodes[node_id]))
+        except OSError:
+            sleep(retry_delay)
+            retry_delay = min(2 * retry_delay, RELAY_RETRY_MAX)
+            continue
+        retry_delay = 0.1
+        with condition:
+            pending.clear()  # the snapshot below already includes these changes
+        try:
+            snapshot = [(json.dumps(channel_snapshot(name)) + "\n").encode() for name in sorted(owned_channels)]
+            node_socket.sendall(b"".join(snapshot))
+            while True:
+                with condition:
+                    condition.wait_for(lambda: pending)
+                    batch = b"".join(pending)
+                    pending.clear()
+                node_socket.sendall(batch)
+        except OSError:
+            node_socket.close()
+
+
+# A malformed message is dropped, the next ones are still applied
+def receive_from_node(node_socket):
+    framer = LineFramer()
+    with node_socket:
+        try:
+            while data := node_socket.recv(BUFSIZE):
+                framer.feed(data)
+                for line in framer.lines():
+                    try:
+                        apply_relay_message(json.loads(line))
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        pass
+        except (OSError, LineTooLong):
+            pass
+
+
+# Other nodes only tell about their own channels, and only pass on the admin commands
+# that name a channel of this node
+def apply_relay_message(message):
+    if message["type"] in ("snapshot", "channel") and message["name"] not in remote_channels:
+        return
+    if message["type"] == "snapshot":
+        remote_channels[message["name"]] = (message["current"], message["queue"])
+        remote_users[message["name"]] = set(message["users"])
+        channel_directory.channel_changed(message["name"])
+    elif message["type"] == "channel":
+        remote_channels[message["name"]] = (message["current"], message["queue"])
+        remote_users[message["name"]].update(message["joined"])
+        remote_users[message["name"]].difference_update(message["left"])
+        channel_directory.channel_changed(message["name"])
+    elif message["type"] == "admin":
+        command = message["line"].split()
+        if message["function"] in admin_commands and len(command) > 1 and command[1] in owned_channels:
+            run_admin_command(admin_commands[message["function"]], message["line"])
+
+
+# Only the nodes of the configuration file may connect, from one of the addresses of their host
+def accept_from_nodes(relay_socket, node_addresses):
+    while True:
+        node_socket, address = relay_socket.accept()
+        if address[0] not in node_addresses:
+            node_socket.close()
+            continue
+        Thread(target=receive_from_node, args=(node_socket,), daemon=True).start()
+
+
+def node_addresses():
+    addresses = set()
+    for host, _ in cluster_nodes.values():
+        try:
+            addresses.update(info[4][0] for info in getaddrinfo(host, None, AF_INET))
+        except OSError:
+            pass  # a node that cannot be resolved cannot connect either
+    return addresses
+
+
+# The relay listens on the host given for this node only
+def start_cluster_relay():
+    relay_socket = socket(AF_INET, SOCK_STREAM)
+    relay_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    relay_host, relay_port = cluster_nodes[server_options["node"]]
+    try:
+        relay_socket.bind((relay_host, relay_port))
+    except Exception:
+        print(f"Error: unable to listen on port {relay_port}.", file=stderr)
+        os._exit(6)
+    relay_socket.listen(len(cluster_nodes))
+    for name in channel_names:
+        if not is_local_channel(name):
+            remote_channels[name] = (0, 0)
+            remote_users[name] = set()
+    for node_id in cluster_nodes:
+        if node_id != server_options["node"]:
+            peer_queues[node_id] = [Condition(), deque()]
+            Thread(target=send_to_node, args=(node_id,), daemon=True).start()
+    Thread(target=accept_from_nodes, args=(relay_socket, node_addresses()), daemon=True).start()
 
 
 # REF: The use of Event and their function set(), wait() is inspired by the code at
 # REF: https://www.instructables.com/Starting-and-Stopping-Python-Threads-With-Events-i/
 if __name__ == "__main__":
     process_command_line()
-    check_valid_file()
-    remaining_ports = len(channel_port)  # will be decrement to check finished port
-    channels = [None] * remaining_ports  # store the socket object?
-    listening_channel_sockets = [None] * remaining_ports
-    channel_users = {each_channel: [[],[]] for each_channel in channel_names}  # check duplicate users in each channel
-    client_info = {each_channel: {} for each_channel in channel_names}
+    config = check_valid_file()
+    output_writer.start()
+    channels = {each_channel: Channel(config.ports[index], config.capacities[index])
+                for index, each_channel in enumerate(channel_names)}
+    channel_history = {each_channel: MessageHistory(int(server_options["history"]), int(server_options["history-bytes"]))
+                       for each_channel in channel_names}
+    channel_locks = {each_channel: new_channel_lock() for each_channel in channel_names}
+    # in --node mode, only the channels of this node are served here
+    served_channels = [name for name in channel_names if is_local_channel(name)]
+    handoff = None
+    if server_options["handoff"]:
+        open_sessions = set()
+        handoff = take_over()
+        if handoff is not None:
+            adopt_listeners(*handoff)
+    if server_options["port"]:
+        if single_port_socket is None:
+            listen_to_single_port()
+        for name in served_channels:
+            print_channel_banner(name)
+        served_channels = []
     # Listen to each socket first
-    for index, port_num in enumerate(channel_port):
-        listen_to_channel_sockets(port_num, index)
+    for name in served_channels:
+        if name not in listening_channel_sockets:  # taken over from the previous server
+            listen_to_channel_sockets(name)
     if cant_listen_detected:
         os._exit(6)
-    # Thread per listening socket
-    for index, port_num in enumerate(channel_port):
-        listening_thread = Thread(target=start_server, args=(port_num, index))
-        listening_thread.start()
-    while remaining_ports > 0:
-        pass
-    stdout.write("Welcome to chatserver.\n")
-    stdout.flush()
+    if cluster_nodes:
+        start_cluster_relay()
+    if int(server_options["workers"]) == 1:
+        open_channel_logs([name for name in channel_names if is_local_channel(name)])
+        if server_options["metrics"]:
+            metrics = Metrics([name for name in channel_names if is_local_channel(name)])
+    if int(server_options["workers"]) > 1:
+        for name in channel_names:
+            print_channel_banner(name)
+        start_workers(int(server_options["workers"]))
+    elif server_options["async"]:
+        for name in served_channels:
+            print_channel_banner(name)
+        start_event_loop_server(served_channels, handoff)
+    else:
+        if server_options["handoff"]:
+            handoff_gate = HandoffGate()
+        Thread(target=timer_wheel.run, daemon=True).start()
+        acceptor.start()
+        if single_port_socket is not None:
+            acceptor.add(single_port_socket, None)
+        for name in served_channels:
+            print_channel_banner(name)
+            serve_channel(name)
+        if handoff is not None:
+            restore_sessions(*handoff)
+    if server_options["metrics-port"]:  # after the workers are forked, they do not serve it
+        start_http_server(int(server_options["metrics-port"]), collect_metrics)
+    write_output("Welcome to chatserver.\n")
     create_all_ports.set()  # all channels start accepting connections
+    if handoff is not None:
+        write_output(f"[Server Message] Took over {taken_over} connections from the previous server.\n")
+    if server_options["handoff"]:
+        listen_for_successor()
+    # The handler runs on the main thread, which may be in the middle of an admin command
+    signal.signal(signal.SIGHUP, lambda signum, frame: Thread(target=run_admin_command,
+                                                              args=(reload, "/reload\n")).start())
 
     # Main thread starts reading from stdin
     try:
         for line in stdin:
-            with lock:
-                if not line:
-                    server_shutdown("/shutdown\n")
-                if line[:9] == "/shutdown":
-                    server_shutdown(line)
-                elif line[:5] == "/kick":
-                    kick(line)
-                elif line[:6] == "/empty":
-                    empty(line)
-                elif line[:5] == "/mute":
-                    mute(line)
+            if not line:
+                server_shutdown("/shutdown\n")
+            if line[:9] == "/shutdown":
+                server_shutdown(line)
+            elif line[:5] == "/kick":
+                run_admin_command(kick, line)
+            elif line[:6] == "/empty":
+                run_admin_command(empty, line)
+            elif line[:5] == "/mute":
+                run_admin_command(mute, line)
+            elif line[:6] == "/stats":
+                stats(line)
+            elif line[:6] == "/trace":
+                trace(line)
+            elif line[:7] == "/reload":
+                run_admin_command(reload, line)
     except Exception:
         pass
-    server_shutdown("/shutdown\n")
\ No newline at end of file
+    server_shutdown("/shutdown\n")
@@ -0,0 +1,109 @@
+import os
+import sys
+from heapq import heappush, heappushpop
+from threading import Lock, Thread, get_ident
+from time import perf_counter, sleep
+from chatmetrics import Histogram
+
+SLOWEST_FAN_OUTS = 10  # fan-outs kept for the report
+
+
+# Lock that records how long it is waited for and how long it is held. It wraps the lock it
+# traces, so it can be swapped in and out at any time: threads that took the lock itself and
+# threads that take it through the wrapper still exclude each other
+class TracedLock:
+    __slots__ = ("lock", "name", "tracer", "acquired_at")
+
+    def __init__(self, lock, name, tracer):
+        self.lock = lock
+        self.name = name
+        self.tracer = tracer
+        self.acquired_at = None  # only set and read by the thread holding the lock
+
+    def acquire(self, blocking=True, timeout=-1):
+        started = perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            self.acquired_at = perf_counter()
+            self.tracer.record(self.tracer.lock_waits, self.name, self.acquired_at - started)
+        return acquired
+
+    # The lock may have been taken before the wrapper was swapped in, then its hold time is unknown
+    def release(self):
+        acquired_at, self.acquired_at = self.acquired_at, None
+        self.lock.release()
+        if acquired_at is not None:
+            self.tracer.record(self.tracer.lock_holds, self.name, perf_counter() - acquired_at)
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+# Everything recorded while tracing is on. Nothing here runs when it is off: the server only
+# checks whether it has a Tracer, and its locks are the plain ones
+class Tracer:
+    def __init__(self, sample_interval):
+        self.lock = Lock()  # guards the records below
+        self.started = perf_counter()
+        self.stopped = None
+        self.lock_waits = {}  # {lock name: Histogram}
+        self.lock_holds = {}
+        self.handlers = {}  # {message type name: Histogram of the time to handle one}
+        self.parsing = Histogram()  # time to split and decode one message
+        self.fan_outs = []  # heap of the slowest (seconds, channel_name, members)
+        self.samples = {}  # {stack as code objects from the outermost call: times it was sampled}
+        self.sample_count = 0
+        Thread(target=self.sample_forever, args=(sample_interval,), daemon=True).start()
+
+    def trace_lock(self, lock, name):
+        return TracedLock(lock, name, self)
+
+    def record(self, histograms, name, seconds):
+        with self.lock:
+            if name not in histograms:
+                histograms[name] = Histogram()
+            histograms[name].record(seconds)
+
+    def parsed(self, seconds):
+        with self.lock:
+            self.parsing.record(seconds)
+
+    def fanned_out(self, channel_name, members, seconds):
+        with self.lock:
+            if len(self.fan_outs) < SLOWEST_FAN_OUTS:
+                heappush(self.fan_outs, (seconds, channel_name, members))
+            elif seconds > self.fan_outs[0][0]:
+                heappushpop(self.fan_outs, (seconds, channel_name, members))
+
+    # Periodic samples of the stacks of every thread, the sampling thread itself excepted
+    def sample_forever(self, interval):
+        own_thread = get_ident()
+        while self.stopped is None:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack = tuple(reversed(stack))
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+                self.sample_count += 1
+            sleep(interval)
+
+    def stop(self):
+        self.stopped = perf_counter()
+
+    # Collapsed stacks, one line per stack: "frame;frame;frame count", the input of flamegraph.pl
+    def write_collapsed(self, path):
+        with open(path, "w") as stack_file:
+            for stack, count in sorted(list(self.samples.items()), key=lambda item: -item[1]):
+                frames = ";".join(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                                  for code in stack)
+                stack_file.write(f"{frames} {count}\n")